@@ -0,0 +1,250 @@
+from __future__ import annotations
+import json
+import os
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, List, Optional
+
+import numpy as np
+
+# 可插拔的 embedding 推理后端
+#   torch - sentence-transformers + PyTorch（默认，参考实现）
+#   onnx  - 从同一个 sentence-transformers 模型导出的 ONNX 图，用 ONNX Runtime 推理；
+#           可选 int8 动态量化（权重量化，CPU 上通常快 2~3 倍）
+# 两个后端输出一致：mean pooling + L2 归一化（e5 系列模型的池化方式）
+#
+# ONNX 模型导出一次后缓存在 model_dir 下:
+#   model.onnx       - fp32 导出结果
+#   model.int8.onnx  - 动态量化结果
+#   tokenizer/       - 分词器
+#   export.json      - 源模型名、最大序列长度
+
+# 单批文本数上限：文本很短时也不要一次塞进太多条
+MAX_BATCH = 256
+
+
+# 中日韩字符（假名、汉字、谚文）：分词器里约 1 字 1 token
+def is_wide_char(ch: str) -> bool:
+    return "぀" <= ch <= "鿿" or "가" <= ch <= "힯"
+
+
+# 估算文本的 token 数：中日韩字符约 1 字 1 token，其他字符约 4 字符 1 token，另加 2 个特殊 token
+def estimate_tokens(text: str) -> int:
+    cjk = sum(1 for ch in text if is_wide_char(ch))
+    return cjk + (len(text) - cjk) // 4 + 2
+
+
+# 长度分桶的动态批：按 token 数排序后贪心切分，
+# 每批 条数 × 批内最长 token 数（padding 后的总量）不超过 token_budget，条数不超过 max_batch
+# 返回每批在原列表中的下标；长度相近的文本分在一起，padding 浪费最小
+def plan_batches(
+    lengths: List[int], token_budget: int, max_batch: int = MAX_BATCH
+) -> List[List[int]]:
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches: List[List[int]] = []
+    cur: List[int] = []
+    for i in order:
+        # 升序排列，加入 i 后批内最长的就是 lengths[i]
+        if cur and (
+            (len(cur) + 1) * lengths[i] > token_budget or len(cur) >= max_batch
+        ):
+            batches.append(cur)
+            cur = []
+        cur.append(i)
+    if cur:
+        batches.append(cur)
+    return batches
+
+
+# 后端必须实现 encode；没有实现的子类在构造时就报错
+class EmbeddingBackend(ABC):
+    name = "base"
+    # 模型最大序列长度，超出部分被截断
+    max_length = 512
+
+    # 返回 (N, dim) float32，已 L2 归一化
+    @abstractmethod
+    def encode(self, texts: List[str], batch_size: int) -> np.ndarray: ...
+
+    # 每条文本截断后的 token 数（含特殊 token），用于分桶；没有分词器时按字符估算
+    def token_lengths(self, texts: List[str]) -> List[int]:
+        return [min(estimate_tokens(t), self.max_length) for t in texts]
+
+
+def _tokenizer_lengths(tokenizer: Any, texts: List[str], max_length: int) -> List[int]:
+    ids = tokenizer(texts, truncation=True, max_length=max_length)["input_ids"]
+    return [len(x) for x in ids]
+
+
+class TorchBackend(EmbeddingBackend):
+    name = "torch"
+
+    def __init__(self, model_name: str, threads: Optional[int] = None) -> None:
+        from sentence_transformers import SentenceTransformer
+
+        if threads:
+            import torch
+
+            torch.set_num_threads(threads)
+        # 加载 SentenceTransformer 文本向量模型
+        self.model = SentenceTransformer(model_name)
+        self.max_length = int(self.model.max_seq_length)
+
+    def encode(self, texts: List[str], batch_size: int) -> np.ndarray:
+        # 归一化后用内积检索≈余弦相似度，效果更稳定
+        vecs = self.model.encode(
+            texts,
+            batch_size=batch_size,
+            show_progress_bar=False,
+            normalize_embeddings=True,
+        )
+        # 确保返回 float32 类型，FAISS 要求
+        return np.asarray(vecs, dtype="float32")
+
+    def token_lengths(self, texts: List[str]) -> List[int]:
+        return _tokenizer_lengths(self.model.tokenizer, texts, self.max_length)
+
+
+def onnx_available() -> bool:
+    import importlib.util
+
+    return importlib.util.find_spec("onnxruntime") is not None
+
+
+# 导出（必要时量化）ONNX 模型，已存在则直接复用；返回要加载的 .onnx 路径
+def export_onnx(model_name: str, model_dir: Path, quantize: bool = False) -> Path:
+    fp32 = model_dir / "model.onnx"
+    int8 = model_dir / "model.int8.onnx"
+    if not fp32.exists():
+        _export_fp32(model_name, model_dir, fp32)
+    if quantize and not int8.exists():
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        tmp = int8.with_suffix(".tmp")
+        quantize_dynamic(str(fp32), str(tmp), weight_type=QuantType.QInt8)
+        os.replace(tmp, int8)
+    return int8 if quantize else fp32
+
+
+def _export_fp32(model_name: str, model_dir: Path, out: Path) -> None:
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    st = SentenceTransformer(model_name, device="cpu")
+    pooling = [m for m in st if hasattr(m, "get_pooling_mode_str")]
+    if not pooling or pooling[0].get_pooling_mode_str() != "mean":
+        raise ValueError(
+            f"onnx backend only supports mean-pooling models: {model_name}"
+        )
+
+    transformer = st[0].auto_model.eval()
+    tokenizer = st.tokenizer
+    dummy = tokenizer(["query: onnx export"], return_tensors="pt")
+    input_names = [
+        k for k in ("input_ids", "attention_mask", "token_type_ids") if k in dummy
+    ]
+
+    # 只导出 Transformer 主体，输出 last_hidden_state；池化和归一化在 numpy 里做
+    class _Encoder(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self.model = transformer
+
+        def forward(self, *inputs: torch.Tensor) -> torch.Tensor:
+            return self.model(**dict(zip(input_names, inputs)))[0]
+
+    model_dir.mkdir(parents=True, exist_ok=True)
+    axes = {name: {0: "batch", 1: "seq"} for name in input_names}
+    axes["last_hidden_state"] = {0: "batch", 1: "seq"}
+    tmp = out.with_suffix(".tmp")
+    with torch.no_grad():
+        torch.onnx.export(
+            _Encoder(),
+            tuple(dummy[k] for k in input_names),
+            str(tmp),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=axes,
+            opset_version=17,
+        )
+    tokenizer.save_pretrained(str(model_dir / "tokenizer"))
+    info = {"model": model_name, "max_seq_length": int(st.max_seq_length)}
+    (model_dir / "export.json").write_text(json.dumps(info, indent=2), encoding="utf-8")
+    os.replace(tmp, out)
+
+
+class OnnxBackend(EmbeddingBackend):
+    name = "onnx"
+
+    def __init__(
+        self,
+        model_name: str,
+        model_dir: Path,
+        quantize: bool = False,
+        threads: Optional[int] = None,
+    ) -> None:
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        path = export_onnx(model_name, model_dir, quantize=quantize)
+        opts = ort.SessionOptions()
+        if threads:
+            opts.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(
+            str(path), opts, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_dir / "tokenizer"))
+        info = json.loads((model_dir / "export.json").read_text(encoding="utf-8"))
+        self.max_length = int(info["max_seq_length"])
+
+    def encode(self, texts: List[str], batch_size: int) -> np.ndarray:
+        out: List[np.ndarray] = []
+        for i in range(0, len(texts), batch_size):
+            enc = self.tokenizer(
+                texts[i : i + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="np",
+            )
+            feeds = {
+                k: v.astype("int64") for k, v in enc.items() if k in self.input_names
+            }
+            hidden = self.session.run(None, feeds)[0]
+            # mean pooling：只平均非 padding 位置
+            mask = enc["attention_mask"][..., None].astype("float32")
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+            pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+            out.append(pooled.astype("float32"))
+        if not out:
+            return np.zeros((0, 0), dtype="float32")
+        return np.concatenate(out)
+
+    def token_lengths(self, texts: List[str]) -> List[int]:
+        return _tokenizer_lengths(self.tokenizer, texts, self.max_length)
+
+
+def create_backend(
+    backend: str,
+    model_name: str,
+    model_dir: Optional[Path] = None,
+    quantize: bool = False,
+    threads: Optional[int] = None,
+) -> EmbeddingBackend:
+    if backend == "torch":
+        if quantize:
+            raise ValueError("quantization is only supported by the onnx backend")
+        return TorchBackend(model_name, threads=threads)
+    if backend == "onnx":
+        if model_dir is None:
+            raise ValueError("onnx backend needs a model_dir for the exported model")
+        return OnnxBackend(model_name, model_dir, quantize=quantize, threads=threads)
+    raise ValueError(f"unknown embedding backend: {backend}")
+
+
+# 与参考实现（torch fp32）逐条比较余弦相似度，返回最小值
+def parity_cosine(reference: np.ndarray, vectors: np.ndarray) -> float:
+    if not len(vectors):
+        return 1.0
+    return float(np.min(np.sum(reference * vectors, axis=1)))
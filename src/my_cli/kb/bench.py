@@ -0,0 +1,433 @@
+from __future__ import annotations
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import tempfile
+import time
+import zlib
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from .paths import KBPaths, ensure_dirs
+from .chunker import Chunk, chunk_markdown_file, _infer_namespace
+from .tokenizer import tokenize
+from .index import build_faiss_index, choose_index_params
+from .bm25 import build_bm25_index
+from .build import build_kb
+from .manifest import scan_raw_files
+from .pack import load_kb_state, retrieve, rrf_fuse, search_kb
+from .snapshot import pin
+
+# kb bench：检索热点路径的基准测试
+#
+# 流程（每个规模一轮）：
+#   1. 生成合成 Markdown 语料（中英混合，固定种子可复现）
+#   2. 构建阶段：切块 / 分词 / 向量化 / FAISS 建索引 / BM25 建索引 / kb build 全流程
+#   3. 查询阶段：分词 / 查询向量化 / BM25 / FAISS / RRF / search_kb(热) / retrieve(冷)
+#   4. 每个阶段记录 p50/p95/p99 延迟、吞吐、进程峰值 RSS，结果写成 JSON
+#
+# 默认用 HashEmbedder 代替真实模型：确定性、离线、几乎零开销，测的是检索管线本身。
+# 两次结果可以用 compare_results 对比，超过阈值的阶段视为回归。
+
+RESULTS_VERSION = 1
+
+# 每个文件的 chunk 数（合成语料每个二级标题下一段正文，正好切成一个 chunk）
+SECTIONS_PER_FILE = 50
+# 向量化阶段每次调用的文本数
+EMBED_BATCH = 256
+# 冷启动 retrieve（每次都重新加载索引）重复次数上限
+COLD_REPEATS = 20
+
+_EN_WORDS = (
+    "asset lifecycle vendor license audit contract procurement inventory "
+    "depreciation approval workflow budget invoice warehouse maintenance "
+    "ticket service request incident change release deploy config policy "
+    "owner location category status report dashboard integration api sync"
+).split()
+_CJK_WORDS = (
+    "资产 生命周期 供应商 许可证 审计 合同 采购 库存 折旧 审批 流程 预算 发票 "
+    "仓库 维护 工单 服务 请求 事件 变更 发布 部署 配置 策略 负责人 位置 类别 "
+    "状态 报表 看板 集成 接口 同步"
+).split()
+
+
+# ---------- 合成语料 ----------
+
+
+def parse_size(text: str) -> int:
+    # "1k" / "100k" / "1m" / "5000"
+    m = re.fullmatch(r"\s*(\d+)\s*([kKmM]?)\s*", text)
+    if not m:
+        raise ValueError(f"invalid size: {text!r}")
+    n = int(m.group(1))
+    return n * {"": 1, "k": 1_000, "m": 1_000_000}[m.group(2).lower()]
+
+
+def _paragraph(rng: random.Random, n_words: int) -> str:
+    # 三种段落：纯中文、纯英文、中英混排
+    kind = rng.random()
+    if kind < 0.4:
+        words = [rng.choice(_CJK_WORDS) for _ in range(n_words)]
+        return "，".join("".join(words[i : i + 4]) for i in range(0, n_words, 4)) + "。"
+    if kind < 0.7:
+        return " ".join(rng.choice(_EN_WORDS) for _ in range(n_words)) + "."
+    return " ".join(
+        rng.choice(_CJK_WORDS) if rng.random() < 0.5 else rng.choice(_EN_WORDS)
+        for _ in range(n_words)
+    )
+
+
+# 在 raw_root 下生成约 num_chunks 个 chunk 的语料，返回文件数
+def generate_corpus(raw_root: Path, num_chunks: int, seed: int = 0) -> int:
+    rng = random.Random(seed)
+    num_files = max(1, -(-num_chunks // SECTIONS_PER_FILE))
+    remaining = num_chunks
+    for f in range(num_files):
+        ns = "domain" if f % 4 == 0 else "project"
+        d = raw_root / ns / f"group{f // 500:04d}"
+        d.mkdir(parents=True, exist_ok=True)
+        lines = [f"# 文档 {f} Document {f}", ""]
+        for s in range(min(SECTIONS_PER_FILE, remaining)):
+            lines.append(f"## 主题 {f}-{s} {rng.choice(_EN_WORDS)}")
+            lines.append("")
+            lines.append(_paragraph(rng, rng.randint(30, 120)))
+            lines.append("")
+        remaining -= min(SECTIONS_PER_FILE, remaining)
+        (d / f"doc{f:06d}.md").write_text("\n".join(lines), encoding="utf-8")
+    return num_files
+
+
+def generate_queries(num: int, seed: int = 0) -> List[str]:
+    rng = random.Random(seed + 1)
+    return [_paragraph(rng, rng.randint(3, 10)) for _ in range(num)]
+
+
+# ---------- 确定性 embedding 桩 ----------
+
+
+# 特征哈希：英文按单词、中文按单字，crc32 映射到维度和符号，再做 L2 归一化
+# 相同文本永远得到相同向量，词汇重叠越多相似度越高，足以让检索结果有意义
+@dataclass
+class HashEmbedder:
+    model_name: str = "stub/hash-384"
+    dim: int = 384
+    quantize: bool = False
+
+    @property
+    def model_id(self) -> str:
+        return self.model_name
+
+    def meta(self) -> Dict[str, Any]:
+        return {}
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        rows: List[int] = []
+        cols: List[int] = []
+        for i, text in enumerate(texts):
+            for tok in re.findall(r"[a-z0-9_]+|[\u4e00-\u9fff]", text.lower()):
+                rows.append(i)
+                cols.append(zlib.crc32(tok.encode("utf-8")))
+        out = np.zeros((len(texts), self.dim), dtype="float32")
+        if rows:
+            h = np.asarray(cols, dtype="int64")
+            sign = np.where(h & (1 << 31), -1.0, 1.0).astype("float32")
+            np.add.at(out, (np.asarray(rows), h % self.dim), sign)
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        out /= np.maximum(norms, 1e-12)
+        return out
+
+
+# ---------- 计时 ----------
+
+
+@dataclass
+class StageResult:
+    # 调用次数 / 处理的条目数（吞吐 = items / total_s）
+    calls: int
+    items: int
+    total_s: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    throughput: float
+    # 阶段结束时进程的峰值 RSS（高水位，单调不减）；Windows 上为 None
+    peak_rss_mb: Optional[float] = None
+
+
+@dataclass
+class SizeRun:
+    size: int
+    num_chunks: int
+    num_files: int
+    stages: Dict[str, StageResult] = field(default_factory=dict)
+
+
+def peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位是 KB，macOS 是字节
+    return rss / (1024 * 1024) if platform.system() == "Darwin" else rss / 1024
+
+
+def _stage(latencies: List[float], items: int) -> StageResult:
+    lat = np.asarray(latencies, dtype="float64")
+    total = float(lat.sum())
+    p50, p95, p99 = np.percentile(lat * 1000.0, [50, 95, 99]) if lat.size else (0, 0, 0)
+    return StageResult(
+        calls=int(lat.size),
+        items=items,
+        total_s=total,
+        p50_ms=float(p50),
+        p95_ms=float(p95),
+        p99_ms=float(p99),
+        throughput=items / total if total > 0 else 0.0,
+        peak_rss_mb=peak_rss_mb(),
+    )
+
+
+# 逐个调用 fn(arg) 计时；warmup 次数不计入结果
+def _time_calls(
+    fn: Callable[[Any], Any], args: List[Any], warmup: int = 0
+) -> List[float]:
+    for a in args[:warmup]:
+        fn(a)
+    out: List[float] = []
+    for a in args:
+        t0 = time.perf_counter()
+        fn(a)
+        out.append(time.perf_counter() - t0)
+    return out
+
+
+# ---------- 基准流程 ----------
+
+
+def run_size(
+    size: int,
+    work_dir: Path,
+    embedder: Any,
+    num_queries: int = 200,
+    seed: int = 0,
+    index_type: str = "flat",
+    topk: int = 8,
+    log: Callable[[str], None] = lambda msg: None,
+) -> SizeRun:
+    paths = KBPaths(work_dir)
+    ensure_dirs(paths)
+    log(f"generating corpus: {size} chunks")
+    num_files = generate_corpus(paths.kb_raw, size, seed=seed)
+    files = list(scan_raw_files(paths.kb_raw).values())
+    stages: Dict[str, StageResult] = {}
+
+    # 构建阶段
+    log("build: chunk")
+    chunks: List[Chunk] = []
+
+    def chunk_one(p: Path) -> None:
+        chunks.extend(
+            chunk_markdown_file(p, namespace=_infer_namespace(paths.kb_raw, p))
+        )
+
+    stages["chunk_markdown_file"] = _stage(_time_calls(chunk_one, files), len(files))
+
+    log("build: tokenize")
+    texts = [c.content for c in chunks]
+    corpus_tokens: List[List[str]] = []
+    lat = _time_calls(lambda t: corpus_tokens.append(tokenize(t)), texts)
+    stages["tokenize"] = _stage(lat, len(texts))
+
+    log("build: embed")
+    batches = [texts[i : i + EMBED_BATCH] for i in range(0, len(texts), EMBED_BATCH)]
+    parts: List[np.ndarray] = []
+    lat = _time_calls(lambda b: parts.append(embedder.encode(b)), batches)
+    stages["embed"] = _stage(lat, len(texts))
+    vectors = np.concatenate(parts) if parts else np.zeros((0, 1), dtype="float32")
+
+    log("build: faiss index")
+    ids = [c.chunk_id for c in chunks]
+    params = choose_index_params(index_type, vectors.shape[0], vectors.shape[1])
+    holder: Dict[str, Any] = {}
+    lat = _time_calls(
+        lambda _: holder.update(index=build_faiss_index(vectors, ids, params)), [None]
+    )
+    stages["index_build"] = _stage(lat, len(ids))
+
+    log("build: bm25 index")
+    lat = _time_calls(lambda _: build_bm25_index(corpus_tokens), [None])
+    stages["bm25_build"] = _stage(lat, len(corpus_tokens))
+    # 端到端构建前释放中间结果（就地清空：上面的计时函数引用着这些列表）
+    parts.clear()
+    corpus_tokens.clear()
+    texts.clear()
+    batches.clear()
+    holder.clear()
+
+    log("build: kb build (end-to-end)")
+    lat = _time_calls(
+        lambda _: build_kb(
+            paths,
+            model=embedder.model_name,
+            full=True,
+            embedder=embedder,
+            index_type=index_type,
+        ),
+        [None],
+    )
+    stages["kb_build"] = _stage(lat, len(chunks))
+
+    # 查询阶段
+    queries = generate_queries(num_queries, seed=seed)
+    state = load_kb_state(pin(paths))
+    warm = min(5, len(queries))
+
+    log("query: tokenize / embed")
+    q_tokens = [tokenize(q) for q in queries]
+    stages["query_tokenize"] = _stage(
+        _time_calls(tokenize, queries, warm), len(queries)
+    )
+    qvecs = [embedder.encode([f"query: {q}"]) for q in queries]
+    lat = _time_calls(lambda q: embedder.encode([f"query: {q}"]), queries, warm)
+    stages["query_embed"] = _stage(lat, len(queries))
+
+    log("query: bm25 / faiss / rrf")
+    fetch = max(30, topk * 5)
+    lat = _time_calls(lambda t: state.bm25.topk(t, topk=fetch), q_tokens, warm)
+    stages["bm25_search"] = _stage(lat, len(queries))
+    lat = _time_calls(lambda v: state.index.search(v, fetch), qvecs, warm)
+    stages["index_search"] = _stage(lat, len(queries))
+
+    fuse_args = []
+    for t, v in zip(q_tokens, qvecs):
+        _, vid = state.index.search(v, fetch)
+        docs, _ = state.bm25.topk(t, topk=fetch)
+        fuse_args.append([vid[0], docs])
+    lat = _time_calls(rrf_fuse, fuse_args, warm)
+    stages["rrf_fuse"] = _stage(lat, len(queries))
+
+    log("query: end-to-end")
+    lat = _time_calls(lambda q: search_kb(q, embedder, state, topk=topk), queries, warm)
+    stages["search_kb"] = _stage(lat, len(queries))
+    cold = queries[:COLD_REPEATS]
+    lat = _time_calls(lambda q: retrieve(q, embedder, paths, topk=topk), cold)
+    stages["retrieve_cold"] = _stage(lat, len(cold))
+
+    return SizeRun(
+        size=size, num_chunks=len(chunks), num_files=num_files, stages=stages
+    )
+
+
+def _environment() -> Dict[str, Any]:
+    import faiss
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "faiss": getattr(faiss, "__version__", "unknown"),
+    }
+
+
+def run_bench(
+    sizes: List[int],
+    embedder: Any,
+    num_queries: int = 200,
+    seed: int = 0,
+    index_type: str = "flat",
+    work_dir: Optional[Path] = None,
+    keep: bool = False,
+    log: Callable[[str], None] = lambda msg: None,
+) -> Dict[str, Any]:
+    base = work_dir or Path(tempfile.mkdtemp(prefix="myspec-bench-"))
+    runs: List[SizeRun] = []
+    try:
+        for size in sizes:
+            d = base / f"size-{size}"
+            if d.exists():
+                shutil.rmtree(d)
+            runs.append(
+                run_size(
+                    size,
+                    d,
+                    embedder,
+                    num_queries=num_queries,
+                    seed=seed,
+                    index_type=index_type,
+                    log=lambda msg, s=size: log(f"[{s}] {msg}"),
+                )
+            )
+    finally:
+        if not keep:
+            shutil.rmtree(base, ignore_errors=True)
+    return {
+        "version": RESULTS_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": _environment(),
+        "config": {
+            "embedder": embedder.model_name,
+            "index_type": index_type,
+            "queries": num_queries,
+            "seed": seed,
+        },
+        "runs": [asdict(r) for r in runs],
+    }
+
+
+def save_results(results: Dict[str, Any], path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+def load_results(path: Path) -> Dict[str, Any]:
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+# ---------- 对比 ----------
+
+
+@dataclass
+class Regression:
+    size: int
+    stage: str
+    metric: str
+    baseline: float
+    current: float
+
+    @property
+    def ratio(self) -> float:
+        return self.current / self.baseline if self.baseline else float("inf")
+
+
+# 按 (规模, 阶段) 对齐两次结果，p50 变慢超过 threshold（且绝对差超过噪声下限）视为回归
+def compare_results(
+    baseline: Dict[str, Any],
+    current: Dict[str, Any],
+    threshold: float = 0.2,
+    min_delta_ms: float = 0.05,
+    metric: str = "p50_ms",
+) -> List[Regression]:
+    base_runs = {r["size"]: r for r in baseline.get("runs", [])}
+    out: List[Regression] = []
+    for run in current.get("runs", []):
+        old = base_runs.get(run["size"])
+        if old is None:
+            continue
+        for name, st in run["stages"].items():
+            prev = old["stages"].get(name)
+            if prev is None:
+                continue
+            b, c = float(prev[metric]), float(st[metric])
+            if c > b * (1 + threshold) and c - b > min_delta_ms:
+                out.append(Regression(run["size"], name, metric, b, c))
+    return out
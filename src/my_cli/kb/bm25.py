@@ -1,12 +1,15 @@
 from __future__ import annotations
 import json
+import math
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
-from rank_bm25 import BM25Okapi
+import numpy as np
 
 from .chunker import Chunk
-from .tokenizer import tokenize
+from .tokenizer import tokenize, tokenize_query
+from .timing import span, file_bytes
 
 #  BM25 关键词检索
 
@@ -51,7 +54,10 @@ def load_bm25_corpus(path: Path) -> Tuple[List[List[str]], List[str], List[str]]
     if not path.exists():
         return corpus, chunk_ids, namespaces
 
-    with path.open("r", encoding="utf-8") as f:
+    with (
+        span("load_bm25_corpus", bytes=file_bytes(path)),
+        path.open("r", encoding="utf-8") as f,
+    ):
         for line in f:
             obj = json.loads(line)
             corpus.append(obj.get("tokens", []))
@@ -60,7 +66,244 @@ def load_bm25_corpus(path: Path) -> Tuple[List[List[str]], List[str], List[str]]
     return corpus, chunk_ids, namespaces
 
 
-# 对查询词分词 → 使用 BM25Okapi 计算得分，返回 topk 个最相关的文档索引和分数
+# Okapi BM25 参数，与 rank_bm25.BM25Okapi 的默认值保持一致，保证得分不变
+K1 = 1.5
+B = 0.75
+EPSILON = 0.25
+# 查询词 postings 总长 × 该值达到文档数时，打分改用稠密数组（见 Bm25Index.score_sparse）
+_DENSE_RATIO = 8
+
+# 词表序列化时的分隔符（分词结果已 strip，不会包含它）
+_VOCAB_SEP = "\x00"
+
+
+# 倒排索引：term -> postings[(doc_index, tf)]，IDF / 文档长度在构建时算好
+# 查询时只遍历查询词的 postings，复杂度 O(postings) 而不是 O(corpus)
+@dataclass
+class Bm25Index:
+    vocab: Dict[str, int]  # term -> term 下标
+    offsets: (
+        np.ndarray
+    )  # (V+1,) int64，term i 的 postings 位于 [offsets[i], offsets[i+1])
+    post_docs: np.ndarray  # (P,) int32 文档下标（即 chunks 下标）
+    post_tf: np.ndarray  # (P,) int32 词频
+    idf: np.ndarray  # (V,) float64
+    doc_len: np.ndarray  # (N,) int64
+    avgdl: float
+
+    @property
+    def num_docs(self) -> int:
+        return int(self.doc_len.shape[0])
+
+    # 返回 (命中文档下标, 得分)，只包含至少命中一个查询词的文档
+    # rows 为升序行号时只对其中的文档计分（命名空间过滤），IDF / avgdl 仍按全库统计
+    # 开销只与查询词的 postings 总长有关：postings 少时稀疏累加（排序分组），
+    # postings 达到库大小的 1/_DENSE_RATIO 时改用 N 大小的稠密数组（此时 O(N) 不超过 O(postings)，
+    # 而且比排序快）。两种方式每个文档都按查询词顺序累加，得分完全一致
+    def score_sparse(
+        self, q_tokens: List[str], rows: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # 与 BM25Okapi.get_scores 一致：重复的查询词重复累加
+        terms = [self.vocab[q] for q in q_tokens if q in self.vocab]
+        if not terms:
+            return np.empty(0, dtype="int64"), np.empty(0, dtype="float64")
+        total = int(sum(self.offsets[t + 1] - self.offsets[t] for t in terms))
+        dense = total * _DENSE_RATIO >= self.num_docs
+
+        mask = None
+        if rows is not None and dense:
+            mask = np.zeros(self.num_docs, dtype=bool)
+            mask[rows] = True
+        docs_parts: List[np.ndarray] = []
+        contrib_parts: List[np.ndarray] = []
+        for t in terms:
+            lo, hi = self.offsets[t], self.offsets[t + 1]
+            docs = self.post_docs[lo:hi]
+            tf = self.post_tf[lo:hi]
+            if rows is not None:
+                keep = mask[docs] if mask is not None else _in_sorted(rows, docs)
+                docs, tf = docs[keep], tf[keep]
+            denom = tf + K1 * (1 - B + B * self.doc_len[docs] / self.avgdl)
+            docs_parts.append(docs)
+            contrib_parts.append(self.idf[t] * (tf * (K1 + 1) / denom))
+
+        if dense:
+            # 同一个词的 postings 里文档不重复，可以直接按下标 +=
+            scores = np.zeros(self.num_docs, dtype="float64")
+            hit = np.zeros(self.num_docs, dtype=bool)
+            for docs, contrib in zip(docs_parts, contrib_parts):
+                scores[docs] += contrib
+                hit[docs] = True
+            cand = np.flatnonzero(hit)
+            return cand, scores[cand]
+        # 按查询词顺序拼接后分组求和
+        cand, inv = np.unique(np.concatenate(docs_parts), return_inverse=True)
+        scores = np.bincount(
+            inv.ravel(), weights=np.concatenate(contrib_parts), minlength=cand.shape[0]
+        )
+        return cand.astype("int64"), scores
+
+    # 返回 topk 的 (文档下标, 得分) 两个数组，按得分降序
+    # rows: 只在这些行（升序）里检索，None 为全库
+    def topk(
+        self, q_tokens: List[str], topk: int = 20, rows: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        if not q_tokens or topk <= 0 or not self.num_docs:
+            return np.empty(0, dtype="int64"), np.empty(0, dtype="float64")
+        with span("bm25_score", terms=len(q_tokens)) as s:
+            cand, scores = self.score_sparse(q_tokens, rows)
+            s.set(candidates=int(cand.shape[0]))
+            return _select_topk(cand, scores, self.num_docs, topk, rows)
+
+    def search(
+        self, q_tokens: List[str], topk: int = 20, rows: Optional[np.ndarray] = None
+    ) -> List[Tuple[int, float]]:
+        docs, scores = self.topk(q_tokens, topk=topk, rows=rows)
+        return list(zip(docs.tolist(), scores.tolist()))
+
+
+# values 中的每个元素是否在升序数组 sorted_arr 里
+def _in_sorted(sorted_arr: np.ndarray, values: np.ndarray) -> np.ndarray:
+    if not sorted_arr.shape[0]:
+        return np.zeros(values.shape[0], dtype=bool)
+    pos = np.searchsorted(sorted_arr, values)
+    pos[pos == sorted_arr.shape[0]] = 0
+    return sorted_arr[pos] == values
+
+
+def _top_sorted(
+    docs: np.ndarray, scores: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    # 按 (得分降序, 下标升序) 取前 k，先用 argpartition 缩小范围再精确排序
+    if docs.shape[0] > k:
+        kth = scores[np.argpartition(scores, docs.shape[0] - k)[docs.shape[0] - k]]
+        keep = scores >= kth
+        docs, scores = docs[keep], scores[keep]
+    order = np.lexsort((docs, -scores))[:k]
+    return docs[order], scores[order]
+
+
+# 复现 "对全部 N 个得分做稳定降序排序再取前 k" 的结果，但只处理候选文档：
+# 正分候选 → 0 分文档(未命中，按下标顺序补齐) → 负分候选
+def _select_topk(
+    cand: np.ndarray,
+    scores: np.ndarray,
+    num_docs: int,
+    topk: int,
+    rows: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    pos = scores > 0
+    docs, sc = _top_sorted(cand[pos], scores[pos], topk)
+    parts_docs, parts_sc = [docs], [sc]
+    need = topk - docs.shape[0]
+    if need > 0:
+        # 0 分文档：按下标顺序取前 need 个不在非零候选里的；
+        # 非零候选只有 nnz 个，在前 need + nnz 个下标里一定能凑够
+        nonzero = cand[scores != 0]
+        n = need + nonzero.shape[0]
+        if rows is not None:
+            head = rows[:n]
+        else:
+            head = np.arange(min(n, num_docs), dtype="int64")
+        zeros = head[~np.isin(head, nonzero)][:need]
+        parts_docs.append(zeros.astype("int64"))
+        parts_sc.append(np.zeros(zeros.shape[0], dtype="float64"))
+        need -= zeros.shape[0]
+    if need > 0:
+        neg = scores < 0
+        docs, sc = _top_sorted(cand[neg], scores[neg], need)
+        parts_docs.append(docs)
+        parts_sc.append(sc)
+    return (
+        np.concatenate(parts_docs).astype("int64"),
+        np.concatenate(parts_sc).astype("float64"),
+    )
+
+
+# 由分词后的语料构建倒排索引
+# term 的编号按首次出现顺序分配，IDF 的累加顺序与 BM25Okapi 相同（平均 IDF 逐位一致）
+# corpus_tokens 可以是生成器（构建时从刚写好的 chunk 存储逐条读取，不必整体放进内存）
+def build_bm25_index(corpus_tokens: Iterable[List[str]]) -> Bm25Index:
+    vocab: Dict[str, int] = {}
+    postings: List[List[Tuple[int, int]]] = []
+    lengths: List[int] = []
+
+    for d, tokens in enumerate(corpus_tokens):
+        lengths.append(len(tokens))
+        freqs: Dict[str, int] = {}
+        for tok in tokens:
+            freqs[tok] = freqs.get(tok, 0) + 1
+        for tok, tf in freqs.items():
+            t = vocab.get(tok)
+            if t is None:
+                t = vocab[tok] = len(postings)
+                postings.append([])
+            postings[t].append((d, tf))
+
+    n = len(lengths)
+    doc_len = np.asarray(lengths, dtype="int64")
+    idf = np.zeros(len(postings), dtype="float64")
+    idf_sum = 0.0
+    negative: List[int] = []
+    for t, plist in enumerate(postings):
+        v = math.log(n - len(plist) + 0.5) - math.log(len(plist) + 0.5)
+        idf[t] = v
+        idf_sum += v
+        if v < 0:
+            negative.append(t)
+    if postings:
+        # 负 IDF 用 epsilon * 平均 IDF 代替（BM25Okapi 的做法）
+        idf[negative] = EPSILON * (idf_sum / len(postings))
+
+    offsets = np.zeros(len(postings) + 1, dtype="int64")
+    offsets[1:] = np.cumsum([len(p) for p in postings])
+    flat = [pair for plist in postings for pair in plist]
+    post = np.asarray(flat, dtype="int32").reshape(-1, 2)
+
+    return Bm25Index(
+        vocab=vocab,
+        offsets=offsets,
+        post_docs=post[:, 0].copy(),
+        post_tf=post[:, 1].copy(),
+        idf=idf,
+        doc_len=doc_len,
+        avgdl=float(doc_len.sum()) / n if n else 0.0,
+    )
+
+
+def save_bm25_index(index: Bm25Index, out_path: Path) -> None:
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    terms = sorted(index.vocab, key=index.vocab.__getitem__)
+    vocab_blob = np.frombuffer(_VOCAB_SEP.join(terms).encode("utf-8"), dtype="uint8")
+    with out_path.open("wb") as f:
+        np.savez(
+            f,
+            vocab=vocab_blob,
+            offsets=index.offsets,
+            post_docs=index.post_docs,
+            post_tf=index.post_tf,
+            idf=index.idf,
+            doc_len=index.doc_len,
+            avgdl=np.float64(index.avgdl),
+        )
+
+
+def load_bm25_index(path: Path) -> Bm25Index:
+    with span("load_bm25_index", bytes=file_bytes(path)), np.load(path) as z:
+        blob = z["vocab"].tobytes().decode("utf-8")
+        terms = blob.split(_VOCAB_SEP) if blob else []
+        return Bm25Index(
+            vocab={t: i for i, t in enumerate(terms)},
+            offsets=z["offsets"],
+            post_docs=z["post_docs"],
+            post_tf=z["post_tf"],
+            idf=z["idf"],
+            doc_len=z["doc_len"],
+            avgdl=float(z["avgdl"]),
+        )
+
+
+# 对查询词分词 → 在倒排索引上计算 BM25 得分，返回 topk 个最相关的文档索引和分数
 def bm25_search(
     query: str,
     corpus_tokens: List[List[str]],
@@ -69,13 +312,7 @@ def bm25_search(
     """
     返回: [(chunk_index, score), ...] 其中 chunk_index 对应 chunks 的下标
     """
-    q_tokens = tokenize(query)
+    q_tokens = tokenize_query(query)
     if not q_tokens:
         return []
-
-    bm25 = BM25Okapi(corpus_tokens)
-    scores = bm25.get_scores(q_tokens)
-
-    scored = list(enumerate(scores))
-    scored.sort(key=lambda x: x[1], reverse=True)
-    return [(idx, float(score)) for idx, score in scored[:topk]]
+    return build_bm25_index(corpus_tokens).search(q_tokens, topk=topk)
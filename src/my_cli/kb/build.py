@@ -0,0 +1,422 @@
+from __future__ import annotations
+import time
+import uuid
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .paths import KBPaths, ensure_dirs
+from .defaults import (
+    CHUNK_OVERLAP,
+    CHUNK_TOKENS,
+    EMBED_BATCH,
+    PARITY_SAMPLES,
+    RECALL_K,
+)
+from .chunker import (
+    CHUNKER_VERSION,
+    Chunk,
+    iter_tokenized_file_chunks,
+    _infer_namespace,
+)
+from .embedder import Embedder
+from .index import (
+    save_chunks_jsonl,
+    load_chunks_jsonl,
+    build_faiss_index,
+    choose_index_params,
+    recall_at_k,
+    supports_remove,
+    update_faiss_index,
+    is_id_mapped,
+    save_index,
+    load_index,
+    save_index_meta,
+    load_index_meta,
+    flat_vectors_in_order,
+    save_vectors_npy,
+)
+from .bm25 import (
+    save_bm25_corpus,
+    load_bm25_corpus,
+    build_bm25_index,
+    save_bm25_index,
+)
+from .tokenizer import TOKENIZER_VERSION, configure_tokenizer, tokenize
+from .query_cache import clear_query_cache
+from .store import ChunkStore, StoreWriter, store_exists
+from .snapshot import discard, gc_snapshots, new_snapshot, pin, publish
+from .manifest import (
+    BuildManifest,
+    FileEntry,
+    ManifestDiff,
+    scan_raw_files,
+    stat_raw_files,
+    recorded_stat,
+    refresh_stats,
+    diff_manifest,
+    load_manifest,
+    save_manifest,
+)
+
+# 构建流程：raw 文档 → 切块（进程池）→ 分批向量化 → FAISS / BM25 / chunks 落盘
+# 默认增量构建：借助 build manifest 只处理新增/修改的文件，删除文件对应的向量按 ID 从索引中移除
+# full=True 时忽略旧清单，全量重建
+#
+# 上一次构建的结果从当前快照读取，新结果全部写进新的快照目录，最后原子地发布（见 snapshot.py）：
+# 构建过程中和失败时，检索始终看到完整的旧索引
+
+
+@dataclass
+class BuildResult:
+    # mode: "full" | "incremental" | "noop"(没有任何变化)
+    mode: str
+    num_chunks: int
+    # 本次实际向量化的 chunk 数
+    embedded: int = 0
+    # 从索引中删除的向量数
+    removed: int = 0
+    diff: ManifestDiff = field(default_factory=ManifestDiff)
+    index_type: str = "flat"
+    # 发布的快照目录（noop 时为 None）
+    snapshot: Optional[Path] = None
+    # 全量构建近似索引时，相对 flat 精确检索的 recall@RECALL_K
+    recall: Optional[float] = None
+    # 量化后端：抽样 chunk 与参考实现（torch fp32）向量的最小余弦相似度
+    parity: Optional[float] = None
+
+
+def _dedupe(
+    chunks: List[Chunk], tokens: List[List[str]]
+) -> Tuple[List[Chunk], List[List[str]]]:
+    # 同一文件内标题和开头都相同的片段会得到相同 chunk_id，只保留第一个
+    seen = set()
+    out: List[Chunk] = []
+    out_tokens: List[List[str]] = []
+    for c, t in zip(chunks, tokens):
+        if c.chunk_id in seen:
+            continue
+        seen.add(c.chunk_id)
+        out.append(c)
+        out_tokens.append(t)
+    return out, out_tokens
+
+
+# 打开上一次构建的 chunk 存储（旧版知识库读 JSONL），返回存储和 chunk_id -> 行号
+# 未变化文件的 chunk 与分词结果按行号从这里按需读取
+def _open_previous(paths: KBPaths) -> Tuple[ChunkStore, Dict[str, int]]:
+    if store_exists(paths.kb_store):
+        store = ChunkStore.open(paths.kb_store)
+    else:
+        chunks = load_chunks_jsonl(paths.chunks_jsonl)
+        corpus, cids, _ = load_bm25_corpus(paths.bm25_corpus_jsonl)
+        aligned = corpus if cids == [c.chunk_id for c in chunks] else None
+        store = ChunkStore.from_chunks(chunks, aligned)
+    rows: Dict[str, int] = {}
+    for i in range(len(store)):
+        rows.setdefault(store.chunk_id(i), i)
+    return store, rows
+
+
+# 把按批向量化的结果写入 FAISS 索引
+#   增量构建、全量 flat / hnsw：每批直接追加到索引，不保留向量
+#   全量 IVF：需要先用全部向量训练聚类中心，只能先缓存，最后一次性建索引
+class _IndexFeeder:
+    def __init__(self, index: Any, index_type: str, params: Dict[str, Any]) -> None:
+        self.index = index
+        self.index_type = index_type
+        self.params = params
+        self.full = index is None
+        self._vectors: List[np.ndarray] = []
+        self._ids: List[str] = []
+
+    def add(self, vectors: np.ndarray, chunk_ids: List[str]) -> None:
+        if self.index is not None:
+            update_faiss_index(self.index, [], vectors, chunk_ids)
+        elif self.index_type.startswith("ivf"):
+            self._vectors.append(vectors)
+            self._ids.extend(chunk_ids)
+        else:
+            # flat / hnsw 的参数与数据规模无关
+            self.params = choose_index_params(self.index_type, 0, vectors.shape[1])
+            self.index = build_faiss_index(vectors, chunk_ids, self.params)
+
+    # 返回近似索引相对精确检索的 recall（只在全量构建时评估）
+    def finish(self, all_ids: List[str]) -> Optional[float]:
+        if not self.full or self.index_type == "flat":
+            return None
+        if self._vectors:
+            vectors = np.concatenate(self._vectors)
+            self.params = choose_index_params(
+                self.index_type, vectors.shape[0], vectors.shape[1]
+            )
+            self.index = build_faiss_index(vectors, self._ids, self.params)
+            return recall_at_k(self.index, vectors, self._ids, k=RECALL_K)
+        # hnsw：向量从索引中取回
+        vectors = flat_vectors_in_order(self.index, all_ids)
+        return recall_at_k(self.index, vectors, all_ids, k=RECALL_K)
+
+
+# 把二进制存储导出为 chunks.jsonl / bm25_corpus.jsonl（调试、外部工具使用）
+def export_jsonl(paths: KBPaths) -> int:
+    store = ChunkStore.open(paths.kb_store)
+    chunks = list(store)
+    save_chunks_jsonl(chunks, paths.chunks_jsonl)
+    save_bm25_corpus(store.corpus_tokens(), chunks, paths.bm25_corpus_jsonl)
+    return len(chunks)
+
+
+def build_kb(
+    paths: KBPaths,
+    model: str,
+    full: bool = False,
+    embedder: Optional[Embedder] = None,
+    jsonl: bool = False,
+    index_type: Optional[str] = None,
+    workers: Optional[int] = None,
+    batch_size: int = EMBED_BATCH,
+    chunk_tokens: Optional[int] = None,
+    chunk_overlap: Optional[int] = None,
+) -> BuildResult:
+    ensure_dirs(paths)
+    configure_tokenizer(paths.jieba_cache)
+    # 上一次发布的快照（旧版布局时是知识库目录本身）
+    current = pin(replace(paths, snapshot_dir=None))
+    files = scan_raw_files(paths.kb_raw)
+    # 与清单 (mtime, size) 一致的文件不用重新计算哈希
+    scanned_at = time.time()
+    stats = stat_raw_files(paths.kb_raw)
+    # 清单里记录的是向量的身份（含量化方式）：切换到 int8 时旧向量不能复用，需要全量重建
+    model_id = embedder.model_id if embedder is not None else model
+
+    # 未指定索引类型时沿用上一次构建的类型
+    old_meta = load_index_meta(current.index_meta)
+    old_type = old_meta.get("index_type", "flat")
+    index_type = index_type or old_type
+    params: Dict[str, Any] = old_meta.get("index_params", {"index_type": old_type})
+    # 切块参数同样沿用上一次构建；规则或参数变了，旧的 chunk 边界和 ID 都不能复用
+    old_chunking = old_meta.get("chunking", {})
+    chunking = {
+        "version": CHUNKER_VERSION,
+        "max_tokens": chunk_tokens or old_chunking.get("max_tokens", CHUNK_TOKENS),
+        "overlap_tokens": (
+            chunk_overlap
+            if chunk_overlap is not None
+            else old_chunking.get("overlap_tokens", CHUNK_OVERLAP)
+        ),
+    }
+
+    manifest = BuildManifest() if full else load_manifest(current.manifest_json)
+    index = None
+    if (
+        manifest.files
+        and manifest.model == model_id
+        and old_type == index_type
+        # 分词规则变了，旧 chunk 的分词结果不能复用
+        and old_meta.get("tokenizer") == TOKENIZER_VERSION
+        and old_chunking == chunking
+        and current.index_faiss.exists()
+        and (store_exists(current.kb_store) or current.chunks_jsonl.exists())
+    ):
+        index = load_index(current.index_faiss)
+        # 旧版按行号寻址的索引无法按 ID 删除，只能全量重建
+        if not is_id_mapped(index):
+            index = None
+    if index is None:
+        manifest = BuildManifest(model=model_id)
+
+    diff, hashes = diff_manifest(manifest, files, stats)
+    if index is not None and not diff.dirty:
+        if "build_id" not in old_meta:
+            # 旧版知识库补上版本号，检索结果缓存才能生效
+            save_index_meta(
+                {**old_meta, "build_id": uuid.uuid4().hex}, current.index_meta
+            )
+        # 上次构建时处在 racy 窗口内的文件现在可以记下 stat，之后的检查不用再算哈希
+        if refresh_stats(manifest, diff.unchanged, stats, scanned_at):
+            save_manifest(manifest, current.manifest_json)
+        total = sum(len(e.chunk_ids) for e in manifest.files.values())
+        return BuildResult(mode="noop", num_chunks=total, diff=diff)
+    if index is not None and not supports_remove(index_type):
+        if diff.changed or diff.removed:
+            # HNSW 不支持删除向量：有修改/删除时全量重建（embedding 缓存让重建几乎不需要推理）
+            index = None
+            manifest = BuildManifest(model=model_id)
+            diff = ManifestDiff(added=list(files))
+
+    prev: Optional[ChunkStore] = None
+    prev_rows: Dict[str, int] = {}
+    if index is not None:
+        prev, prev_rows = _open_previous(current)
+
+    unchanged = set(diff.unchanged)
+    stale_ids = [
+        cid
+        for rel in diff.changed + diff.removed
+        for cid in manifest.files[rel].chunk_ids
+    ]
+    removed = 0
+    if index is not None:
+        removed = update_faiss_index(index, stale_ids, None, [])
+    feeder = _IndexFeeder(index, index_type, params)
+
+    # 流水线：进程池切块 → 按 batch_size 分批向量化并写入索引，同时 chunk 流式写入存储
+    # 内存占用取决于批大小，而不是整个知识库的正文
+    todo = [
+        (rel, p, _infer_namespace(paths.kb_raw, p))
+        for rel, p in files.items()
+        if rel not in unchanged or rel not in manifest.files
+    ]
+    chunk_stream = iter_tokenized_file_chunks(
+        todo,
+        workers=workers,
+        dict_cache=paths.jieba_cache,
+        max_tokens=chunking["max_tokens"],
+        overlap_tokens=chunking["overlap_tokens"],
+    )
+
+    # 新快照在发布前对检索不可见
+    build_id = uuid.uuid4().hex
+    snap = new_snapshot(paths, build_id)
+    new_manifest = BuildManifest(model=model_id)
+    writer = StoreWriter(snap.kb_store)
+    row_ids: List[str] = []
+    pending: List[Chunk] = []
+    embedded = 0
+    # 一致性检查用的样本（只在量化后端时收集）
+    sample_texts: List[str] = []
+    sample_vectors: List[np.ndarray] = []
+
+    def flush() -> None:
+        nonlocal embedder, embedded
+        if not pending:
+            return
+        # 只有存在新 chunk 时才加载模型（纯删除不需要推理）
+        embedder = embedder or Embedder(
+            model_name=model, cache_dir=paths.embed_cache_dir
+        )
+        texts = [f"passage: {c.content}" for c in pending]
+        vectors = embedder.encode(texts)
+        feeder.add(vectors, [c.chunk_id for c in pending])
+        room = PARITY_SAMPLES - len(sample_texts)
+        if embedder.quantize and room > 0:
+            sample_texts.extend(texts[:room])
+            sample_vectors.append(vectors[:room])
+        embedded += len(pending)
+        pending.clear()
+
+    try:
+        for rel in files:
+            entry = manifest.files.get(rel)
+            if rel in unchanged and entry is not None:
+                file_ids = []
+                for cid in entry.chunk_ids:
+                    row = prev_rows.get(cid)
+                    if row is None:
+                        continue
+                    c = prev.get(row)
+                    # 旧版 JSONL 知识库可能没有对齐的分词结果
+                    tokens = (
+                        prev.tokens(row) if prev.has_tokens else tokenize(c.content)
+                    )
+                    writer.add(c, tokens)
+                    file_ids.append(cid)
+            else:
+                # 新切出的 chunk 即使 ID 与旧的相同，内容也可能变了，用工作进程里的新分词结果
+                _, (file_chunks, file_tokens) = next(chunk_stream)
+                file_chunks, file_tokens = _dedupe(file_chunks, file_tokens)
+                for c, tokens in zip(file_chunks, file_tokens):
+                    writer.add(c, tokens)
+                    pending.append(c)
+                    if len(pending) >= batch_size:
+                        flush()
+                file_ids = [c.chunk_id for c in file_chunks]
+            mtime_ns, size = recorded_stat(stats.get(rel, (0, -1)), scanned_at)
+            new_manifest.files[rel] = FileEntry(
+                sha1=hashes[rel], chunk_ids=file_ids, mtime_ns=mtime_ns, size=size
+            )
+            row_ids.extend(file_ids)
+        flush()
+    except BaseException:
+        writer.abort()
+        discard(snap)
+        raise
+    prev = None
+
+    # 从没构建过、也没有文档时什么都不发布；已有索引而文档全部删除时发布空快照，
+    # 否则旧快照里已删除的文档会一直被检索到，清单也一直显示有变化
+    built = store_exists(current.kb_store) or current.chunks_jsonl.exists()
+    if not row_ids and not files and not built:
+        writer.abort()
+        discard(snap)
+        return BuildResult(
+            mode="full" if feeder.full else "incremental", num_chunks=0, diff=diff
+        )
+
+    try:
+        recall = None
+        mode = "full" if feeder.full else "incremental"
+        if row_ids:
+            recall = feeder.finish(row_ids)
+            index, params = feeder.index, feeder.params
+            save_index(index, snap.index_faiss)
+            if index_type == "flat":
+                # 与 store 行顺序对齐的向量矩阵，检索时 np.load(mmap_mode="r") 直接使用
+                save_vectors_npy(
+                    flat_vectors_in_order(index, row_ids), snap.vectors_npy
+                )
+
+        # 保存索引元信息（含推理后端，检索时用同样的配置编码查询）
+        meta = {
+            "model": model,
+            **(embedder.meta() if embedder is not None else {}),
+            "num_chunks": len(row_ids),
+            "kb_raw": str(paths.kb_raw.as_posix()),
+            "index_type": index_type,
+            "index_params": params,
+            "tokenizer": TOKENIZER_VERSION,
+            "chunking": chunking,
+            # 每次构建一个新的版本号，检索结果缓存按它失效
+            "build_id": build_id,
+        }
+        save_index_meta(meta, snap.index_meta)
+
+        writer.close()
+        if row_ids:
+            # BM25 倒排索引从刚写好的存储逐条读取分词结果构建
+            store = ChunkStore.open(snap.kb_store)
+            tokens = (store.tokens(i) for i in range(len(store)))
+            save_bm25_index(build_bm25_index(tokens), snap.bm25_index)
+        if jsonl:
+            export_jsonl(snap)
+        save_manifest(new_manifest, snap.manifest_json)
+    except BaseException:
+        discard(snap)
+        raise
+
+    # 所有文件写完后切换 CURRENT：检索要么看到完整的旧快照，要么看到完整的新快照
+    try:
+        publish(paths, snap)
+    except BaseException:
+        discard(snap)
+        raise
+    clear_query_cache(paths)
+    gc_snapshots(paths)
+
+    parity = None
+    if sample_texts:
+        parity = embedder.parity(sample_texts, np.concatenate(sample_vectors))
+
+    return BuildResult(
+        mode=mode,
+        num_chunks=len(row_ids),
+        embedded=embedded,
+        removed=removed,
+        diff=diff,
+        index_type=index_type,
+        recall=recall,
+        parity=parity,
+        snapshot=snap.snapshot_dir,
+    )
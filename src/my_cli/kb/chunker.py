@@ -1,9 +1,26 @@
 from __future__ import annotations
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 import hashlib  # 生成稳定的 chunk_id
+import itertools
+import os
 import re  # 解析 Markdown 标题
-from typing import Iterable, List, Tuple
+from typing import (
+    Callable,
+    Deque,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from .backends import is_wide_char
+from .defaults import CHUNK_OVERLAP, CHUNK_TOKENS
+from .tokenizer import configure_tokenizer, tokenize
 
 # 这个模块用于 将 Markdown 文档分块（chunking），是 RAG（检索增强生成）系统的核心组件
 # 使用场景
@@ -28,8 +45,18 @@ class Chunk:
     namespace: str
 
 
+K = TypeVar("K")
+R = TypeVar("R")
+
+# 切块规则的版本：修改切分逻辑或 chunk_id 的算法时递增，kb build 据此全量重建
+CHUNKER_VERSION = 2
+
 # 匹配 Markdown 标题（# ~ ######）
-_HEADING_RE = re.compile(r"^(#{1,6})\s+(.+)$", re.MULTILINE)
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.+)$")
+# 代码块围栏（``` 或 ~~~，最多缩进 3 个空格）
+_FENCE_RE = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+# 句子：以中文句末标点结尾，或以后面跟空白/行尾的英文句末标点结尾；末尾不完整的句子单独成段
+_SENTENCE_RE = re.compile(r".+?(?:[。！？；]+|[.!?;]+(?=\s|$))\s*|.+$")
 
 
 def _hash_id(text: str) -> str:
@@ -49,89 +76,346 @@ def _infer_namespace(raw_root: Path, file_path: Path) -> str:
     return "default"
 
 
-# 将单个 Markdown 文件按标题分块
-def chunk_markdown_file(
-    path: Path, namespace: str, max_chars: int = 1200
-) -> List[Chunk]:
-    raw = path.read_text(encoding="utf-8", errors="ignore").strip()
-    if not raw:
-        return []
-
-    matches = list(_HEADING_RE.finditer(raw))
-    chunks: List[Chunk] = []
-
-    # 如果没有任何标题：整个文档当成一个 section
-    if not matches:
-        heading_path = "Document"
-        body = raw
-        parts = (
-            [body]
-            if len(body) <= max_chars
-            else [body[i : i + max_chars] for i in range(0, len(body), max_chars)]
-        )
-        for part in parts:
-            base = f"{path.as_posix()}::{heading_path}::{part[:200]}"
-            cid = _hash_id(base)
-            chunks.append(
-                Chunk(
-                    chunk_id=cid,
-                    source_path=str(path.as_posix()),
-                    heading=heading_path,
-                    content=part.strip(),
-                    namespace=namespace,
-                )
-            )
-        return chunks
+# 文本的"宽度"：中日韩字符记 4，其他字符记 1，宽度 // 4 就是 backends.estimate_tokens
+# 的估算（不含特殊 token）。宽度可以直接相加，拼接后的 token 数不会因逐段取整而低估
+def _width(text: str) -> int:
+    wide = sum(1 for ch in text if is_wide_char(ch))
+    return len(text) + 3 * wide
+
+
+# 切块的最小单位：一段文本和它与前一个单位拼接时用的分隔符
+#   段落 / 列表 / 表格 / 代码块之间用空行，同一块拆开的行之间用换行，句子之间直接拼接
+@dataclass
+class _Unit:
+    text: str
+    width: int
+    sep: str
+    code: bool = False
+
+
+# 超长的一行（没有可用的句子边界）按 token 预算硬切，尽量切在空白处
+def _split_long(text: str, limit: int) -> List[str]:
+    parts: List[str] = []
+    start = 0
+    width = 0
+    last_space = -1
+    for i, ch in enumerate(text):
+        width += 4 if is_wide_char(ch) else 1
+        if width // 4 > limit and i > start:
+            cut = last_space + 1 if last_space >= start else i
+            parts.append(text[start:cut])
+            start = cut
+            width = _width(text[start : i + 1])
+            last_space = -1
+        if ch.isspace():
+            last_space = i
+    if start < len(text):
+        parts.append(text[start:])
+    return parts
+
+
+# 一行文本 → 不超过 limit 的片段：整行 → 句子 → 硬切
+def _split_line(line: str, limit: int) -> List[str]:
+    if _width(line) // 4 <= limit:
+        return [line]
+    pieces: List[str] = []
+    for sentence in _SENTENCE_RE.findall(line):
+        if _width(sentence) // 4 <= limit:
+            pieces.append(sentence)
+        else:
+            pieces.extend(_split_long(sentence, limit))
+    return pieces
+
 
-    # 维护标题层次栈：遇到新标题就按 level 出栈/入栈
+# 一个结构块 → 切块单位；超过预算的块按行、句子逐级拆开
+def _block_units(lines: List[str], code: bool, limit: int) -> List[_Unit]:
+    text = "\n".join(lines)
+    width = _width(text)
+    if width // 4 <= limit:
+        return [_Unit(text, width, "\n\n", code)]
+    if code:
+        return _code_units(lines, limit)
+    units: List[_Unit] = []
+    for i, line in enumerate(lines):
+        for j, piece in enumerate(_split_line(line, limit)):
+            sep = ("\n\n" if i == 0 else "\n") if j == 0 else ""
+            units.append(_Unit(piece, _width(piece), sep))
+    return units
+
+
+# 超长代码块按行分组，每组重新包上围栏，保证每个 chunk 里的代码块都是完整的 Markdown
+def _code_units(lines: List[str], limit: int) -> List[_Unit]:
+    opener = lines[0]
+    m = _FENCE_RE.match(opener)
+    closer = m.group(1) if m else "```"
+    body = lines[1:]
+    if body and _FENCE_RE.match(body[-1]):
+        body = body[:-1]
+    # 围栏两行和换行占用的宽度
+    room = max(limit * 4 - _width(opener) - _width(closer) - 2, 4)
+    groups: List[List[str]] = []
+    cur: List[str] = []
+    cur_width = 0
+    for line in body:
+        for piece in _split_line(line, room // 4):
+            w = _width(piece) + 1
+            if cur and cur_width + w > room:
+                groups.append(cur)
+                cur, cur_width = [], 0
+            cur.append(piece)
+            cur_width += w
+    if cur:
+        groups.append(cur)
+    units = []
+    for g in groups:
+        text = "\n".join([opener, *g, closer])
+        units.append(_Unit(text, _width(text), "\n\n", True))
+    return units
+
+
+def _join(units: List[_Unit]) -> str:
+    return "".join((u.sep if i else "") + u.text for i, u in enumerate(units)).strip()
+
+
+# 拼接后的总宽度（第一个单位的分隔符不计入）
+def _joined_width(units: List[_Unit]) -> int:
+    return sum(u.width + (len(u.sep) if i else 0) for i, u in enumerate(units))
+
+
+# 下一块开头要重复的内容：上一块结尾的若干个完整单位，放不下时取最后一个单位的结尾几句；
+# 代码块不参与重叠
+def _overlap_tail(units: List[_Unit], overlap: int) -> List[_Unit]:
+    tail: List[_Unit] = []
+    width = 0
+    for u in reversed(units):
+        w = u.width + len(u.sep)
+        if u.code or (width + w) // 4 > overlap:
+            break
+        tail.insert(0, u)
+        width += w
+    if tail or not units or units[-1].code:
+        return tail
+    sentences = _SENTENCE_RE.findall(units[-1].text.rsplit("\n", 1)[-1])
+    for sentence in reversed(sentences[1:]):
+        w = _width(sentence)
+        if (width + w) // 4 > overlap:
+            break
+        tail.insert(0, _Unit(sentence, w, ""))
+        width += w
+    return tail
+
+
+# 把一节（同一标题下）的单位按 token 预算贪心装箱，相邻块之间带 overlap 的重叠
+def _pack_section(units: List[_Unit], limit: int, overlap: int) -> Iterator[str]:
+    cur: List[_Unit] = []
+    width = 0
+    fresh = False  # cur 里是否有上一块没有的内容
+    for u in units:
+        if fresh and (width + len(u.sep) + u.width) // 4 > limit:
+            yield _join(cur)
+            cur = _overlap_tail(cur, overlap)
+            width = _joined_width(cur)
+            fresh = False
+            if (width + len(u.sep) + u.width) // 4 > limit:
+                cur, width = [], 0
+        width += u.width + (len(u.sep) if cur else 0)
+        cur.append(u)
+        fresh = True
+    if fresh:
+        yield _join(cur)
+
+
+# 单遍流式解析 Markdown：逐行识别标题、代码块围栏和空行分隔的块（段落 / 列表 / 表格），
+# 每读完一节就切块产出，不需要先把整个文件读进来再找全部标题；
+# 围栏里以 # 开头的行不当作标题
+def iter_markdown_chunks(
+    lines: Iterable[str],
+    source_path: str,
+    namespace: str,
+    max_tokens: int = CHUNK_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP,
+) -> Iterator[Chunk]:
+    limit = max_tokens - 2
+    overlap = min(overlap_tokens, limit // 2)
     heading_stack: List[Tuple[int, str]] = []
+    units: List[_Unit] = []
+    block: List[str] = []
+    fence: Optional[str] = None  # 当前所在代码块的围栏字符串
 
-    for i, m in enumerate(matches):
-        level = len(m.group(1))  # '#' 数量
-        title = m.group(2).strip()
-        start = m.end()
-        end = matches[i + 1].start() if i + 1 < len(matches) else len(raw)
-        body = raw[start:end].strip()
+    def flush_block(code: bool = False) -> None:
+        if block:
+            units.extend(_block_units(block, code, limit))
+            block.clear()
 
-        # 更新栈：同级或更深的旧标题需要弹出
-        while heading_stack and heading_stack[-1][0] >= level:
-            heading_stack.pop()
-        heading_stack.append((level, title))
+    def flush_section() -> Iterator[Chunk]:
+        heading_path = _make_heading_path(heading_stack)
+        for content in _pack_section(units, limit, overlap):
+            if not content:
+                continue
+            yield Chunk(
+                # chunk_id 由完整内容派生：内容不同的块不会撞 ID
+                chunk_id=_hash_id(f"{source_path}::{heading_path}::{content}"),
+                source_path=source_path,
+                heading=heading_path,
+                content=content,
+                namespace=namespace,
+            )
+        units.clear()
 
-        if not body:
+    for raw_line in lines:
+        line = raw_line.rstrip("\r\n")
+        if fence is not None:
+            block.append(line)
+            stripped = line.strip()
+            if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                flush_block(code=True)
+                fence = None
             continue
+        m = _FENCE_RE.match(line)
+        if m:
+            flush_block()
+            fence = m.group(1)
+            block.append(line)
+            continue
+        m = _HEADING_RE.match(line)
+        if m:
+            flush_block()
+            yield from flush_section()
+            # 更新栈：同级或更深的旧标题需要弹出
+            level = len(m.group(1))  # '#' 数量
+            while heading_stack and heading_stack[-1][0] >= level:
+                heading_stack.pop()
+            heading_stack.append((level, m.group(2).strip()))
+            continue
+        if not line.strip():
+            flush_block()
+            continue
+        block.append(line)
+    # 文件结尾：未闭合的代码块也按代码块处理
+    flush_block(code=fence is not None)
+    yield from flush_section()
 
-        heading_path = _make_heading_path(heading_stack)
 
-        # 超长再硬切
-        parts = (
-            [body]
-            if len(body) <= max_chars
-            else [body[j : j + max_chars] for j in range(0, len(body), max_chars)]
-        )
-        for part in parts:
-            base = f"{path.as_posix()}::{heading_path}::{part[:200]}"
-            cid = _hash_id(base)
-            chunks.append(
-                Chunk(
-                    chunk_id=cid,
-                    source_path=str(path.as_posix()),
-                    heading=heading_path,
-                    content=part.strip(),
-                    namespace=namespace,
-                )
+# 将单个 Markdown 文件按标题和结构块切块
+def chunk_markdown_file(
+    path: Path,
+    namespace: str,
+    max_tokens: int = CHUNK_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP,
+) -> List[Chunk]:
+    with path.open("r", encoding="utf-8", errors="ignore") as f:
+        return list(
+            iter_markdown_chunks(
+                f,
+                str(path.as_posix()),
+                namespace,
+                max_tokens=max_tokens,
+                overlap_tokens=overlap_tokens,
             )
+        )
+
+
+# 并行切块
+# 文件数较少时进程池的启动开销比切块本身还大，直接在当前进程处理
+_MIN_PARALLEL_FILES = 8
+# 每个工作进程最多同时排队的文件数：限制提前切好但还没被消费的 chunk 占用的内存
+_PREFETCH_PER_WORKER = 4
+
+
+# 进程池任务：参数和返回值都要能 pickle，所以传字符串路径
+# args: (路径, namespace, max_tokens, overlap_tokens)
+def _chunk_file_task(args: Tuple[str, str, int, int]) -> List[Chunk]:
+    path, namespace, max_tokens, overlap_tokens = args
+    return chunk_markdown_file(
+        Path(path), namespace, max_tokens=max_tokens, overlap_tokens=overlap_tokens
+    )
+
+
+# 切块的同时分词：中文分词是构建里最耗 CPU 的步骤之一，放在工作进程里和切块一起并行
+def _chunk_tokenize_task(
+    args: Tuple[str, str, int, int],
+) -> Tuple[List[Chunk], List[List[str]]]:
+    chunks = _chunk_file_task(args)
+    return chunks, [tokenize(c.content) for c in chunks]
 
-    return chunks
+
+# 按输入顺序逐个产出 (key, task 的结果)
+# 调用方消费上一个文件的结果（例如向量化）时，进程池已经在处理后面的文件
+def _iter_file_tasks(
+    items: Iterable[Tuple[K, Path, str]],
+    task: Callable[[Tuple[str, str, int, int]], R],
+    workers: Optional[int],
+    sizes: Tuple[int, int],
+    dict_cache: Optional[Path] = None,
+) -> Iterator[Tuple[K, R]]:
+    it = iter(items)
+    head = list(itertools.islice(it, _MIN_PARALLEL_FILES))
+    workers = workers if workers is not None else (os.cpu_count() or 1)
+    if workers <= 1 or len(head) < _MIN_PARALLEL_FILES:
+        for key, path, ns in itertools.chain(head, it):
+            yield key, task((str(path), ns, *sizes))
+        return
+
+    window = workers * _PREFETCH_PER_WORKER
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=configure_tokenizer,
+        initargs=(dict_cache,),
+    ) as pool:
+        pending: Deque[Tuple[K, Future]] = deque()
+        for key, path, ns in itertools.chain(head, it):
+            pending.append((key, pool.submit(task, (str(path), ns, *sizes))))
+            if len(pending) >= window:
+                k, fut = pending.popleft()
+                yield k, fut.result()
+        while pending:
+            k, fut = pending.popleft()
+            yield k, fut.result()
+
+
+# 按输入顺序逐个产出 (key, 该文件的 chunks)
+# items: (key, 文件路径, namespace)，可以是惰性的生成器（边发现文件边切块）
+def iter_file_chunks(
+    items: Iterable[Tuple[K, Path, str]],
+    workers: Optional[int] = None,
+    max_tokens: int = CHUNK_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP,
+) -> Iterator[Tuple[K, List[Chunk]]]:
+    sizes = (max_tokens, overlap_tokens)
+    return _iter_file_tasks(items, _chunk_file_task, workers, sizes)
+
+
+# 同 iter_file_chunks，额外产出与 chunks 对齐的 BM25 分词结果
+# dict_cache: jieba 词典缓存位置（KBPaths.jieba_cache），工作进程共用
+def iter_tokenized_file_chunks(
+    items: Iterable[Tuple[K, Path, str]],
+    workers: Optional[int] = None,
+    dict_cache: Optional[Path] = None,
+    max_tokens: int = CHUNK_TOKENS,
+    overlap_tokens: int = CHUNK_OVERLAP,
+) -> Iterator[Tuple[K, Tuple[List[Chunk], List[List[str]]]]]:
+    sizes = (max_tokens, overlap_tokens)
+    return _iter_file_tasks(items, _chunk_tokenize_task, workers, sizes, dict_cache)
+
+
+# 惰性遍历 root 下指定后缀的文件
+def iter_doc_files(root: Path, exts: Iterable[str] = (".md", ".txt")) -> Iterator[Path]:
+    exts = tuple(exts)
+    for p in root.rglob("*"):
+        if p.is_file() and p.suffix.lower() in exts:
+            yield p
+
+
+# 流式产出 root 下所有文档的 chunk
+def iter_chunks(
+    root: Path, exts: Iterable[str] = (".md", ".txt"), workers: Optional[int] = None
+) -> Iterator[Chunk]:
+    items = ((p, p, _infer_namespace(root, p)) for p in iter_doc_files(root, exts))
+    for _, chunks in iter_file_chunks(items, workers=workers):
+        yield from chunks
 
 
 # 递归扫描目录，收集所有文档的 chunks
 # 返回所有 .md 和 .txt 文件的 chunk 列表
 def collect_chunks(root: Path, exts: Iterable[str] = (".md", ".txt")) -> List[Chunk]:
-    # 递归收集指定后缀的文档，并汇总所有 chunk
-    all_chunks: List[Chunk] = []
-    for p in root.rglob("*"):
-        if p.is_file() and p.suffix.lower() in exts:
-            ns = _infer_namespace(root, p)
-            all_chunks.extend(chunk_markdown_file(p, namespace=ns))
-    return all_chunks
+    return list(iter_chunks(root, exts))
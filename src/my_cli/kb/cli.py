@@ -1,24 +1,54 @@
 from __future__ import annotations
+import hashlib
+import itertools
+import json
+import re
+import sys
 from pathlib import Path
-from typing import Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 import typer
 from rich.console import Console
 from rich.table import Table
 
 from .paths import KBPaths, ensure_dirs
-from .chunker import collect_chunks
-from .embedder import Embedder
-from .index import (
-    save_chunks_jsonl,
-    build_faiss_index,
-    save_index,
-    save_index_meta,
+from .defaults import (
+    CHUNK_OVERLAP,
+    CHUNK_TOKENS,
+    DEFAULT_MODEL,
+    EMBED_BACKENDS,
+    EMBED_BATCH,
+    EMBED_TOKEN_BUDGET,
+    INDEX_TYPES,
+    PARITY_THRESHOLD,
+    QUERY_BATCH,
+    RECALL_K,
+    WATCH_DEBOUNCE,
+    WATCH_POLL_INTERVAL,
 )
-from .pack import retrieve, write_pack_and_trace
-from .bm25 import build_bm25_corpus, save_bm25_corpus
+from .timing import recording, span
+
+if TYPE_CHECKING:
+    from .embedder import Embedder
+    from .pack import RetrievalHit
+    from .query_cache import QueryCache
+    from .timing import Recorder
+
 # 命令行入口：构建向量索引、查询相似内容、生成知识包文件
+# main.py 在启动时就会导入本模块：这里只导入轻量依赖，
+# 模型 / FAISS / numpy / jieba 相关模块在各命令内部按需导入，不影响 version / check / init 的启动速度
 
 console = Console()
+err_console = Console(stderr=True)
 kb_app = typer.Typer(help="Knowledge Base (RAG) commands", add_completion=False)
 
 
@@ -28,61 +58,402 @@ def kb_build(
     root: Optional[Path] = typer.Option(
         None, "--root", help="Project root, default is current directory"
     ),
-    model: str = typer.Option(
-        "intfloat/multilingual-e5-small", "--model", help="Embedding model name"
+    model: str = typer.Option(DEFAULT_MODEL, "--model", help="Embedding model name"),
+    shard: Optional[str] = typer.Option(
+        None,
+        "--shard",
+        help="Build the KB shard .myspec/kb/shards/<NAME> (documents in its raw/) instead of the main KB",
+    ),
+    full: bool = typer.Option(
+        False, "--full", help="Ignore the build manifest and rebuild everything"
+    ),
+    jsonl: bool = typer.Option(
+        False, "--jsonl", help="Also export chunks.jsonl / bm25_corpus.jsonl"
+    ),
+    index_type: Optional[str] = typer.Option(
+        None,
+        "--index-type",
+        help=f"FAISS index type: {', '.join(INDEX_TYPES)}. Default keeps the current type (flat for new KBs).",
+    ),
+    workers: Optional[int] = typer.Option(
+        None, "--workers", help="Chunking worker processes, default is CPU count"
+    ),
+    batch_size: int = typer.Option(
+        EMBED_BATCH, "--batch-size", min=1, help="Chunks embedded per batch"
+    ),
+    backend: Optional[str] = typer.Option(
+        None,
+        "--backend",
+        help=f"Embedding backend: {', '.join(EMBED_BACKENDS)}. Default keeps the current backend (torch for new KBs).",
+    ),
+    quantize: Optional[bool] = typer.Option(
+        None,
+        "--quantize/--no-quantize",
+        help="Use the int8-quantized ONNX model (onnx backend only). Default keeps the current setting.",
+    ),
+    threads: Optional[int] = typer.Option(
+        None, "--threads", min=1, help="Inference threads, default is the backend's own"
+    ),
+    encode_batch: Optional[int] = typer.Option(
+        None,
+        "--encode-batch",
+        min=1,
+        help="Max texts per inference call, default is limited only by --token-budget",
+    ),
+    token_budget: int = typer.Option(
+        EMBED_TOKEN_BUDGET,
+        "--token-budget",
+        min=1,
+        help="Padded tokens per inference call; texts are bucketed by length to fill it",
+    ),
+    parity_threshold: float = typer.Option(
+        PARITY_THRESHOLD,
+        "--parity-threshold",
+        help="Warn when quantized vectors drift below this cosine similarity from the torch reference",
+    ),
+    chunk_tokens: Optional[int] = typer.Option(
+        None,
+        "--chunk-tokens",
+        min=32,
+        help=f"Estimated model tokens per chunk. Default keeps the current setting ({CHUNK_TOKENS} for new KBs).",
+    ),
+    chunk_overlap: Optional[int] = typer.Option(
+        None,
+        "--chunk-overlap",
+        min=0,
+        help=f"Tokens repeated between adjacent chunks of a section. Default keeps the current setting ({CHUNK_OVERLAP} for new KBs).",
     ),
 ):
     """
-    把 raw 目录中的 *.md 和 *.txt 文件构建本地 FAISS 索引
+    把 raw 目录中的 *.md 和 *.txt 文件构建本地 FAISS 索引（默认增量）
     """
     project_root = root or Path.cwd()
-    paths = KBPaths(project_root)
+    paths = _kb_paths(project_root, shard)
+    if index_type is not None and index_type not in INDEX_TYPES:
+        raise typer.BadParameter(
+            f"--index-type must be one of: {', '.join(INDEX_TYPES)}"
+        )
+    if backend is not None and backend not in EMBED_BACKENDS:
+        raise typer.BadParameter(
+            f"--backend must be one of: {', '.join(EMBED_BACKENDS)}"
+        )
+    _run_build(
+        paths,
+        model=model,
+        full=full,
+        jsonl=jsonl,
+        index_type=index_type,
+        workers=workers,
+        batch_size=batch_size,
+        backend=backend,
+        quantize=quantize,
+        threads=threads,
+        encode_batch=encode_batch,
+        token_budget=token_budget,
+        parity_threshold=parity_threshold,
+        chunk_tokens=chunk_tokens,
+        chunk_overlap=chunk_overlap,
+    )
+
+
+def _run_build(
+    paths: KBPaths,
+    model: str = DEFAULT_MODEL,
+    full: bool = False,
+    jsonl: bool = False,
+    index_type: Optional[str] = None,
+    workers: Optional[int] = None,
+    batch_size: int = EMBED_BATCH,
+    backend: Optional[str] = None,
+    quantize: Optional[bool] = None,
+    threads: Optional[int] = None,
+    encode_batch: Optional[int] = None,
+    token_budget: int = EMBED_TOKEN_BUDGET,
+    parity_threshold: float = PARITY_THRESHOLD,
+    chunk_tokens: Optional[int] = None,
+    chunk_overlap: Optional[int] = None,
+    out: Console = console,
+    embedder: Optional["Embedder"] = None,
+) -> None:
+    from .build import build_kb
+    from .snapshot import pin
+
     ensure_dirs(paths)
+    # kb watch 在多次构建之间复用同一个 Embedder（模型只加载一次）
+    if embedder is None:
+        embedder = _build_embedder(
+            paths,
+            model,
+            backend=backend,
+            quantize=quantize,
+            threads=threads,
+            encode_batch=encode_batch,
+            token_budget=token_budget,
+        )
 
     # if not paths.myspec_dir.exists():
     #     raise typer.BadParameter(
     #         "No .myspec directory found. Run `myspec init` in this project first."
     #     )
 
-    console.print(f"[bold]Indexing knowledge from:[/bold] {paths.kb_raw}")
-    chunks = collect_chunks(paths.kb_raw)
+    out.print(f"[bold]Indexing knowledge from:[/bold] {paths.kb_raw}")
+    result = build_kb(
+        paths,
+        model=model,
+        full=full,
+        embedder=embedder,
+        jsonl=jsonl,
+        index_type=index_type,
+        workers=workers,
+        batch_size=batch_size,
+        chunk_tokens=chunk_tokens,
+        chunk_overlap=chunk_overlap,
+    )
 
-    if not chunks:
-        console.print(
-            "[yellow]No documents found in .myspec/kb/raw. Add some .md/.txt first.[/yellow]"
+    if not result.num_chunks and result.snapshot is None:
+        out.print(
+            f"[yellow]No documents found in {paths.kb_raw}. Add some .md/.txt first.[/yellow]"
         )
         raise typer.Exit(code=1)
+    if not result.num_chunks:
+        # 文档全部删除：发布了空索引，检索不再返回旧文档
+        out.print(
+            f"[yellow]No documents left in {paths.kb_raw}. "
+            f"Published an empty index ({result.mode}).[/yellow]"
+        )
+        out.print(f"Published snapshot [cyan]{result.snapshot.name}[/cyan]")
+        return
 
-    # 向量化文本并构建索引
-    embedder = Embedder(model_name=model)
-    vectors = embedder.encode([f"passage: {c.content}" for c in chunks])
+    if result.mode == "noop":
+        out.print(
+            f"[green]OK[/green] Index is up to date ({result.num_chunks} chunks)."
+        )
+        return
 
-    index = build_faiss_index(vectors)
-    save_index(index, paths.index_faiss)
-    save_chunks_jsonl(chunks, paths.chunks_jsonl)
+    d = result.diff
+    out.print(
+        f"[green]OK[/green] Built index with {result.num_chunks} chunks "
+        f"({result.mode}: +{len(d.added)} ~{len(d.changed)} -{len(d.removed)} files, "
+        f"{result.embedded} embedded, {result.removed} removed)."
+    )
+    if result.recall is not None:
+        out.print(
+            f"Index type [cyan]{result.index_type}[/cyan]: "
+            f"recall@{RECALL_K} vs flat = {result.recall:.3f}"
+        )
+    st = embedder.stats
+    if st.texts:
+        out.print(
+            f"Embedding: {st.tokens} tokens in {st.batches} batches, "
+            f"{st.tokens_per_s:.0f} tokens/s, padding {st.padding_ratio:.1%}"
+        )
+    if result.parity is not None:
+        if result.parity < parity_threshold:
+            out.print(
+                f"[yellow]Warning:[/yellow] quantized vectors drift from the torch reference "
+                f"(min cosine {result.parity:.4f} < {parity_threshold}). "
+                "Consider --no-quantize."
+            )
+        else:
+            out.print(f"Quantization parity: min cosine = {result.parity:.4f}")
+    built = pin(paths)
+    out.print(f"Published snapshot [cyan]{built.index_root.name}[/cyan]")
+    out.print(f"- {built.index_faiss}")
+    if built.vectors_npy.exists():
+        out.print(f"- {built.vectors_npy}")
+    out.print(f"- {built.kb_store}")
+    out.print(f"- {built.index_meta}")
+    out.print(f"- {built.bm25_index}")
+    if jsonl:
+        out.print(f"- {built.chunks_jsonl}")
+        out.print(f"- {built.bm25_corpus_jsonl}")
+    out.print(f"- {built.manifest_json}")
 
-    # 保存索引元信息
-    meta = {
-        "model": model,
-        "num_chunks": len(chunks),
-        "kb_raw": str(paths.kb_raw.as_posix()),
-    }
-    save_index_meta(meta, paths.index_meta)
 
-    bm25_corpus = build_bm25_corpus(chunks)
-    save_bm25_corpus(bm25_corpus, chunks, paths.bm25_corpus_jsonl)
+# 构建用的 Embedder：未指定后端 / 量化时沿用上一次构建的设置
+def _build_embedder(
+    paths: KBPaths,
+    model: str,
+    backend: Optional[str] = None,
+    quantize: Optional[bool] = None,
+    threads: Optional[int] = None,
+    encode_batch: Optional[int] = None,
+    token_budget: int = EMBED_TOKEN_BUDGET,
+) -> "Embedder":
+    from .backends import onnx_available
+    from .embedder import Embedder
+    from .index import load_index_meta
+    from .snapshot import pin
 
-    console.print(f"[green]OK[/green] Built index with {len(chunks)} chunks.")
-    console.print(f"- {paths.index_faiss}")
-    console.print(f"- {paths.chunks_jsonl}")
-    console.print(f"- {paths.index_meta}")
-    console.print(f"- {paths.bm25_corpus_jsonl}")
+    old_meta = load_index_meta(pin(paths).index_meta)
+    backend = backend or old_meta.get("backend", "torch")
+    if quantize is None:
+        quantize = bool(old_meta.get("quantize", False)) and backend == "onnx"
+    if quantize and backend != "onnx":
+        raise typer.BadParameter("--quantize requires --backend onnx")
+    if backend == "onnx" and not onnx_available():
+        raise typer.BadParameter(
+            "--backend onnx requires onnxruntime: pip install 'my-spec-cli[onnx]'"
+        )
+    return Embedder(
+        model_name=model,
+        cache_dir=paths.embed_cache_dir,
+        backend=backend,
+        quantize=quantize,
+        threads=threads,
+        batch_size=encode_batch,
+        token_budget=token_budget,
+        onnx_dir=paths.onnx_dir,
+    )
+
+
+# 查询结果缓存：索引没有重建过时，同样的查询直接返回上次的结果
+# targets 是这次查询固定的快照：查缓存、检索、写缓存都基于同一组快照和同一个版本号，
+# 查询过程中 kb build 发布了新索引时，旧快照的结果不会记到新版本号下
+def _open_query_cache(
+    paths: KBPaths, targets: List[Tuple[str, KBPaths]]
+) -> Optional["QueryCache"]:
+    from .query_cache import QueryCache
+
+    return QueryCache.open(paths, targets)
+
+
+# 优先走 kb serve 常驻进程，没有运行时在进程内加载模型和索引
+def _retrieve(
+    paths: KBPaths,
+    query: str,
+    topk: int,
+    ns_list: Optional[List[str]],
+    use_cache: bool = True,
+) -> List[RetrievalHit]:
+    from .pack import kb_targets
+
+    targets = kb_targets(paths)
+    cache = _open_query_cache(paths, targets) if use_cache else None
+    if cache is not None:
+        hits = cache.get(query, topk, ns_list)
+        if hits is not None:
+            return hits
+
+    hits = _retrieve_uncached(paths, query, topk, ns_list, targets)
+    if cache is not None:
+        cache.put(query, topk, ns_list, hits)
+    return hits
+
+
+# kb serve 每次请求都检查索引版本，返回的结果不会比 targets 旧
+def _retrieve_uncached(
+    paths: KBPaths,
+    query: str,
+    topk: int,
+    ns_list: Optional[List[str]],
+    targets: Optional[List[Tuple[str, KBPaths]]] = None,
+) -> List[RetrievalHit]:
+    from .client import remote_retrieve
+
+    hits = remote_retrieve(paths, query, topk=topk, namespaces=ns_list)
+    if hits is not None:
+        return hits
+
+    from .pack import retrieve
+
+    embedder = _query_embedder(paths, targets=targets)
+    return retrieve(
+        query=query,
+        embedder=embedder,
+        paths=paths,
+        topk=topk,
+        namespaces=ns_list,
+        targets=targets,
+    )
+
+
+# 批量检索：服务可用时按组转发，否则在进程内只加载一次模型和索引
+def _retrieve_many(
+    paths: KBPaths,
+    queries: Iterable[str],
+    topk: int,
+    ns_list: Optional[List[str]],
+) -> Iterator[List[RetrievalHit]]:
+    from .client import remote_retrieve_many, server_available
+
+    it = iter(queries)
+    if server_available(paths):
+        while True:
+            batch = list(itertools.islice(it, QUERY_BATCH))
+            if not batch:
+                return
+            results = remote_retrieve_many(paths, batch, topk=topk, namespaces=ns_list)
+            if results is None:
+                # 服务中途不可用：这一组和剩下的查询改为进程内检索
+                it = itertools.chain(batch, it)
+                break
+            yield from results
+
+    from .pack import retrieve_many
+
+    embedder = _query_embedder(paths)
+    yield from retrieve_many(it, embedder, paths, topk=topk, namespaces=ns_list)
+
+
+# 查询向量用构建索引时的模型和推理后端编码（有分片时以主知识库 / 第一个分片为准）
+def _query_embedder(
+    paths: KBPaths,
+    model: Optional[str] = None,
+    targets: Optional[List[Tuple[str, KBPaths]]] = None,
+):
+    from .embedder import embedder_for_index
+    from .index import load_index_meta
+    from .pack import kb_targets
+
+    if targets is None:
+        targets = kb_targets(paths)
+    meta_path = targets[0][1].index_meta if targets else paths.index_meta
+    return embedder_for_index(
+        load_index_meta(meta_path),
+        cache_dir=paths.embed_cache_dir,
+        onnx_dir=paths.onnx_dir,
+        model=model,
+    )
+
+
+# 读取批量查询文件：每行一个查询；以 { 开头的行按 JSON 解析 {"id": ..., "query": ...}
+# 没有 id 时用行号；FILE 为 - 时从标准输入读取
+def _read_batch(path: Path) -> Iterator[Tuple[str, str]]:
+    f = sys.stdin if str(path) == "-" else path.open("r", encoding="utf-8")
+    try:
+        for lineno, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                obj = json.loads(line)
+                yield str(obj.get("id", lineno)), str(obj["query"])
+            else:
+                yield str(lineno), line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+# JSONL 逐行写到标准输出并立即 flush，下游可以边跑边消费
+def _emit_jsonl(obj: Dict[str, Any]) -> None:
+    sys.stdout.write(json.dumps(obj, ensure_ascii=False) + "\n")
+    sys.stdout.flush()
+
+
+def _parse_namespaces(namespaces: str) -> Optional[List[str]]:
+    if not namespaces.strip():
+        return None
+    return [x.strip() for x in namespaces.split(",") if x.strip()]
 
 
 # 输入一段查询语句，输出最相似的文本块列表。主要用于调试检索效果。
 @kb_app.command("query")
 def kb_query(
-    query: str = typer.Argument(..., help="Feature request or requirement text"),
+    query: Optional[str] = typer.Argument(
+        None, help="Feature request or requirement text"
+    ),
     topk: int = typer.Option(6, "--topk", help="Top K evidence chunks"),
     namespaces: str = typer.Option(
         "",
@@ -92,25 +463,47 @@ def kb_query(
     root: Optional[Path] = typer.Option(
         None, "--root", help="Project root, default is current directory"
     ),
+    batch: Optional[Path] = typer.Option(
+        None,
+        "--batch",
+        help="File with one query per line (or JSONL with id/query); results are streamed as JSONL. Use - for stdin.",
+    ),
+    chrome_trace: Optional[Path] = typer.Option(
+        None,
+        "--chrome-trace",
+        help="Write per-stage timings as Chrome trace-event JSON (open in Perfetto / chrome://tracing)",
+    ),
+    no_cache: bool = typer.Option(
+        False, "--no-cache", help="Bypass the query-result cache"
+    ),
 ):
     project_root = root or Path.cwd()
     paths = KBPaths(project_root)
+    ns_list = _parse_namespaces(namespaces)
 
-    embedder = Embedder()
+    if batch is not None:
+        from .pack import hit_to_dict
 
-    ns_list = None
-    if namespaces.strip():
-        ns_list = [x.strip() for x in namespaces.split(",") if x.strip()]
+        items = _read_batch(batch)
+        # 同一个迭代器一边取 id 一边取查询：检索结果按输入顺序产出
+        ids: List[str] = []
 
-    hits = retrieve(
-        query=query,
-        embedder=embedder,
-        index_path=paths.index_faiss,
-        chunks_path=paths.chunks_jsonl,
-        bm25_corpus_path=paths.bm25_corpus_jsonl,
-        topk=topk,
-        namespaces=ns_list,
-    )
+        def queries() -> Iterator[str]:
+            for qid, q in items:
+                ids.append(qid)
+                yield q
+
+        for i, hits in enumerate(_retrieve_many(paths, queries(), topk, ns_list)):
+            _emit_jsonl({"id": ids[i], "hits": [hit_to_dict(h) for h in hits]})
+        return
+
+    if query is None:
+        raise typer.BadParameter("Provide a QUERY or --batch FILE")
+
+    with recording() as rec:
+        hits = _retrieve(paths, query, topk, ns_list, use_cache=not no_cache)
+    if chrome_trace is not None:
+        _write_chrome_trace(rec, chrome_trace)
 
     table = Table(title="KB Query Results")
     table.add_column("#", style="cyan", width=4)
@@ -128,9 +521,10 @@ def kb_query(
 
 # 生成知识包文件：根据查询从知识库检索相关内容，生成 knowledge-pack.md 和 trace.json
 @kb_app.command("pack")
-@kb_app.command("pack")
 def kb_pack(
-    query: str = typer.Argument(..., help="Feature request or requirement text"),
+    query: Optional[str] = typer.Argument(
+        None, help="Feature request or requirement text"
+    ),
     topk: int = typer.Option(6, "--topk", help="Top K evidence chunks"),
     namespaces: str = typer.Option(
         "",
@@ -140,38 +534,498 @@ def kb_pack(
     root: Optional[Path] = typer.Option(
         None, "--root", help="Project root, default is current directory"
     ),
+    batch: Optional[Path] = typer.Option(
+        None,
+        "--batch",
+        help="File with one query per line (or JSONL with id/query); writes one pack per query. Use - for stdin.",
+    ),
+    out_dir: Optional[Path] = typer.Option(
+        None,
+        "--out-dir",
+        help="Output directory for --batch, default is .myspec/context/batch/",
+    ),
+    chrome_trace: Optional[Path] = typer.Option(
+        None,
+        "--chrome-trace",
+        help="Also write per-stage timings as Chrome trace-event JSON (open in Perfetto / chrome://tracing)",
+    ),
+    no_cache: bool = typer.Option(
+        False, "--no-cache", help="Bypass the query-result cache"
+    ),
+    no_refresh: bool = typer.Option(
+        False,
+        "--no-refresh",
+        help="Use the index as is, even if raw documents changed since the last build",
+    ),
 ):
     """
     生成 .myspec/context/knowledge-pack.md 和 trace.json 给 Claude Code 的/specify 使用。
     """
+    from .pack import kb_targets, write_pack_and_trace
+
     project_root = root or Path.cwd()
     paths = KBPaths(project_root)
     ensure_dirs(paths)
+    if query is None and batch is None:
+        raise typer.BadParameter("Provide a QUERY or --batch FILE")
+    # 批量模式的标准输出是 JSONL，提示信息改写到 stderr
+    out = err_console if batch is not None else console
+    ns_list = _parse_namespaces(namespaces)
 
-    if not paths.index_faiss.exists() or not paths.chunks_jsonl.exists():
-        console.print(
+    # 记录检索和渲染各阶段耗时，写入 trace.json 的 timings
+    with recording() as rec:
+        # raw 文档在上次构建后有变化时先增量更新索引，否则缓存和检索都会返回过期的内容
+        if not no_refresh:
+            _refresh_index(paths, out)
+        # 缓存命中说明索引存在且没变，不用检查索引、也不用导入 FAISS / 模型
+        # 查缓存、检索、写缓存都用这里固定的快照
+        targets = kb_targets(paths)
+        use_cache = batch is None and not no_cache
+        cache = _open_query_cache(paths, targets) if use_cache else None
+        hits = cache.get(query, topk, ns_list) if cache is not None else None
+        if hits is None:
+            if not targets:
+                targets = _ensure_index(paths, out)
+                cache = _open_query_cache(paths, targets) if use_cache else None
+            if batch is None:
+                hits = _retrieve_uncached(paths, query, topk, ns_list, targets)
+                if cache is not None:
+                    cache.put(query, topk, ns_list, hits)
+        if batch is None:
+            write_pack_and_trace(paths, query=query, hits=hits, recorder=rec)
+
+    if batch is not None:
+        # 每个查询写到 <out-dir>/<id>/knowledge-pack.md 和 trace.json
+        base = out_dir or paths.context_dir / "batch"
+        items = list(_read_batch(batch))
+        results = _retrieve_many(paths, (q for _, q in items), topk, ns_list)
+        dirs = _batch_dir_names([qid for qid, _ in items])
+        for (qid, q), hits, name in zip(items, results, dirs):
+            pack_path, trace_path = write_pack_and_trace(
+                paths, query=q, hits=hits, out_dir=base / name
+            )
+            _emit_jsonl(
+                {
+                    "id": qid,
+                    "pack": str(pack_path),
+                    "trace": str(trace_path),
+                    "num_hits": len(hits),
+                }
+            )
+        out.print(f"[green]OK[/green] {len(items)} knowledge packs written to {base}")
+        return
+
+    console.print("[green]OK[/green] Knowledge pack generated:")
+    console.print(f"- {paths.knowledge_pack_md}")
+    console.print(f"- {paths.trace_json}")
+    if chrome_trace is not None:
+        _write_chrome_trace(rec, chrome_trace)
+        console.print(f"- {chrome_trace}")
+
+
+# 主知识库和分片都还没有构建过时先自动构建一次
+# 返回固定的快照（没有索引时先构建）
+def _ensure_index(paths: KBPaths, out: Console) -> List[Tuple[str, KBPaths]]:
+    from .pack import kb_targets
+
+    targets = kb_targets(paths)
+    if not targets:
+        out.print(
             "[yellow]Index not found. Running `myspec kb build` first...[/yellow]"
         )
-        kb_build(root=project_root)
+        _run_build(paths, out=out)
+        targets = kb_targets(paths)
+    return targets
 
-    embedder = Embedder()
 
-    ns_list = None
-    if namespaces.strip():
-        ns_list = [x.strip() for x in namespaces.split(",") if x.strip()]
+# 已构建的知识库（主知识库 / 分片）里 raw 文档有变化的，返回未固定快照的路径和变化的文件
+# 只 stat raw 目录并与快照里清单记录的 (mtime, size) 比较，不读文件内容
+def _stale_kbs(paths: KBPaths) -> List[Tuple[KBPaths, List[str]]]:
+    from dataclasses import replace
 
-    hits = retrieve(
-        query=query,
-        embedder=embedder,
-        index_path=paths.index_faiss,
-        chunks_path=paths.chunks_jsonl,
-        bm25_corpus_path=paths.bm25_corpus_jsonl,
-        topk=topk,
-        namespaces=ns_list,
+    from .manifest import load_manifest, stale_files
+    from .pack import kb_targets
+
+    stale: List[Tuple[KBPaths, List[str]]] = []
+    with span("stale_check"):
+        for _, target in kb_targets(paths):
+            changed = stale_files(load_manifest(target.manifest_json), target.kb_raw)
+            if changed:
+                stale.append((replace(target, snapshot_dir=None), changed))
+    return stale
+
+
+# 上一次构建使用的模型：自动更新时沿用，不会因为默认模型不同而触发全量重建
+def _index_model(paths: KBPaths) -> str:
+    from .snapshot import pin
+
+    try:
+        meta = json.loads(pin(paths).index_meta.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return DEFAULT_MODEL
+    return meta.get("model") or DEFAULT_MODEL
+
+
+# 刷新失败不影响 kb pack：提示后继续用已发布的索引
+def _refresh_index(paths: KBPaths, out: Console) -> None:
+    for target, changed in _stale_kbs(paths):
+        out.print(
+            f"[yellow]{len(changed)} file(s) in {target.kb_raw} changed since the last build. "
+            "Updating the index...[/yellow]"
+        )
+        try:
+            _run_build(target, model=_index_model(target), out=out)
+        except typer.Exit:
+            out.print(
+                "[yellow]Index refresh failed; using the last published index.[/yellow]"
+            )
+        except Exception as e:
+            out.print(
+                f"[yellow]Index refresh failed ({e}); using the last published index.[/yellow]"
+            )
+
+
+def _write_chrome_trace(rec: Recorder, path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(
+        json.dumps(rec.to_chrome_trace(), ensure_ascii=False), encoding="utf-8"
     )
 
-    write_pack_and_trace(paths, query=query, hits=hits)
 
-    console.print("[green]OK[/green] Knowledge pack generated:")
-    console.print(f"- {paths.knowledge_pack_md}")
-    console.print(f"- {paths.trace_json}")
+# 查询 id 用作目录名，去掉路径分隔符等字符
+def _safe_name(qid: str) -> str:
+    return re.sub(r"[^\w.-]", "_", qid).strip(".") or "_"
+
+
+# 批量模式下每个查询的输出目录名
+# 不同 id 清理后同名（"a/b"、"a b" 都变成 a_b）时加上原始 id 的短哈希，完全相同的 id 再加序号；
+# 按不区分大小写比较（Windows / macOS 的文件系统）
+def _batch_dir_names(qids: List[str]) -> List[str]:
+    safe = [_safe_name(q) for q in qids]
+    counts: Dict[str, int] = {}
+    for name in safe:
+        counts[name.lower()] = counts.get(name.lower(), 0) + 1
+    names: List[str] = []
+    used: Set[str] = set()
+    for qid, name in zip(qids, safe):
+        if counts[name.lower()] > 1:
+            digest = hashlib.sha1(qid.encode("utf-8")).hexdigest()[:8]
+            name = f"{name}-{digest}"
+        base, n = name, 1
+        while name.lower() in used:
+            n += 1
+            name = f"{base}-{n}"
+        used.add(name.lower())
+        names.append(name)
+    return names
+
+
+# 把二进制存储导出成 JSONL，便于调试或给外部工具使用
+@kb_app.command("export")
+def kb_export(
+    root: Optional[Path] = typer.Option(
+        None, "--root", help="Project root, default is current directory"
+    ),
+    shard: Optional[str] = typer.Option(
+        None, "--shard", help="Export the KB shard <NAME> instead of the main KB"
+    ),
+):
+    """
+    导出 chunks.jsonl 和 bm25_corpus.jsonl（调试用格式）
+    """
+    from .build import export_jsonl
+    from .snapshot import pin
+    from .store import store_exists
+
+    project_root = root or Path.cwd()
+    paths = pin(_kb_paths(project_root, shard))
+    if not store_exists(paths.kb_store):
+        console.print(
+            "[yellow]No KB store found. Run `myspec kb build` first.[/yellow]"
+        )
+        raise typer.Exit(code=1)
+
+    n = export_jsonl(paths)
+    console.print(f"[green]OK[/green] Exported {n} chunks:")
+    console.print(f"- {paths.chunks_jsonl}")
+    console.print(f"- {paths.bm25_corpus_jsonl}")
+
+
+# 列出主知识库和各分片：kb query / kb pack 会同时检索它们
+@kb_app.command("shards")
+def kb_shards(
+    root: Optional[Path] = typer.Option(
+        None, "--root", help="Project root, default is current directory"
+    ),
+):
+    """
+    列出参与检索的知识库分片
+    """
+    from .pack import kb_targets
+
+    paths = KBPaths(root or Path.cwd())
+    targets = kb_targets(paths)
+    if not targets:
+        console.print("[yellow]No KB built yet. Run `myspec kb build` first.[/yellow]")
+        raise typer.Exit(code=1)
+
+    table = Table(title="KB Shards")
+    table.add_column("Shard", style="cyan")
+    table.add_column("Chunks", justify="right")
+    table.add_column("Index", style="magenta")
+    table.add_column("Model", style="dim")
+    table.add_column("Path", style="dim")
+    for name, target in targets:
+        try:
+            meta = json.loads(target.index_meta.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            meta = {}
+        table.add_row(
+            name,
+            str(meta.get("num_chunks", "?")),
+            str(meta.get("index_type", "?")),
+            str(meta.get("model", "?")),
+            str(target.kb_root),
+        )
+    console.print(table)
+
+
+def _kb_paths(project_root: Path, shard: Optional[str]) -> KBPaths:
+    from .pack import MAIN_SHARD
+
+    paths = KBPaths(project_root)
+    if shard is None:
+        return paths
+    if (
+        not re.fullmatch(r"[\w.-]+", shard)
+        or not shard.strip(".")
+        or shard == MAIN_SHARD
+    ):
+        raise typer.BadParameter(f"Invalid shard name: {shard}")
+    return paths.shard(shard)
+
+
+# 常驻服务：模型、索引、chunks、BM25 语料一直留在内存里，kb query / kb pack 自动转发
+@kb_app.command("serve")
+def kb_serve(
+    root: Optional[Path] = typer.Option(
+        None, "--root", help="Project root, default is current directory"
+    ),
+    model: Optional[str] = typer.Option(
+        None,
+        "--model",
+        help="Embedding model name, default is the one the index was built with",
+    ),
+    host: str = typer.Option("127.0.0.1", "--host", help="Address to listen on"),
+    port: int = typer.Option(0, "--port", help="Port to listen on, 0 picks a free one"),
+):
+    """
+    启动本地检索服务，kb query / kb pack 检测到它时直接复用已加载的模型和索引
+    """
+    from .server import serve_forever
+
+    project_root = root or Path.cwd()
+    paths = KBPaths(project_root)
+    ensure_dirs(paths)
+
+    console.print("[bold]Loading model and index...[/bold]")
+    embedder = _query_embedder(paths, model=model)
+    console.print(
+        f"[green]OK[/green] Serving {paths.kb_root} (address in {paths.serve_json}). "
+        "Press Ctrl+C to stop."
+    )
+    try:
+        serve_forever(paths, embedder, host=host, port=port)
+    except KeyboardInterrupt:
+        console.print("\n[yellow]Stopped.[/yellow]")
+
+
+# 监视 raw 目录，文档变化后自动增量构建并发布新快照（kb serve 会自动加载）
+@kb_app.command("watch")
+def kb_watch(
+    root: Optional[Path] = typer.Option(
+        None, "--root", help="Project root, default is current directory"
+    ),
+    shard: Optional[str] = typer.Option(
+        None, "--shard", help="Watch the KB shard <NAME> instead of the main KB"
+    ),
+    model: Optional[str] = typer.Option(
+        None,
+        "--model",
+        help="Embedding model name, default is the one the index was built with",
+    ),
+    debounce: float = typer.Option(
+        WATCH_DEBOUNCE,
+        "--debounce",
+        min=0.0,
+        help="Seconds without further changes before rebuilding",
+    ),
+    poll_interval: float = typer.Option(
+        WATCH_POLL_INTERVAL,
+        "--poll-interval",
+        min=0.05,
+        help="Seconds between scans when polling",
+    ),
+    polling: bool = typer.Option(
+        False, "--polling", help="Poll the raw tree instead of using inotify"
+    ),
+):
+    """
+    监视 raw 目录，文档变化后自动增量构建索引
+    """
+    import time
+
+    from .embedder import EncodeStats
+    from .watch import InotifyWatcher, open_watcher, watch_loop
+
+    project_root = root or Path.cwd()
+    paths = _kb_paths(project_root, shard)
+    ensure_dirs(paths)
+    model = model or _index_model(paths)
+    embedder = _build_embedder(paths, model)
+
+    def rebuild(changed: Set[str]) -> None:
+        if changed:
+            stamp = time.strftime("%H:%M:%S")
+            names = ", ".join(sorted(changed)[:5])
+            more = " ..." if len(changed) > 5 else ""
+            console.print(f"[dim]{stamp}[/dim] {len(changed)} change(s): {names}{more}")
+        embedder.stats = EncodeStats()
+        try:
+            _run_build(paths, model=model, embedder=embedder)
+        except typer.Exit:
+            # raw 目录暂时为空：保留上一次发布的索引，继续监视
+            pass
+        except Exception as e:
+            console.print(f"[red]Build failed:[/red] {e}")
+
+    # 清单里还有没记录 stat 的文件时静默地再跑一次构建（noop，只补记 stat）
+    def settle() -> None:
+        from .manifest import load_manifest
+        from .snapshot import pin
+
+        manifest = load_manifest(pin(paths).manifest_json)
+        if all(e.mtime_ns for e in manifest.files.values()):
+            return
+        try:
+            _run_build(paths, model=model, embedder=embedder, out=Console(quiet=True))
+        except (typer.Exit, Exception):
+            pass
+
+    # 先开始监视再把索引更新到当前状态（没有变化时是 noop），中间的修改不会漏掉
+    watcher = open_watcher(paths.kb_raw, poll_interval=poll_interval, polling=polling)
+    rebuild(set())
+    how = "inotify" if isinstance(watcher, InotifyWatcher) else "polling"
+    console.print(
+        f"[green]OK[/green] Watching {paths.kb_raw} ({how}). Press Ctrl+C to stop."
+    )
+    try:
+        watch_loop(watcher, rebuild, debounce=debounce, settle=settle)
+    except KeyboardInterrupt:
+        console.print("\n[yellow]Stopped.[/yellow]")
+
+
+# 检索热点路径的基准测试：生成合成语料，逐阶段统计延迟 / 吞吐 / 峰值内存，结果写成 JSON
+@kb_app.command("bench")
+def kb_bench(
+    sizes: str = typer.Option(
+        "1k,10k",
+        "--sizes",
+        help="Comma-separated corpus sizes in chunks, e.g. 1k,100k,1m",
+    ),
+    queries: int = typer.Option(200, "--queries", min=1, help="Queries per size"),
+    seed: int = typer.Option(0, "--seed", help="Random seed for corpus and queries"),
+    index_type: str = typer.Option("flat", "--index-type", help="FAISS index type"),
+    model: Optional[str] = typer.Option(
+        None,
+        "--model",
+        help="Benchmark a real embedding model instead of the deterministic offline stub",
+    ),
+    out: Optional[Path] = typer.Option(
+        None, "--out", help="Results JSON path, default is .myspec/kb/bench/<time>.json"
+    ),
+    compare: Optional[Path] = typer.Option(
+        None, "--compare", help="Baseline results JSON to check for regressions"
+    ),
+    threshold: float = typer.Option(
+        0.2, "--threshold", help="Relative p50 slowdown counted as a regression"
+    ),
+    work_dir: Optional[Path] = typer.Option(
+        None, "--work-dir", help="Where to generate corpora, default is a temp dir"
+    ),
+    keep: bool = typer.Option(
+        False, "--keep", help="Keep generated corpora and indexes"
+    ),
+    root: Optional[Path] = typer.Option(
+        None, "--root", help="Project root, default is current directory"
+    ),
+):
+    """
+    跑检索基准测试（默认使用确定性 embedding 桩，可离线运行）
+    """
+    from .embedder import Embedder
+    from .bench import (
+        HashEmbedder,
+        compare_results,
+        load_results,
+        parse_size,
+        run_bench,
+        save_results,
+    )
+
+    if index_type not in INDEX_TYPES:
+        raise typer.BadParameter(
+            f"--index-type must be one of: {', '.join(INDEX_TYPES)}"
+        )
+    try:
+        size_list = [parse_size(x) for x in sizes.split(",") if x.strip()]
+    except ValueError as e:
+        raise typer.BadParameter(str(e))
+
+    paths = KBPaths(root or Path.cwd())
+    embedder = Embedder(model_name=model) if model else HashEmbedder()
+    results = run_bench(
+        size_list,
+        embedder,
+        num_queries=queries,
+        seed=seed,
+        index_type=index_type,
+        work_dir=work_dir,
+        keep=keep,
+        log=lambda msg: console.print(f"[dim]{msg}[/dim]"),
+    )
+
+    for run in results["runs"]:
+        table = Table(title=f"{run['num_chunks']} chunks / {run['num_files']} files")
+        table.add_column("Stage", style="cyan", no_wrap=True)
+        for col in ("Calls", "p50 ms", "p95 ms", "p99 ms", "items/s", "Peak RSS MB"):
+            table.add_column(col, justify="right")
+        for name, st in run["stages"].items():
+            rss = st["peak_rss_mb"]
+            table.add_row(
+                name,
+                str(st["calls"]),
+                f"{st['p50_ms']:.3f}",
+                f"{st['p95_ms']:.3f}",
+                f"{st['p99_ms']:.3f}",
+                f"{st['throughput']:.1f}",
+                "-" if rss is None else f"{rss:.0f}",
+            )
+        console.print(table)
+
+    stamp = results["created"].replace(":", "").replace("-", "")[:15]
+    out = out or paths.kb_root / "bench" / f"bench-{stamp}.json"
+    save_results(results, out)
+    console.print(f"[green]OK[/green] Results written to {out}")
+
+    if compare is not None:
+        regressions = compare_results(load_results(compare), results, threshold)
+        if not regressions:
+            console.print(f"[green]OK[/green] No regressions vs {compare}")
+            return
+        for r in regressions:
+            console.print(
+                f"[red]REGRESSION[/red] size={r.size} {r.stage} {r.metric}: "
+                f"{r.baseline:.3f} -> {r.current:.3f} ({r.ratio:.2f}x)"
+            )
+        raise typer.Exit(code=1)
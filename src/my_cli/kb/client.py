@@ -0,0 +1,92 @@
+from __future__ import annotations
+import json
+import urllib.error
+import urllib.request
+from typing import Any, Dict, List, Optional
+
+from .paths import KBPaths
+from .pack import RetrievalHit, hit_from_dict
+from .timing import current_recorder, span
+
+# kb serve 的客户端
+# 只用标准库 urllib：转发请求时不需要导入模型/FAISS，命令行启动保持轻量
+# 服务没有运行、连接失败或返回错误时一律返回 None，由调用方退回进程内检索
+
+# 本地回环连接，超时给短一点；检索本身在服务端通常是毫秒级
+_CONNECT_TIMEOUT = 0.5
+_REQUEST_TIMEOUT = 30.0
+
+
+def _server_url(paths: KBPaths) -> Optional[str]:
+    try:
+        info = json.loads(paths.serve_json.read_text(encoding="utf-8"))
+        return f"http://{info['host']}:{int(info['port'])}"
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def server_available(paths: KBPaths) -> bool:
+    url = _server_url(paths)
+    if url is None:
+        return False
+    try:
+        with urllib.request.urlopen(f"{url}/health", timeout=_CONNECT_TIMEOUT) as r:
+            return r.status == 200
+    except (OSError, urllib.error.URLError):
+        return False
+
+
+def _post(paths: KBPaths, route: str, payload: Dict[str, Any]) -> Optional[Any]:
+    url = _server_url(paths)
+    if url is None or not server_available(paths):
+        return None
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    req = urllib.request.Request(
+        f"{url}{route}",
+        data=body,
+        headers={"Content-Type": "application/json; charset=utf-8"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=_REQUEST_TIMEOUT) as r:
+            return json.loads(r.read())
+    except (OSError, ValueError, urllib.error.URLError):
+        return None
+
+
+def remote_retrieve(
+    paths: KBPaths,
+    query: str,
+    topk: int = 8,
+    namespaces: Optional[List[str]] = None,
+) -> Optional[List[RetrievalHit]]:
+    rec = current_recorder()
+    start = rec.elapsed() if rec is not None else 0.0
+    with span("remote_retrieve") as s:
+        obj = _post(
+            paths, "/retrieve", {"query": query, "topk": topk, "namespaces": namespaces}
+        )
+        if obj is None:
+            s.set(ok=False)
+            return None
+    # 服务端的阶段挂在 remote_retrieve 下面
+    if rec is not None and obj.get("timings"):
+        rec.add_remote(obj["timings"], offset=start, depth=1)
+    return [hit_from_dict(h) for h in obj.get("hits", [])]
+
+
+# 一组查询一次请求;服务不可用时返回 None
+def remote_retrieve_many(
+    paths: KBPaths,
+    queries: List[str],
+    topk: int = 8,
+    namespaces: Optional[List[str]] = None,
+) -> Optional[List[List[RetrievalHit]]]:
+    obj = _post(
+        paths,
+        "/retrieve_many",
+        {"queries": queries, "topk": topk, "namespaces": namespaces},
+    )
+    if obj is None:
+        return None
+    return [[hit_from_dict(h) for h in hits] for hits in obj.get("results", [])]
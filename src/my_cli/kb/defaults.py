@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+# kb 各模块共用的默认值
+# 单独放在这个只依赖标准库的模块里：命令行在定义参数默认值时要用到它们，
+# 而定义它们的模块（embedder / index / build / pack）会导入 torch、faiss、numpy 等重依赖
+
+# 默认 embedding 模型
+DEFAULT_MODEL = "intfloat/multilingual-e5-small"
+
+# embedding 推理后端（kb build --backend）
+#   torch - sentence-transformers + PyTorch，参考实现
+#   onnx  - 同一模型导出的 ONNX 图，ONNX Runtime 推理，可选 int8 量化（需要 onnxruntime）
+EMBED_BACKENDS = ("torch", "onnx")
+# 量化向量与参考实现的最小余弦相似度低于该值时 kb build 给出警告
+PARITY_THRESHOLD = 0.98
+# 一致性检查抽样的 chunk 数
+PARITY_SAMPLES = 64
+
+# 可选的索引类型（kb build --index-type）
+#   flat     - IndexFlatIP 精确检索，小规模知识库默认值
+#   ivf-flat - 倒排聚类 + 原始向量，按 nprobe 只扫描部分簇
+#   ivf-pq   - 倒排聚类 + 乘积量化，向量压缩到 pq_m 字节左右，适合几十万以上规模
+#   hnsw     - 图索引，查询快、无需训练，但不支持删除（增量构建遇到删除会全量重建）
+INDEX_TYPES = ("flat", "ivf-flat", "ivf-pq", "hnsw")
+
+# 切块（kb build --chunk-tokens / --chunk-overlap）
+#   每个 chunk 的 token 上限（按字符估算，含特殊 token），留出 "passage: " 前缀的余量，不超过模型的 512
+CHUNK_TOKENS = 384
+# 同一节内相邻 chunk 的重叠 token 数：下一块以上一块结尾的几句话开头
+CHUNK_OVERLAP = 32
+
+# 全量构建近似索引时评估 recall@RECALL_K
+RECALL_K = 10
+# 每批向量化的 chunk 数：切块与向量化交替进行，峰值内存由它决定
+EMBED_BATCH = 256
+# 单次模型推理的 token 预算（批大小 × 批内最长文本的 token 数，即 padding 后的总量）
+EMBED_TOKEN_BUDGET = 8192
+
+# 知识库快照（kb build 每次写入新快照再原子切换）
+#   被替换下来的快照保留的秒数：正在读取旧快照的查询 / kb serve 有足够时间切换
+SNAPSHOT_GRACE = 10 * 60
+#   构建中途失败、一直没有发布的快照保留的秒数
+SNAPSHOT_ABANDONED = 24 * 60 * 60
+
+# kb watch
+#   最后一次变化后等待的秒数（一批连续变化只构建一次）
+WATCH_DEBOUNCE = 1.0
+#   持续有变化时最长等待的秒数
+WATCH_MAX_WAIT = 30.0
+#   轮询模式（没有 inotify 时）扫描 raw 目录的间隔秒数
+WATCH_POLL_INTERVAL = 1.0
+
+# 批量检索时每组查询的数量(一组查询一次 encode、一次 FAISS 搜索)
+QUERY_BATCH = 64
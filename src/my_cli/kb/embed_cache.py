@@ -0,0 +1,296 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import re
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# 持久化 embedding 缓存
+# key = hash(模型名 + 带前缀的文本)，value = 归一化后的 float32 向量
+# 每个模型一个子目录：
+#   vectors.f32 - (N, dim) float32 矩阵，直接 memmap，不整体读入内存
+#   keys.npy    - (N,) 16 字节摘要，与 vectors 行对齐（紧凑的 key 索引）
+#   stamps.npy  - (N,) int64 最近使用时间戳(逻辑时钟)，用于 LRU 淘汰
+#   meta.json   - dim / 行数 / 时钟
+#   .lock       - 写入锁
+# 内容不变的 chunk（切分支、无关改动后重建、多个 namespace 出现同样内容）都直接命中缓存
+#
+# 多个进程（kb build、kb query、kb serve、kb watch）共用同一份缓存：
+#   - 写入（flush）持有 .lock 排他锁，锁内重新读取磁盘上的 keys/meta，在 vectors.f32 的实际末尾追加，
+#     再写回 keys/stamps/meta；vectors.f32 只追加或整体替换（淘汰），从不截断，
+#     其他进程已经 memmap 的行一直有效
+#   - 读取在锁内一次性读入 keys/meta 并映射矩阵，之后只用这份一致的视图
+#   - 命中只更新内存里的时间戳，下一次写入新向量时一并落盘，纯查询不重写 keys/stamps
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# 超过上限时淘汰到上限的这个比例，避免每次写入都触发整理
+_EVICT_TARGET = 0.8
+_KEY_DTYPE = "S16"
+# 行号没有登记 key 的行（异常退出留下的半截写入）用的占位 key，时间戳为 0，最先被淘汰
+_NO_KEY = bytes(16)
+
+
+# 跨进程的排他文件锁
+@contextmanager
+def _file_lock(path: Path) -> Iterator[None]:
+    with path.open("a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+
+            while True:
+                try:
+                    # LK_LOCK 重试 10 秒后报错，继续等
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _model_slug(model_name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "__", model_name)
+
+
+class EmbeddingCache:
+    def __init__(
+        self, root: Path, model_name: str, max_bytes: int = DEFAULT_MAX_BYTES
+    ) -> None:
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        self.dir = root / _model_slug(model_name)
+        self._vectors_path = self.dir / "vectors.f32"
+        self._keys_path = self.dir / "keys.npy"
+        self._stamps_path = self.dir / "stamps.npy"
+        self._meta_path = self.dir / "meta.json"
+        self._lock_path = self.dir / ".lock"
+
+        self.dim: Optional[int] = None
+        self.clock = 0
+        self._keys = np.empty(0, dtype=_KEY_DTYPE)
+        self._stamps = np.empty(0, dtype="int64")
+        self._rows: Optional[Dict[bytes, int]] = None
+        self._vectors: Optional[np.ndarray] = None
+        # 等待 flush 写入的新向量、本进程命中过的 key -> 时间戳
+        self._pending: Dict[bytes, np.ndarray] = {}
+        self._touched: Dict[bytes, int] = {}
+        if self._meta_path.exists():
+            with _file_lock(self._lock_path):
+                self._load()
+
+    def __len__(self) -> int:
+        return int(self._keys.shape[0])
+
+    @property
+    def nbytes(self) -> int:
+        return len(self) * (self.dim or 0) * 4
+
+    def key(self, text: str) -> bytes:
+        data = f"{self.model_name}\n{text}".encode("utf-8")
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def _row_bytes(self) -> int:
+        return (self.dim or 0) * 4
+
+    # 读入磁盘上的 keys/stamps/meta 并映射矩阵（持有锁时调用）
+    def _load(self) -> None:
+        self._keys = np.empty(0, dtype=_KEY_DTYPE)
+        self._stamps = np.empty(0, dtype="int64")
+        self._rows = None
+        self._vectors = None
+        try:
+            meta = json.loads(self._meta_path.read_text(encoding="utf-8"))
+            keys = np.load(self._keys_path)
+            stamps = np.load(self._stamps_path)
+            size = self._vectors_path.stat().st_size
+        except (OSError, ValueError):
+            # 缓存损坏时直接当成空缓存，下次写入会重建
+            return
+        count = int(meta.get("count", 0))
+        dim = meta.get("dim")
+        if keys.shape[0] < count or stamps.shape[0] < count:
+            return
+        if not dim or size < count * dim * 4:
+            return
+        self.dim = int(dim)
+        self.clock = max(self.clock, int(meta.get("clock", 0)))
+        self._keys = keys[:count]
+        self._stamps = stamps[:count].copy()
+        self._map()
+
+    def _map(self) -> None:
+        self._vectors = None
+        if len(self):
+            self._vectors = np.memmap(
+                self._vectors_path,
+                dtype="float32",
+                mode="r",
+                shape=(len(self), self.dim),
+            )
+
+    def _row_map(self) -> Dict[bytes, int]:
+        if self._rows is None:
+            # numpy 的定长 bytes 取出时会去掉末尾的 \0，补齐后才能和 key() 比较
+            self._rows = {
+                k.ljust(16, b"\0"): i for i, k in enumerate(self._keys.tolist())
+            }
+        return self._rows
+
+    # 查询缓存：返回 (命中的 {下标: 向量}, 未命中的下标列表)
+    def lookup(self, texts: List[str]) -> Tuple[Dict[int, np.ndarray], List[int]]:
+        self.clock += 1
+        hits: Dict[int, np.ndarray] = {}
+        missing: List[int] = []
+        rows = self._row_map()
+        for i, t in enumerate(texts):
+            k = self.key(t)
+            row = rows.get(k)
+            if row is not None:
+                hits[i] = np.array(self._vectors[row])
+                self._stamps[row] = self.clock
+                self._touched[k] = self.clock
+            elif k in self._pending:
+                hits[i] = self._pending[k].copy()
+            else:
+                missing.append(i)
+        return hits, missing
+
+    # 登记新向量，flush 时写入（同一批内重复的文本只写一次）
+    def store(self, texts: List[str], vectors: np.ndarray) -> None:
+        if not texts:
+            return
+        vectors = np.ascontiguousarray(vectors, dtype="float32")
+        if self.dim is not None and vectors.shape[1] != self.dim:
+            raise ValueError(
+                f"embedding dim {vectors.shape[1]} does not match cache dim {self.dim}"
+            )
+        rows = self._row_map()
+        for t, v in zip(texts, vectors):
+            k = self.key(t)
+            if k not in rows:
+                self._pending.setdefault(k, v)
+
+    # 在 vectors.f32 的实际末尾追加，返回第一行的行号（持有锁时调用）
+    # 不完整的末行先补零，凑齐整行
+    def _append(self, vectors: np.ndarray) -> int:
+        row_bytes = self._row_bytes()
+        with self._vectors_path.open("ab") as f:
+            size = f.seek(0, os.SEEK_END)
+            rows, rest = divmod(size, row_bytes)
+            if rest:
+                f.write(bytes(row_bytes - rest))
+                rows += 1
+            f.write(vectors.tobytes())
+        return rows
+
+    # 超过容量上限时按 LRU 淘汰：保留最近使用的行，重写矩阵文件（持有锁时调用）
+    def _evict(self) -> None:
+        if self.nbytes <= self.max_bytes or not self.dim:
+            return
+        keep_n = int(self.max_bytes * _EVICT_TARGET) // self._row_bytes()
+        # 按时间戳降序，时间戳相同时优先保留后写入的行
+        order = np.lexsort((-np.arange(len(self)), -self._stamps))
+        keep = np.sort(order[:keep_n])
+
+        mat = self._vectors
+        tmp = self._vectors_path.with_suffix(".tmp")
+        with tmp.open("wb") as f:
+            for start in range(0, keep.shape[0], 4096):
+                f.write(np.asarray(mat[keep[start : start + 4096]]).tobytes())
+        # 释放 memmap 后再替换文件（Windows 下被映射的文件无法覆盖）
+        # 其他进程仍在映射时替换失败，这次不淘汰
+        del mat
+        self._vectors = None
+        try:
+            os.replace(tmp, self._vectors_path)
+        except PermissionError:
+            tmp.unlink(missing_ok=True)
+            self._map()
+            return
+
+        self._keys = self._keys[keep]
+        self._stamps = self._stamps[keep]
+        self._rows = None
+        self._map()
+
+    # 把新向量写入磁盘：锁内重新读取磁盘上的状态，追加本进程新算出的向量，
+    # 合并本进程命中的时间戳，必要时淘汰，最后写 keys/stamps/meta
+    # 只有时间戳变化时不写（随下一次写入一起落盘）
+    def flush(self) -> None:
+        if not self._pending:
+            return
+        self.dir.mkdir(parents=True, exist_ok=True)
+        with _file_lock(self._lock_path):
+            self._load()
+            pending = self._pending
+            self._pending = {}
+            dim = int(next(iter(pending.values())).shape[0])
+            if self.dim is None:
+                self.dim = dim
+            elif dim != self.dim:
+                raise ValueError(
+                    f"embedding dim {dim} does not match cache dim {self.dim}"
+                )
+
+            rows = self._row_map()
+            new_keys = [k for k in pending if k not in rows]
+            for k, stamp in self._touched.items():
+                row = rows.get(k)
+                if row is not None:
+                    self._stamps[row] = max(int(self._stamps[row]), stamp)
+            self._touched = {}
+            if new_keys:
+                first = self._append(np.stack([pending[k] for k in new_keys]))
+                gap = first - len(self)
+                self._keys = np.concatenate(
+                    [
+                        self._keys,
+                        np.full(gap, _NO_KEY, dtype=_KEY_DTYPE),
+                        np.array(new_keys, dtype=_KEY_DTYPE),
+                    ]
+                )
+                self._stamps = np.concatenate(
+                    [
+                        self._stamps,
+                        np.zeros(gap, dtype="int64"),
+                        np.full(len(new_keys), self.clock, dtype="int64"),
+                    ]
+                )
+                self._rows = None
+                self._map()
+                self._evict()
+
+            # 先写 keys/stamps，最后写 meta：meta 中的 count 决定哪些行有效
+            for path, arr in (
+                (self._keys_path, self._keys),
+                (self._stamps_path, self._stamps),
+            ):
+                tmp = path.with_suffix(".tmp.npy")
+                np.save(tmp, arr)
+                os.replace(tmp, path)
+            meta = {
+                "model": self.model_name,
+                "dim": self.dim,
+                "count": len(self),
+                "clock": self.clock,
+            }
+            tmp = self._meta_path.with_suffix(".tmp")
+            tmp.write_text(
+                json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8"
+            )
+            os.replace(tmp, self._meta_path)
@@ -1,32 +1,173 @@
 from __future__ import annotations
-from dataclasses import dataclass
-from typing import List
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
 import numpy as np
 
-# 本地 embedding（sentence-transformers）
-from sentence_transformers import SentenceTransformer
+from .defaults import DEFAULT_MODEL, EMBED_TOKEN_BUDGET
+from .embed_cache import EmbeddingCache
+from .timing import span
+
+# 本地 embedding：推理后端见 backends.py（torch / onnx）
+# 后端会连带导入 torch 或 onnxruntime（数秒），推迟到第一次真正需要推理时
+if TYPE_CHECKING:
+    from .backends import EmbeddingBackend
 
 # 这个文件负责把文本转成向量（embedding），给 FAISS 检索用
 
 
+# 推理吞吐统计（累计）：tokens 为真实 token 数，padded_tokens 为补齐到批内最长后的总量
+@dataclass
+class EncodeStats:
+    texts: int = 0
+    batches: int = 0
+    tokens: int = 0
+    padded_tokens: int = 0
+    seconds: float = 0.0
+
+    @property
+    def tokens_per_s(self) -> float:
+        return self.tokens / self.seconds if self.seconds > 0 else 0.0
+
+    # padding 占模型实际处理 token 的比例
+    @property
+    def padding_ratio(self) -> float:
+        if not self.padded_tokens:
+            return 0.0
+        return 1 - self.tokens / self.padded_tokens
+
+
 @dataclass
 class Embedder:
     # 使用的模型名称
-    model_name: str = "intfloat/multilingual-e5-small"
+    model_name: str = DEFAULT_MODEL
+    # 可选的持久化 embedding 缓存目录（.myspec/kb/embed_cache），None 表示不缓存
+    cache_dir: Optional[Path] = None
+    # 推理后端："torch" | "onnx"
+    backend: str = "torch"
+    # 仅 onnx：使用 int8 动态量化模型
+    quantize: bool = False
+    # 推理线程数，None 使用后端默认值
+    threads: Optional[int] = None
+    # 每批推理的文本数上限，None 只受 token 预算限制
+    batch_size: Optional[int] = None
+    # 每批推理的 token 预算（条数 × 批内最长 token 数）
+    token_budget: int = EMBED_TOKEN_BUDGET
+    # 导出的 ONNX 模型根目录（.myspec/kb/onnx），onnx 后端必填
+    onnx_dir: Optional[Path] = None
+    cache: Optional[EmbeddingCache] = field(default=None, init=False, repr=False)
+    stats: EncodeStats = field(default_factory=EncodeStats, init=False, repr=False)
 
-    # 对象创建后自动加载模型
     def __post_init__(self) -> None:
-        # 加载 SentenceTransformer 文本向量模型
-        self.model = SentenceTransformer(self.model_name)
+        # 模型在第一次真正需要推理时才加载：缓存全部命中时完全不用加载权重
+        self._model: Optional[EmbeddingBackend] = None
+        if self.cache_dir is not None:
+            # 量化后的向量与原模型不同，缓存按 model_id 分开
+            self.cache = EmbeddingCache(self.cache_dir, self.model_id)
+
+    # 向量的“身份”：同一模型的 torch 与 onnx fp32 输出一致，可以共用缓存和索引；int8 不行
+    @property
+    def model_id(self) -> str:
+        return f"{self.model_name}#int8" if self.quantize else self.model_name
+
+    @property
+    def model(self) -> EmbeddingBackend:
+        if self._model is None:
+            with span("model_load", model=self.model_name, backend=self.backend):
+                from .backends import create_backend
+
+                model_dir = None
+                if self.onnx_dir is not None:
+                    model_dir = self.onnx_dir / self.model_name.replace("/", "__")
+                self._model = create_backend(
+                    self.backend,
+                    self.model_name,
+                    model_dir=model_dir,
+                    quantize=self.quantize,
+                    threads=self.threads,
+                )
+        return self._model
+
+    # 写入 index_meta.json 的推理配置，检索时据此构造同样的 Embedder
+    def meta(self) -> Dict[str, Any]:
+        return {"backend": self.backend, "quantize": self.quantize}
 
-    # 批量把文本转成向量
+    # 批量把文本转成向量（先查缓存，只对未命中的文本做推理）
     def encode(self, texts: List[str]) -> np.ndarray:
-        # 归一化后用内积检索≈余弦相似度，效果更稳定
-        vecs = self.model.encode(
-            texts,
-            batch_size=32,
-            show_progress_bar=False,
-            normalize_embeddings=True,
+        if self.cache is None or not texts:
+            with span("embed", texts=len(texts), cache_hits=0):
+                return self._encode(texts)
+
+        with span("embed", texts=len(texts)) as s:
+            hits, missing = self.cache.lookup(texts)
+            s.set(cache_hits=len(hits))
+            if missing:
+                computed = self._encode([texts[i] for i in missing])
+                self.cache.store([texts[i] for i in missing], computed)
+            self.cache.flush()
+
+        if not missing:
+            return np.stack([hits[i] for i in range(len(texts))]).astype("float32")
+        out = np.empty((len(texts), computed.shape[1]), dtype="float32")
+        out[missing] = computed
+        for i, v in hits.items():
+            out[i] = v
+        return out
+
+    # 长度分桶的动态批：按 token 数排序、在 token 预算内成批推理，结果按原顺序写回
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        from .backends import MAX_BATCH, plan_batches
+
+        model = self.model
+        lengths = model.token_lengths(texts)
+        batches = plan_batches(
+            lengths, self.token_budget, max_batch=self.batch_size or MAX_BATCH
         )
-        # 确保返回 float32 类型，FAISS 要求
-        return np.asarray(vecs, dtype="float32")
+        out: Optional[np.ndarray] = None
+        padded = 0
+        with span("encode_batches", batches=len(batches)) as s:
+            t0 = time.perf_counter()
+            for idx in batches:
+                vecs = model.encode([texts[i] for i in idx], batch_size=len(idx))
+                if out is None:
+                    out = np.empty((len(texts), vecs.shape[1]), dtype="float32")
+                out[idx] = vecs
+                padded += len(idx) * max(lengths[i] for i in idx)
+            seconds = time.perf_counter() - t0
+            tokens = sum(lengths)
+            s.set(tokens=tokens, padded_tokens=padded)
+
+        st = self.stats
+        st.texts += len(texts)
+        st.batches += len(batches)
+        st.tokens += tokens
+        st.padded_tokens += padded
+        st.seconds += seconds
+        if out is None:
+            return np.zeros((0, 0), dtype="float32")
+        return out
+
+    # 量化一致性检查：用参考实现（torch fp32）重新编码样本，返回与给定向量的最小余弦相似度
+    def parity(self, texts: List[str], vectors: np.ndarray) -> float:
+        from .backends import parity_cosine
+
+        reference = Embedder(model_name=self.model_name, threads=self.threads)
+        with span("parity_check", texts=len(texts)):
+            return parity_cosine(reference._encode(texts), vectors)
+
+
+# 按 index_meta.json 记录的模型和后端构造 Embedder：查询向量与索引向量出自同一套推理配置
+def embedder_for_index(
+    meta: Dict[str, Any],
+    cache_dir: Optional[Path] = None,
+    onnx_dir: Optional[Path] = None,
+    model: Optional[str] = None,
+) -> Embedder:
+    return Embedder(
+        model_name=model or meta.get("model", DEFAULT_MODEL),
+        cache_dir=cache_dir,
+        backend=meta.get("backend", "torch"),
+        quantize=bool(meta.get("quantize", False)),
+        onnx_dir=onnx_dir,
+    )
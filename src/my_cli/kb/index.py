@@ -1,13 +1,17 @@
 from __future__ import annotations
 import json
+import math
+import os
 from dataclasses import asdict
 from pathlib import Path
-from typing import Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 import faiss
 
 from .chunker import Chunk
+from .defaults import INDEX_TYPES
+from .timing import span, file_bytes
 
 # 负责保存/加载文本分块数据，以及构建、保存、加载 FAISS 向量索引
 
@@ -26,7 +30,10 @@ def load_chunks_jsonl(path: Path) -> List[Chunk]:
     chunks: List[Chunk] = []
     if not path.exists():
         return chunks
-    with path.open("r", encoding="utf-8") as f:
+    with (
+        span("load_chunks_jsonl", bytes=file_bytes(path)),
+        path.open("r", encoding="utf-8") as f,
+    ):
         for line in f:
             obj = json.loads(line)
             if "namespace" not in obj:
@@ -35,20 +42,165 @@ def load_chunks_jsonl(path: Path) -> List[Chunk]:
     return chunks
 
 
-# 用向量 vectors 创建 FAISS 索引，这里使用 IndexFlatIP（内积检索）要求输入向量是归一化过的（这样内积≈余弦相似度）
-def build_faiss_index(vectors: np.ndarray) -> faiss.Index:
+# chunk_id 是 sha1 的十六进制前缀，取前 15 位（60bit）转成 int64，作为 FAISS 中的向量 ID
+def faiss_id(chunk_id: str) -> int:
+    return int(chunk_id[:15], 16)
+
+
+def faiss_ids(chunk_ids: List[str]) -> np.ndarray:
+    return np.asarray([faiss_id(cid) for cid in chunk_ids], dtype="int64")
+
+
+# 每个聚类中心/码本至少需要的训练样本数（FAISS 建议 30~256）
+_MIN_POINTS_PER_CENTROID = 39
+_TRAIN_POINTS_PER_CENTROID = 64
+_MAX_TRAIN_SAMPLES = 200_000
+
+
+def supports_remove(index_type: str) -> bool:
+    return index_type != "hnsw"
+
+
+# 按数据规模自动选择索引参数，结果写入 index_meta.json，检索时据此配置索引
+def choose_index_params(index_type: str, n: int, dim: int) -> Dict[str, Any]:
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"unknown index type: {index_type}")
+    params: Dict[str, Any] = {"index_type": index_type}
+    if index_type.startswith("ivf"):
+        # 经验值 nlist ≈ 4·sqrt(N)，同时保证每个簇有足够的训练样本
+        nlist = int(4 * math.sqrt(max(n, 1)))
+        nlist = max(1, min(nlist, n // _MIN_POINTS_PER_CENTROID))
+        params["nlist"] = nlist
+        params["nprobe"] = min(nlist, max(16, nlist // 10))
+    if index_type == "ivf-pq":
+        # 每个子量化器负责约 8 维；码本位数受训练样本数限制
+        params["pq_m"] = max(
+            d for d in range(1, dim + 1) if dim % d == 0 and d <= max(1, dim // 8)
+        )
+        params["pq_nbits"] = min(
+            8, max(1, int(math.log2(max(2, n // _MIN_POINTS_PER_CENTROID))))
+        )
+    if index_type == "hnsw":
+        params["hnsw_m"] = 32
+        params["ef_construction"] = 80
+        params["ef_search"] = 64
+    return params
+
+
+# 随机（固定种子，构建可复现）抽取训练样本
+def _train_sample(vectors: np.ndarray, params: Dict[str, Any]) -> np.ndarray:
+    want = params.get("nlist", 1) * _TRAIN_POINTS_PER_CENTROID
+    if "pq_nbits" in params:
+        want = max(want, (1 << params["pq_nbits"]) * _TRAIN_POINTS_PER_CENTROID)
+    want = min(want, _MAX_TRAIN_SAMPLES)
+    if vectors.shape[0] <= want:
+        return vectors
+    rng = np.random.default_rng(0)
+    rows = np.sort(rng.choice(vectors.shape[0], size=want, replace=False))
+    return np.ascontiguousarray(vectors[rows])
+
+
+# 用向量 vectors 创建 FAISS 索引，统一使用内积（要求输入向量是归一化过的，这样内积≈余弦相似度）
+# 向量按 chunk_id 派生的 ID 寻址，增量构建时可以按 ID 删除/追加：
+#   IVF 原生支持自定义 ID；flat / hnsw 外面包一层 IndexIDMap2
+def build_faiss_index(
+    vectors: np.ndarray,
+    chunk_ids: List[str],
+    params: Optional[Dict[str, Any]] = None,
+) -> faiss.Index:
     """
-    vectors: (N, dim), 已 normalize，适合 IndexFlatIP
+    vectors: (N, dim), 已 normalize
+    chunk_ids: 与 vectors 行对齐
+    params: choose_index_params() 的结果，None 表示 flat
     """
     if vectors.ndim != 2:
         raise ValueError("vectors must be 2D array")
+    if len(chunk_ids) != vectors.shape[0]:
+        raise ValueError("chunk_ids must align with vectors")
     dim = vectors.shape[1]
-    # 不做压缩/聚类，保存全部向量，用内积做精确相似度检索，适合小规模知识库
-    index = faiss.IndexFlatIP(dim)
-    index.add(vectors)
+    params = params or {"index_type": "flat"}
+    index_type = params["index_type"]
+    ip = faiss.METRIC_INNER_PRODUCT
+
+    if index_type == "flat":
+        # 不做压缩/聚类，保存全部向量，用内积做精确相似度检索，适合小规模知识库
+        index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+    elif index_type == "hnsw":
+        hnsw = faiss.IndexHNSWFlat(dim, params["hnsw_m"], ip)
+        hnsw.hnsw.efConstruction = params["ef_construction"]
+        index = faiss.IndexIDMap2(hnsw)
+    else:
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "ivf-flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, params["nlist"], ip)
+        else:
+            index = faiss.IndexIVFPQ(
+                quantizer, dim, params["nlist"], params["pq_m"], params["pq_nbits"], ip
+            )
+        index.train(_train_sample(vectors, params))
+
+    index.add_with_ids(vectors, faiss_ids(chunk_ids))
+    configure_index(index, params)
     return index
 
 
+# 设置查询期参数（nprobe / efSearch）
+def configure_index(index: faiss.Index, params: Dict[str, Any]) -> None:
+    if "nprobe" in params:
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            ivf.nprobe = int(params["nprobe"])
+    if "ef_search" in params and isinstance(index, faiss.IndexIDMap2):
+        inner = faiss.downcast_index(index.index)
+        if isinstance(inner, faiss.IndexHNSW):
+            inner.hnsw.efSearch = int(params["ef_search"])
+
+
+# 用精确内积检索做基准，评估近似索引的 recall@k（查询取自库内随机向量）
+def recall_at_k(
+    index: faiss.Index,
+    vectors: np.ndarray,
+    chunk_ids: List[str],
+    k: int = 10,
+    num_queries: int = 200,
+) -> float:
+    n = vectors.shape[0]
+    if n == 0:
+        return 1.0
+    k = min(k, n)
+    rng = np.random.default_rng(0)
+    rows = rng.choice(n, size=min(num_queries, n), replace=False)
+    queries = np.ascontiguousarray(vectors[rows])
+    # faiss.knn 直接暴力计算，不额外复制一份 flat 索引
+    _, exact_rows = faiss.knn(queries, vectors, k, metric=faiss.METRIC_INNER_PRODUCT)
+    ids = faiss_ids(chunk_ids)
+    _, approx = index.search(queries, k)
+    hit = 0
+    for truth, got in zip(exact_rows, approx):
+        hit += len(set(ids[truth].tolist()) & set(got.tolist()))
+    return hit / float(k * len(rows))
+
+
+# 旧版本构建的索引是裸 IndexFlatIP，search 返回的是行号而不是 chunk 的 ID
+def is_id_mapped(index: faiss.Index) -> bool:
+    return isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2, faiss.IndexIVF))
+
+
+# 增量更新：删除已失效 chunk 的向量，再追加新 chunk 的向量
+def update_faiss_index(
+    index: faiss.Index,
+    remove_chunk_ids: List[str],
+    vectors: np.ndarray,
+    add_chunk_ids: List[str],
+) -> int:
+    removed = 0
+    if remove_chunk_ids:
+        removed = index.remove_ids(faiss_ids(remove_chunk_ids))
+    if add_chunk_ids:
+        index.add_with_ids(vectors, faiss_ids(add_chunk_ids))
+    return int(removed)
+
+
 # 先尝试 faiss.write_index() 直接写文件
 # 如果失败（Windows 中文路径常见问题），就改用 faiss.serialize_index() 得到字节，再手动写入文件
 def save_index(index: faiss.Index, index_path: Path) -> None:
@@ -64,7 +216,25 @@ def save_index(index: faiss.Index, index_path: Path) -> None:
 # 先尝试 faiss.read_index() 读取，失败时读取字节并用 faiss.deserialize_index() 还原
 # 这里用 np.frombuffer(..., dtype="uint8")
 # 是为了满足 FAISS 反序列化对输入类型的要求
-def load_index(index_path: Path) -> faiss.Index:
+#
+# mmap=True 时以只读 + 内存映射方式打开（查询路径使用）：
+#   IO_FLAG_MMAP     - IVF 的倒排表直接映射文件
+#   IO_FLAG_MMAP_IFC - Flat 向量存储直接映射文件（较新的 FAISS 才有）
+# 打开几 GB 的索引只产生实际访问到的页的缺页开销，多个 kb 进程共享同一份 page cache。
+# 映射出来的索引不可修改，增量构建需要用 mmap=False 打开。
+def load_index(index_path: Path, mmap: bool = False) -> faiss.Index:
+    with span("load_index", bytes=file_bytes(index_path), mmap=mmap):
+        return _read_index(index_path, mmap)
+
+
+def _read_index(index_path: Path, mmap: bool) -> faiss.Index:
+    if mmap:
+        flags = faiss.IO_FLAG_READ_ONLY | faiss.IO_FLAG_MMAP
+        flags |= getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        try:
+            return faiss.read_index(str(index_path), flags)
+        except Exception:
+            pass
     try:
         return faiss.read_index(str(index_path))
     except Exception:
@@ -72,6 +242,104 @@ def load_index(index_path: Path) -> faiss.Index:
         return faiss.deserialize_index(np.frombuffer(data, dtype="uint8"))
 
 
+# flat 索引的 NumPy 备选实现：向量矩阵保存为 .npy（行与 chunk 存储对齐），
+# np.load(mmap_mode="r") 打开后分块做矩阵乘 + argpartition 取 topk。
+# 不依赖 FAISS 的 mmap 支持（旧版本 FAISS、Windows 中文路径下 read_index 失败时也能零拷贝打开）。
+class NumpyFlatIndex:
+    # 每块处理的行数，控制临时得分矩阵的内存
+    BLOCK_ROWS = 65536
+
+    def __init__(self, vectors: np.ndarray) -> None:
+        self.vectors = vectors
+
+    @property
+    def ntotal(self) -> int:
+        return int(self.vectors.shape[0])
+
+    # 与 faiss.Index.search 相同的返回格式: (scores, ids)，这里的 id 就是行号
+    # rows 不为 None 时只扫描这些行（命名空间过滤），开销与子集大小成正比
+    def search(
+        self, queries: np.ndarray, k: int, rows: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        nq = queries.shape[0]
+        n = self.ntotal if rows is None else int(rows.shape[0])
+        k = min(k, n)
+        best_s = np.empty((nq, 0), dtype="float32")
+        best_i = np.empty((nq, 0), dtype="int64")
+        for start in range(0, n, self.BLOCK_ROWS):
+            if rows is None:
+                block = np.asarray(self.vectors[start : start + self.BLOCK_ROWS])
+                ids = np.arange(start, start + block.shape[0], dtype="int64")
+            else:
+                ids = rows[start : start + self.BLOCK_ROWS]
+                block = np.asarray(self.vectors[ids])
+            s = queries @ block.T
+            i = np.broadcast_to(ids, s.shape)
+            s = np.concatenate([best_s, s], axis=1)
+            i = np.concatenate([best_i, i], axis=1)
+            if s.shape[1] > k:
+                part = np.argpartition(-s, k - 1, axis=1)[:, :k]
+                s = np.take_along_axis(s, part, axis=1)
+                i = np.take_along_axis(i, part, axis=1)
+            best_s, best_i = s, i
+        order = np.argsort(-best_s, axis=1, kind="stable")
+        return (
+            np.take_along_axis(best_s, order, axis=1).astype("float32"),
+            np.take_along_axis(best_i, order, axis=1),
+        )
+
+
+# 只在给定的向量 ID 集合内检索（FAISS IDSelector，命名空间过滤），返回格式同 index.search
+# 过滤条件很窄时近似索引可能凑不满 k 个：此时 IVF 扫描全部簇、HNSW 放大 efSearch 再查一次
+def search_subset(
+    index: faiss.Index, queries: np.ndarray, k: int, ids: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    sel = faiss.IDSelectorBatch(np.ascontiguousarray(ids, dtype="int64"))
+    ivf = faiss.try_extract_index_ivf(index)
+    hnsw = None
+    if isinstance(index, faiss.IndexIDMap2):
+        inner = faiss.downcast_index(index.index)
+        if isinstance(inner, faiss.IndexHNSW):
+            hnsw = inner.hnsw
+
+    def params(boost: bool) -> faiss.SearchParameters:
+        if ivf is not None:
+            return faiss.SearchParametersIVF(
+                sel=sel, nprobe=ivf.nlist if boost else ivf.nprobe
+            )
+        if hnsw is not None:
+            ef = max(hnsw.efSearch, k)
+            return faiss.SearchParametersHNSW(sel=sel, efSearch=ef * 8 if boost else ef)
+        return faiss.SearchParameters(sel=sel)
+
+    scores, out = index.search(queries, k, params=params(False))
+    if (ivf is not None or hnsw is not None) and (out < 0).any():
+        scores, out = index.search(queries, k, params=params(True))
+    return scores, out
+
+
+# 取出 flat 索引里的全部向量，按 chunk_ids 的顺序排列（用于生成 vectors.npy）
+def flat_vectors_in_order(index: faiss.Index, chunk_ids: List[str]) -> np.ndarray:
+    inner = faiss.downcast_index(index.index)
+    vecs = inner.reconstruct_n(0, inner.ntotal)
+    pos = {int(v): i for i, v in enumerate(faiss.vector_to_array(index.id_map))}
+    rows = [pos[faiss_id(cid)] for cid in chunk_ids]
+    return np.ascontiguousarray(vecs[rows], dtype="float32")
+
+
+def save_vectors_npy(vectors: np.ndarray, path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # 先写临时文件再替换，正在 mmap 旧文件的读取方不受影响
+    tmp = path.with_suffix(".tmp.npy")
+    np.save(tmp, vectors)
+    os.replace(tmp, path)
+
+
+def load_vectors_npy(path: Path) -> NumpyFlatIndex:
+    with span("load_vectors", bytes=file_bytes(path), mmap=True):
+        return NumpyFlatIndex(np.load(path, mmap_mode="r"))
+
+
 # 保存索引的元信息（如模型名、chunk 数量）以 JSON 文件形式写入
 def save_index_meta(meta: Dict, meta_path: Path) -> None:
     meta_path.parent.mkdir(parents=True, exist_ok=True)
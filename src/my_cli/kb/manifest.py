@@ -0,0 +1,213 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# 构建清单（build manifest）
+# 记录 raw 目录下每个文件的内容哈希和它产出的 chunk_id 列表，
+# 增量构建时据此判断哪些文件新增/修改/删除，只重新切块和向量化变化的部分。
+#
+# 同时记录文件的 (mtime_ns, size)：与清单一致的文件不再计算哈希，
+# kb pack / kb watch 也据此只 stat 一遍 raw 目录就能判断索引是否过期。
+# 构建前刚修改过的文件（RACY_WINDOW 秒内）不记录 mtime，下次仍按哈希比较，
+# 避免同一时间戳内的第二次修改被漏掉。
+
+MANIFEST_VERSION = 1
+RACY_WINDOW = 2.0
+DEFAULT_EXTS = (".md", ".txt")
+
+# (mtime_ns, size)
+FileStat = Tuple[int, int]
+
+
+# 单个源文件的记录
+@dataclass
+class FileEntry:
+    # sha1: 文件内容哈希（判断是否变化的依据）
+    sha1: str
+    # chunk_ids: 该文件切出的 chunk_id，按文档顺序
+    chunk_ids: List[str] = field(default_factory=list)
+    # 构建时的 mtime_ns / size；0 / -1 表示未记录（旧版清单或构建时刚被修改）
+    mtime_ns: int = 0
+    size: int = -1
+
+    def same_stat(self, st: Optional[FileStat]) -> bool:
+        return self.mtime_ns != 0 and (self.mtime_ns, self.size) == st
+
+
+@dataclass
+class BuildManifest:
+    model: str = ""
+    # key: 相对 raw 根目录的 posix 路径
+    files: Dict[str, FileEntry] = field(default_factory=dict)
+
+
+# 与上一次构建对比的结果
+@dataclass
+class ManifestDiff:
+    added: List[str] = field(default_factory=list)
+    changed: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    unchanged: List[str] = field(default_factory=list)
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+
+def file_sha1(path: Path) -> str:
+    h = hashlib.sha1()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+# 扫描 raw 目录，返回 {相对路径: 绝对路径}，按路径排序保证构建结果稳定
+def scan_raw_files(root: Path, exts: Iterable[str] = DEFAULT_EXTS) -> Dict[str, Path]:
+    exts = tuple(exts)
+    found: Dict[str, Path] = {}
+    if not root.exists():
+        return found
+    for p in root.rglob("*"):
+        if p.is_file() and p.suffix.lower() in exts:
+            found[p.relative_to(root).as_posix()] = p
+    return dict(sorted(found.items()))
+
+
+# 只 stat 不读内容：{相对路径: (mtime_ns, size)}
+def stat_raw_files(
+    root: Path, exts: Iterable[str] = DEFAULT_EXTS
+) -> Dict[str, FileStat]:
+    exts = tuple(exts)
+    stats: Dict[str, FileStat] = {}
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if os.path.splitext(name)[1].lower() not in exts:
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            rel = Path(os.path.relpath(path, root)).as_posix()
+            stats[rel] = (st.st_mtime_ns, st.st_size)
+    return stats
+
+
+# 写入清单的文件状态：刚修改过的文件不记录 mtime（见文件头）
+def recorded_stat(st: FileStat, now: Optional[float] = None) -> FileStat:
+    now = time.time() if now is None else now
+    if st[0] >= (now - RACY_WINDOW) * 1e9:
+        return 0, -1
+    return st
+
+
+# 内容没变、但清单里的 (mtime, size) 与现在不一致的文件（构建时处在 racy 窗口内、只被 touch 过），
+# 更新为现在的 stat；返回是否有更新。不更新的话之后每次检查都要重新计算这些文件的哈希
+def refresh_stats(
+    manifest: BuildManifest,
+    unchanged: Iterable[str],
+    stats: Dict[str, FileStat],
+    now: Optional[float] = None,
+) -> bool:
+    updated = False
+    for rel in unchanged:
+        entry = manifest.files.get(rel)
+        st = stats.get(rel)
+        if entry is None or st is None or entry.same_stat(st):
+            continue
+        mtime_ns, size = recorded_stat(st, now)
+        if (mtime_ns, size) != (entry.mtime_ns, entry.size):
+            entry.mtime_ns, entry.size = mtime_ns, size
+            updated = True
+    return updated
+
+
+# 与清单 (mtime, size) 不一致的文件（含新增和删除），为空说明索引是最新的
+# 清单里没有记录 mtime 的文件退回到比较哈希
+def stale_files(
+    manifest: BuildManifest, root: Path, stats: Optional[Dict[str, FileStat]] = None
+) -> List[str]:
+    stats = stat_raw_files(root) if stats is None else stats
+    stale = [rel for rel in manifest.files if rel not in stats]
+    for rel, st in stats.items():
+        old = manifest.files.get(rel)
+        if old is None:
+            stale.append(rel)
+        elif not old.same_stat(st) and (
+            old.size not in (-1, st[1]) or old.sha1 != file_sha1(root / rel)
+        ):
+            stale.append(rel)
+    return sorted(stale)
+
+
+# 计算当前文件与清单的差异，同时返回每个文件的最新哈希
+# stats 给出时，(mtime, size) 与清单一致的文件直接视为未变化，不读内容
+def diff_manifest(
+    manifest: BuildManifest,
+    files: Dict[str, Path],
+    stats: Optional[Dict[str, FileStat]] = None,
+) -> Tuple[ManifestDiff, Dict[str, str]]:
+    diff = ManifestDiff()
+    hashes: Dict[str, str] = {}
+    for rel, p in files.items():
+        old = manifest.files.get(rel)
+        if old is not None and stats is not None and old.same_stat(stats.get(rel)):
+            hashes[rel] = old.sha1
+            diff.unchanged.append(rel)
+            continue
+        sha = file_sha1(p)
+        hashes[rel] = sha
+        if old is None:
+            diff.added.append(rel)
+        elif old.sha1 != sha:
+            diff.changed.append(rel)
+        else:
+            diff.unchanged.append(rel)
+    diff.removed = [rel for rel in manifest.files if rel not in files]
+    return diff, hashes
+
+
+def save_manifest(manifest: BuildManifest, path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = {
+        "version": MANIFEST_VERSION,
+        "model": manifest.model,
+        "files": {
+            rel: {
+                "sha1": e.sha1,
+                "chunk_ids": e.chunk_ids,
+                "mtime_ns": e.mtime_ns,
+                "size": e.size,
+            }
+            for rel, e in manifest.files.items()
+        },
+    }
+    # 没有变化的构建会就地更新已发布快照里的清单，写临时文件再替换，读取方不会读到半截
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+# 清单不存在或版本不兼容时返回空清单（触发全量构建）
+def load_manifest(path: Path) -> BuildManifest:
+    if not path.exists():
+        return BuildManifest()
+    data = json.loads(path.read_text(encoding="utf-8"))
+    if data.get("version") != MANIFEST_VERSION:
+        return BuildManifest()
+    files = {
+        rel: FileEntry(
+            sha1=e.get("sha1", ""),
+            chunk_ids=list(e.get("chunk_ids", [])),
+            mtime_ns=int(e.get("mtime_ns", 0)),
+            size=int(e.get("size", -1)),
+        )
+        for rel, e in data.get("files", {}).items()
+    }
+    return BuildManifest(model=data.get("model", ""), files=files)
@@ -1,15 +1,40 @@
 from __future__ import annotations
 
+import contextvars
+import itertools
 import json
-from dataclasses import dataclass
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 from .paths import KBPaths, ensure_dirs
+from .defaults import QUERY_BATCH
 from .chunker import Chunk
-from .embedder import Embedder
-from .index import load_index, load_chunks_jsonl
-from .bm25 import load_bm25_corpus, bm25_search
+from .timing import Recorder, span, file_bytes
+from .tokenizer import configure_tokenizer, tokenize_query
+
+# 检索用到的 FAISS / numpy / jieba 在函数内部导入：
+# 命中查询结果缓存时 kb query / kb pack 只需要本模块的数据类和渲染函数
+if TYPE_CHECKING:
+    import numpy as np
+
+    from .bm25 import Bm25Index
+    from .embedder import Embedder
+    from .store import ChunkStore
 
 # pack.py - 知识包生成模块
 # 核心功能: 混合检索(FAISS向量 + BM25关键词) → RRF融合排名  → 生成知识包
@@ -26,6 +51,28 @@ class RetrievalHit:
     chunk: Chunk  # 文档块对象(包含内容、来源等)
     vec_rank: Optional[int] = None  # 在向量检索中的排名(1表示第一名,None表示未出现)
     bm25_rank: Optional[int] = None  # 在BM25检索中的排名(1表示第一名,None表示未出现)
+    shard: Optional[str] = None  # 来自哪个分片(只有一个知识库时为 None)
+
+
+# RetrievalHit <-> dict,用于 kb serve 的 HTTP 传输
+def hit_to_dict(h: RetrievalHit) -> Dict[str, Any]:
+    return {
+        "fused_score": h.fused_score,
+        "vec_rank": h.vec_rank,
+        "bm25_rank": h.bm25_rank,
+        "shard": h.shard,
+        "chunk": asdict(h.chunk),
+    }
+
+
+def hit_from_dict(obj: Dict[str, Any]) -> RetrievalHit:
+    return RetrievalHit(
+        fused_score=float(obj["fused_score"]),
+        chunk=Chunk(**obj["chunk"]),
+        vec_rank=obj.get("vec_rank"),
+        bm25_rank=obj.get("bm25_rank"),
+        shard=obj.get("shard"),
+    )
 
 
 # RRF 排名融合算法
@@ -53,20 +100,185 @@ def _rrf_fuse(
     Reciprocal Rank Fusion:
     score = Σ 1 / (k + rank)
     """
-    scores: Dict[str, float] = {}
+    return _rrf_fuse_lists([vec_ids, bm25_ids], k=k)
 
-    # 累加向量检索的排名得分
-    for rank, cid in enumerate(vec_ids, start=1):
-        scores[cid] = scores.get(cid, 0.0) + 1.0 / (k + rank)
 
-    # 累加 BM25 检索的排名得分
-    for rank, cid in enumerate(bm25_ids, start=1):
-        scores[cid] = scores.get(cid, 0.0) + 1.0 / (k + rank)
+# 任意多个排名列表的 RRF(多分片时每个分片贡献一个向量列表和一个 BM25 列表)
+def _rrf_fuse_lists(
+    ranked_lists: List[List[str]],
+    k: int = 60,
+    weights: Optional[Sequence[float]] = None,
+) -> List[Tuple[str, float]]:
+    import numpy as np
 
-    # 按融合得分降序排列
-    fused = list(scores.items())
-    fused.sort(key=lambda x: x[1], reverse=True)
-    return fused
+    keys, scores = rrf_fuse(
+        [np.asarray(ids, dtype=object) for ids in ranked_lists], weights, k=k
+    )
+    return list(zip(keys.tolist(), scores.tolist()))
+
+
+# 加权 RRF 的向量化实现: score(key) = Σ weight_i / (k + rank_i)
+#   ranked: 各排名列表的键数组(按排名顺序,列表内不重复);weights: 每个列表的权重,默认都是 1
+# 返回 (键, 融合得分) 两个数组,按得分降序;得分相同的按键首次出现的先后
+# (与逐个累加进 dict 再稳定排序的结果一致,每个键的累加顺序也相同)
+def rrf_fuse(
+    ranked: Sequence[np.ndarray],
+    weights: Optional[Sequence[float]] = None,
+    k: int = 60,
+) -> Tuple[np.ndarray, np.ndarray]:
+    import numpy as np
+
+    if weights is None:
+        weights = [1.0] * len(ranked)
+    elif len(weights) != len(ranked):
+        raise ValueError(f"got {len(weights)} weights for {len(ranked)} ranked lists")
+    parts = [(r, w) for r, w in zip(ranked, weights) if len(r)]
+    if not parts:
+        return np.empty(0, dtype="int64"), np.empty(0, dtype="float64")
+
+    keys = np.concatenate([r for r, _ in parts])
+    contrib = np.concatenate(
+        [w / (k + np.arange(1, len(r) + 1, dtype="float64")) for r, w in parts]
+    )
+    uniq, first, inv = np.unique(keys, return_index=True, return_inverse=True)
+    scores = np.bincount(inv.ravel(), weights=contrib, minlength=uniq.shape[0])
+    order = np.lexsort((first, -scores))
+    return uniq[order], scores[order]
+
+
+# 检索所需的全部内存状态: chunk 表 + FAISS 索引 + BM25 倒排索引
+# 单次命令用 load_kb_state 加载一次;kb serve 常驻进程则一直持有它
+@dataclass
+class KBState:
+    store: ChunkStore
+    # faiss.Index 或 NumpyFlatIndex(均提供 ntotal / search),不存在时只走 BM25
+    index: Optional[Any] = None
+    bm25: Optional[Bm25Index] = None
+    # ID 映射索引返回 chunk_id 派生的向量 ID;旧版索引返回的是行号
+    id_mapped: bool = False
+    # 构建索引时使用的 embedding 模型(index_meta.json),分片检索时校验查询向量是否同源
+    model: Optional[str] = None
+    # 命名空间组合 -> 行号(升序),常驻服务里重复的过滤条件不用重新计算
+    ns_rows: Dict[Tuple[str, ...], Any] = field(default_factory=dict)
+
+    def namespace_rows(self, namespaces: List[str]) -> Any:
+        key = tuple(sorted(set(namespaces)))
+        rows = self.ns_rows.get(key)
+        if rows is None:
+            rows = self.store.namespace_rows(list(key))
+            self.ns_rows[key] = rows
+        return rows
+
+
+def load_kb_state(paths: KBPaths) -> KBState:
+    from .bm25 import build_bm25_index, load_bm25_corpus, load_bm25_index
+    from .index import (
+        configure_index,
+        is_id_mapped,
+        load_chunks_jsonl,
+        load_index,
+        load_index_meta,
+        load_vectors_npy,
+    )
+    from .store import ChunkStore, store_exists
+
+    # 优先打开二进制列式存储(只读偏移列,正文按需切片);旧版知识库读 JSONL
+    corpus_tokens: Optional[List[List[str]]] = None
+    if store_exists(paths.kb_store):
+        with span("load_store") as s:
+            store = ChunkStore.open(paths.kb_store)
+            # 正文和分词是 mmap 的，这里只统计真正读入内存的元信息和列
+            s.set(
+                bytes=file_bytes(
+                    paths.kb_store / "meta.json", paths.kb_store / "columns.npz"
+                ),
+                chunks=len(store),
+            )
+    else:
+        chunks = load_chunks_jsonl(paths.chunks_jsonl)
+        corpus_tokens, _, _ = load_bm25_corpus(paths.bm25_corpus_jsonl)
+        aligned = corpus_tokens if len(corpus_tokens) == len(chunks) else None
+        store = ChunkStore.from_chunks(chunks, aligned)
+
+    state = KBState(store=store)
+    if not len(store):
+        return state
+
+    with span("load_index_meta", bytes=file_bytes(paths.index_meta)):
+        meta = load_index_meta(paths.index_meta)
+    state.model = meta.get("model")
+    vectors = None
+    if meta.get("index_type", "flat") == "flat" and paths.vectors_npy.exists():
+        # flat 索引优先用 mmap 的 vectors.npy,返回的就是行号
+        vectors = load_vectors_npy(paths.vectors_npy)
+        if vectors.ntotal != len(store):
+            vectors = None
+    if vectors is not None:
+        state.index = vectors
+    elif paths.index_faiss.exists():
+        # 以只读 mmap 方式打开 FAISS 索引
+        state.index = load_index(paths.index_faiss, mmap=True)
+        state.id_mapped = is_id_mapped(state.index)
+        # 按构建时记录的参数配置查询期参数(IVF 的 nprobe / HNSW 的 efSearch)
+        params = meta.get("index_params")
+        if params:
+            configure_index(state.index, params)
+
+    # 优先加载构建时生成的 BM25 倒排索引;旧版知识库只有分词语料,现场构建一次
+    if paths.bm25_index.exists():
+        state.bm25 = load_bm25_index(paths.bm25_index)
+    else:
+        with span("build_bm25_index"):
+            if corpus_tokens is None:
+                corpus_tokens = store.corpus_tokens()
+            if corpus_tokens:
+                state.bm25 = build_bm25_index(corpus_tokens)
+    return state
+
+
+# 主知识库在分片列表里的名字(RetrievalHit.shard 只在多个分片时才填写)
+MAIN_SHARD = "main"
+
+
+# 多个知识库分片的检索状态:项目主知识库 + .myspec/kb/shards/ 下的每个分片,各自一个 KBState
+@dataclass
+class ShardedState:
+    shards: List[Tuple[str, KBState]]
+
+
+def kb_built(paths: KBPaths) -> bool:
+    from .store import store_exists
+
+    return store_exists(paths.kb_store) or paths.chunks_jsonl.exists()
+
+
+# 主知识库和已构建的分片(主知识库在前,分片按名称排序)
+# 每个知识库固定到当前发布的快照:之后的读取都在这个快照里进行,不受并发 kb build 影响
+def kb_targets(paths: KBPaths) -> List[Tuple[str, KBPaths]]:
+    from .snapshot import pin
+
+    main = pin(paths)
+    targets = [(MAIN_SHARD, main)] if kb_built(main) else []
+    for name in paths.shard_names():
+        shard = pin(paths.shard(name))
+        if kb_built(shard):
+            targets.append((name, shard))
+    return targets
+
+
+# 加载全部分片;多个分片时并行加载。什么都没构建时退回主知识库(空状态)
+# targets: 调用方已经固定的快照(kb_targets 的结果),None 时现在固定
+def load_sharded_state(
+    paths: KBPaths, targets: Optional[List[Tuple[str, KBPaths]]] = None
+) -> Union[KBState, ShardedState]:
+    # jieba 词典从主知识库目录下的缓存加载（只有中文查询才会用到）
+    configure_tokenizer(paths.jieba_cache)
+    if targets is None:
+        targets = kb_targets(paths)
+    if len(targets) <= 1:
+        return load_kb_state(targets[0][1] if targets else paths)
+    states = _parallel_map(lambda t: load_kb_state(t[1]), targets)
+    return ShardedState(shards=[(name, st) for (name, _), st in zip(targets, states)])
 
 
 # 混合检索核心函数
@@ -82,13 +294,12 @@ def _rrf_fuse(
 def retrieve(
     query: str,
     embedder: Embedder,
-    index_path: Path,
-    chunks_path: Path,
-    bm25_corpus_path: Path,
+    paths: KBPaths,
     topk: int = 8,
     namespaces: Optional[List[str]] = None,
     vec_candidates: int = 30,
     bm25_candidates: int = 30,
+    targets: Optional[List[Tuple[str, KBPaths]]] = None,
 ) -> List[RetrievalHit]:
     """
     Hybrid retrieve = Vector + BM25 -> RRF fuse -> TopK
@@ -96,111 +307,296 @@ def retrieve(
     namespaces:
       - None: 不过滤(全库)
       - ["domain", "project"]: 只保留对应 namespace
+    targets: 已固定的快照(与查询结果缓存的版本号一致),None 时现在固定
     """
-    # 加载所有文档块
-    chunks = load_chunks_jsonl(chunks_path)
-    if not chunks:
-        return []
-
-    allowed_ns = set(namespaces) if namespaces else None
+    with span("load_kb_state"):
+        state = load_sharded_state(paths, targets)
+    return search_kb(
+        query,
+        embedder,
+        state,
+        topk=topk,
+        namespaces=namespaces,
+        vec_candidates=vec_candidates,
+        bm25_candidates=bm25_candidates,
+    )
 
-    # 构建 chunk_id -> chunk 的映射,方便后续快速查找
-    id2chunk: Dict[str, Chunk] = {c.chunk_id: c for c in chunks}
 
-    # 命名空间过滤函数
-    def ns_allowed(c: Chunk) -> bool:
-        return True if allowed_ns is None else (c.namespace in allowed_ns)
+# 批量检索:一次性加载索引,按 batch_size 分组检索,按输入顺序逐条产出每个查询的结果
+# 调用方可以边产出边写结果(JSONL 流式输出),不必等全部查询完成
+def retrieve_many(
+    queries: Iterable[str],
+    embedder: Embedder,
+    paths: KBPaths,
+    topk: int = 8,
+    namespaces: Optional[List[str]] = None,
+    vec_candidates: int = 30,
+    bm25_candidates: int = 30,
+    batch_size: int = QUERY_BATCH,
+) -> Iterator[List[RetrievalHit]]:
+    state = load_sharded_state(paths)
+    it = iter(queries)
+    while True:
+        batch = list(itertools.islice(it, batch_size))
+        if not batch:
+            return
+        yield from search_kb_many(
+            batch,
+            embedder,
+            state,
+            topk=topk,
+            namespaces=namespaces,
+            vec_candidates=vec_candidates,
+            bm25_candidates=bm25_candidates,
+        )
 
-    # ========== 第一步: 向量检索 ==========
-    vec_rank_map: Dict[str, int] = {}  # chunk_id -> 排名(1,2,3...)
-    vec_id_list: List[str] = []  # 按排名顺序的 chunk_id 列表
 
-    if index_path.exists():
-        # 加载 FAISS 索引
-        index = load_index(index_path)
+# 在已加载的 KBState / ShardedState 上执行混合检索(不再读盘)
+def search_kb(
+    query: str,
+    embedder: Embedder,
+    state: Union[KBState, ShardedState],
+    topk: int = 8,
+    namespaces: Optional[List[str]] = None,
+    vec_candidates: int = 30,
+    bm25_candidates: int = 30,
+    weights: Tuple[float, float] = (1.0, 1.0),
+) -> List[RetrievalHit]:
+    return search_kb_many(
+        [query],
+        embedder,
+        state,
+        topk=topk,
+        namespaces=namespaces,
+        vec_candidates=vec_candidates,
+        bm25_candidates=bm25_candidates,
+        weights=weights,
+    )[0]
+
+
+# 单个知识库(分片)上一个查询的候选:向量 / BM25 各自去重后的排名列表(排名 = 下标 + 1)
+#   *_rows: 行号;*_keys: 对应 chunk 的向量 ID(由 chunk_id 派生,跨分片唯一),融合时作键
+@dataclass
+class _Candidates:
+    vec_rows: np.ndarray
+    vec_keys: np.ndarray
+    bm25_rows: np.ndarray
+    bm25_keys: np.ndarray
+
+
+# 多个查询一起检索:查询向量一次 encode(模型内部按批推理)、分词一次,
+# 每个分片上 FAISS 对查询矩阵只搜索一次,BM25 共用同一份倒排索引;
+# 多个分片在线程池里并行检索(FAISS / numpy 计算时释放 GIL),
+# 最后把每个分片的向量排名和 BM25 排名一起做 RRF 融合
+def search_kb_many(
+    queries: List[str],
+    embedder: Embedder,
+    state: Union[KBState, ShardedState],
+    topk: int = 8,
+    namespaces: Optional[List[str]] = None,
+    vec_candidates: int = 30,
+    bm25_candidates: int = 30,
+    weights: Tuple[float, float] = (1.0, 1.0),
+) -> List[List[RetrievalHit]]:
+    shards = state.shards if isinstance(state, ShardedState) else [(None, state)]
+    shards = [(name, st) for name, st in shards if len(st.store)]
+    if not shards or not queries:
+        return [[] for _ in queries]
+
+    # ========== 第一步: 查询向量化和分词(所有分片共用) ==========
+    qvecs = None
+    if any(st.index is not None for _, st in shards):
+        for name, st in shards:
+            if st.index is not None and st.model and st.model != embedder.model_name:
+                raise ValueError(
+                    f"KB shard '{name or MAIN_SHARD}' was built with {st.model}, "
+                    f"but queries are embedded with {embedder.model_name}"
+                )
         # 查询文本向量化(注意 E5 模型需要 "query: " 前缀)
-        qvec = embedder.encode([f"query: {query}"])
-        # 多取一些候选,因为命名空间过滤后可能不够
-        fetch_k = min(len(chunks), max(vec_candidates, topk * 5))
-        # FAISS检索: scores是相似度得分,ids是文档索引
-        scores, ids = index.search(qvec, fetch_k)
-
-        rank = 0  # 当前有效排名(过滤后的)
-        for idx in ids[0].tolist():
-            # 检查索引有效性
-            if idx < 0 or idx >= len(chunks):
-                continue
-            c = chunks[idx]
-            # 命名空间过滤
-            if not ns_allowed(c):
-                continue
-            cid = c.chunk_id
-            if cid in vec_rank_map:
-                continue
-            # 记录排名
-            rank += 1
-            vec_rank_map[cid] = rank
-            vec_id_list.append(cid)
-            # 达到候选数量就停止
-            if rank >= vec_candidates:
-                break
-
-    # ========== 第二步: BM25检索 ==========
-    bm25_rank_map: Dict[str, int] = {}
-    bm25_id_list: List[str] = []
-
-    # 加载 BM25 语料库(分词后的文档集合)
-    corpus_tokens, _, _ = load_bm25_corpus(bm25_corpus_path)
-    if corpus_tokens:
-        # BM25 检索
-        bm25_results = bm25_search(
-            query, corpus_tokens, topk=max(bm25_candidates, topk * 5)
+        with span("encode_query", queries=len(queries)):
+            qvecs = embedder.encode([f"query: {q}" for q in queries])
+    with span("tokenize_query", queries=len(queries)) as s:
+        q_tokens = [tokenize_query(q) for q in queries]
+        s.set(tokens=sum(len(t) for t in q_tokens))
+
+    # ========== 第二步: 各分片检索候选 ==========
+    def search_shard(st: KBState) -> List[_Candidates]:
+        return _shard_candidates(
+            st, qvecs, q_tokens, topk, namespaces, vec_candidates, bm25_candidates
         )
-        rank = 0
-        for (
-            idx,
-            _score,
-        ) in bm25_results:  # idx是文档索引，_score 是 BM25 得分(融合时不直接用)
-            # 检查索引有效性
-            if idx < 0 or idx >= len(chunks):
-                continue
-            c = chunks[idx]
-            # 命名空间过滤
-            if not ns_allowed(c):
-                continue
-            cid = c.chunk_id
-            # 去重
-            if cid in bm25_rank_map:
-                continue
-            # 记录排名
-            rank += 1
-            bm25_rank_map[cid] = rank
-            bm25_id_list.append(cid)
-            # 达到候选数量就停止
-            if rank >= bm25_candidates:
-                break
-
-    # ========== 第三步: RRF融合 ==========
-    # 输入: 向量排名列表 + BM25排名列表
-    # 输出: [(chunk_id, 融合得分), ...] 按得分降序
-    fused = _rrf_fuse(vec_id_list, bm25_id_list, k=60)
-
-    # ========== 第四步: 构建最终结果 ==========
-    hits: List[RetrievalHit] = []
-    for cid, fused_score in fused[:topk]:  # 只取 topk 个
-        c = id2chunk.get(cid)
-        if not c:
+
+    if len(shards) == 1:
+        per_shard = [search_shard(shards[0][1])]
+    else:
+        with span("shard_fanout", shards=len(shards)):
+            per_shard = _parallel_map(search_shard, [st for _, st in shards])
+
+    # ========== 第三步: RRF融合 + 构建最终结果 ==========
+    # weights: (向量, BM25) 排名列表的 RRF 权重,每个分片的两个列表用同一组权重
+    results: List[List[RetrievalHit]] = []
+    for qi in range(len(queries)):
+        cands = [c[qi] for c in per_shard]
+        # 输入: 每个分片的向量排名列表 + BM25排名列表(只有一个知识库时就是两个列表)
+        # 输出: 按融合得分降序的键和得分
+        lists: List[np.ndarray] = []
+        for c in cands:
+            lists.extend([c.vec_keys, c.bm25_keys])
+        with span(
+            "rrf_fuse",
+            vec_candidates=sum(len(c.vec_keys) for c in cands),
+            bm25_candidates=sum(len(c.bm25_keys) for c in cands),
+        ):
+            keys, scores = rrf_fuse(lists, list(weights) * len(cands), k=60)
+
+        top = keys[:topk]  # 只取 topk 个
+        with span("materialize_hits", hits=int(top.shape[0])):
+            owner, rows, vec_rank, bm25_rank = _locate_hits(cands, top)
+            hits = [
+                RetrievalHit(
+                    fused_score=float(scores[i]),  # RRF融合得分
+                    chunk=shards[owner[i]][1].store.get(rows[i]),  # 只为 topk 构造
+                    vec_rank=vec_rank[i] or None,  # 在(分片内)向量检索中的排名
+                    bm25_rank=bm25_rank[i] or None,  # 在(分片内) BM25 检索中的排名
+                    shard=shards[owner[i]][0],
+                )
+                for i in range(top.shape[0])
+            ]
+        results.append(hits)
+
+    return results
+
+
+# 键在排名列表中的下标,不存在为 -1(列表内键不重复)
+def _positions(keys: np.ndarray, wanted: np.ndarray) -> np.ndarray:
+    import numpy as np
+
+    if not keys.shape[0]:
+        return np.full(wanted.shape[0], -1, dtype="int64")
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    pos = np.minimum(np.searchsorted(sorted_keys, wanted), keys.shape[0] - 1)
+    return np.where(sorted_keys[pos] == wanted, order[pos], -1)
+
+
+# 融合后的每个键落在哪个分片、哪一行,以及在该分片里的向量 / BM25 排名(0 表示未命中)
+# 同一个 chunk 出现在多个分片时取第一个分片;同一分片内优先用向量列表里的行号
+def _locate_hits(
+    cands: List[_Candidates], top: np.ndarray
+) -> Tuple[List[int], List[int], List[int], List[int]]:
+    import numpy as np
+
+    n = top.shape[0]
+    owner = np.full(n, -1, dtype="int64")
+    rows = np.full(n, -1, dtype="int64")
+    vec_rank = np.zeros(n, dtype="int64")
+    bm25_rank = np.zeros(n, dtype="int64")
+    for si, c in enumerate(cands):
+        vp = _positions(c.vec_keys, top)
+        bp = _positions(c.bm25_keys, top)
+        new = (owner < 0) & ((vp >= 0) | (bp >= 0))
+        if not new.any():
             continue
-        hits.append(
-            RetrievalHit(
-                fused_score=float(fused_score),  # RRF融合得分
-                chunk=c,  # 文档块对象
-                vec_rank=vec_rank_map.get(cid),  # 在向量检索中的排名
-                bm25_rank=bm25_rank_map.get(cid),  # 在 BM25 检索中的排名
+        vp, bp = vp[new], bp[new]
+        in_vec = vp >= 0
+        found = np.empty(vp.shape[0], dtype="int64")
+        found[in_vec] = c.vec_rows[vp[in_vec]]
+        found[~in_vec] = c.bm25_rows[bp[~in_vec]]
+        owner[new] = si
+        rows[new] = found
+        vec_rank[new] = vp + 1
+        bm25_rank[new] = bp + 1
+    return owner.tolist(), rows.tolist(), vec_rank.tolist(), bm25_rank.tolist()
+
+
+# 线程池并行执行,保持输入顺序;计时上下文随任务带到工作线程
+def _parallel_map(fn: Callable[[Any], Any], items: List[Any]) -> List[Any]:
+    workers = min(len(items), os.cpu_count() or 4)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, fn, x) for x in items]
+        return [f.result() for f in futures]
+
+
+# 在一个知识库(分片)上检索全部查询的候选
+#   向量检索: 查询向量矩阵 → FAISS检索 → 向量 ID 换回行号 → 去重记录排名
+#   BM25检索: 分词结果 → 倒排索引检索 → 去重记录排名
+def _shard_candidates(
+    state: KBState,
+    qvecs: Optional[np.ndarray],
+    q_tokens: List[List[str]],
+    topk: int,
+    namespaces: Optional[List[str]],
+    vec_candidates: int,
+    bm25_candidates: int,
+) -> List[_Candidates]:
+    import numpy as np
+
+    from .index import NumpyFlatIndex, search_subset
+
+    store = state.store
+    n = len(store)
+    empty = np.empty(0, dtype="int64")
+    out = [_Candidates(empty, empty, empty, empty) for _ in q_tokens]
+
+    # 命名空间过滤: 在检索时就限定到这些行(向量检索用 ID 选择器,BM25 用行掩码),
+    # 而不是检索全库后再丢弃,开销只与命名空间大小有关,且总能凑满 topk
+    rows = state.namespace_rows(namespaces) if namespaces else None
+    if rows is not None and not len(rows):
+        return out
+    scope = n if rows is None else int(rows.shape[0])
+
+    # ========== 向量检索(所有查询一次完成) ==========
+    vec_rows: Optional[np.ndarray] = None
+    index = state.index
+    if index is not None and qvecs is not None:
+        fetch_k = min(index.ntotal, scope, max(vec_candidates, topk * 5))
+        # FAISS检索: scores是相似度得分,ids是向量 ID(或旧版索引的行号)
+        with span(
+            "vector_search",
+            index=type(index).__name__,
+            ntotal=int(index.ntotal),
+            scope=scope,
+            queries=len(q_tokens),
+            candidates=int(fetch_k),
+        ):
+            if rows is None:
+                _scores, ids = index.search(qvecs, fetch_k)
+            elif isinstance(index, NumpyFlatIndex):
+                _scores, ids = index.search(qvecs, fetch_k, rows=rows)
+            else:
+                sel = store.faiss_ids[rows] if state.id_mapped else rows
+                _scores, ids = search_subset(index, qvecs, fetch_k, sel)
+            if state.id_mapped:
+                ids = store.rows_for_faiss_ids(ids.ravel()).reshape(ids.shape)
+            vec_rows = np.asarray(ids, dtype="int64")
+
+    for qi, c in enumerate(out):
+        if vec_rows is not None:
+            c.vec_rows, c.vec_keys = _ranked(store, vec_rows[qi], vec_candidates)
+
+        # ========== BM25检索 ==========
+        if state.bm25 is None or not q_tokens[qi]:
+            continue
+        # BM25 检索(倒排索引,只遍历查询词的 postings);得分融合时不直接用
+        with span("bm25_search") as s:
+            docs, _scores = state.bm25.topk(
+                q_tokens[qi], topk=max(bm25_candidates, topk * 5), rows=rows
             )
-        )
+            s.set(candidates=int(docs.shape[0]))
+        c.bm25_rows, c.bm25_keys = _ranked(store, docs, bm25_candidates)
+    return out
+
 
-    return hits
+# 检索结果 → 排名列表: 去掉无效行号(-1 等),按 chunk 去重保留第一次出现,截取前 limit 个
+def _ranked(
+    store: ChunkStore, rows: np.ndarray, limit: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    import numpy as np
+
+    rows = rows[(rows >= 0) & (rows < len(store))]
+    keys = store.faiss_ids[rows]
+    _, first = np.unique(keys, return_index=True)
+    keep = np.sort(first)[:limit]
+    return rows[keep], keys[keep]
 
 
 def render_knowledge_pack(query: str, hits: List[RetrievalHit]) -> str:
@@ -225,6 +621,8 @@ def render_knowledge_pack(query: str, hits: List[RetrievalHit]) -> str:
             f"### [E{i}] {c.heading}  (hybrid={h.fused_score:.6f} | vec_rank={h.vec_rank} | bm25_rank={h.bm25_rank})"
         )
         lines.append(f"Namespace: `{c.namespace}`")
+        if h.shard:
+            lines.append(f"Shard: `{h.shard}`")
         lines.append(f"Source: `{c.source_path}`")
         lines.append(f"Chunk ID: `{c.chunk_id}`")
         lines.append("")
@@ -256,13 +654,28 @@ def render_knowledge_pack(query: str, hits: List[RetrievalHit]) -> str:
 #   paths: KBPaths 对象（包含各种文件路径）
 #   query: 用户查询字符串
 #   hits: 检索命中列表
-def write_pack_and_trace(paths: KBPaths, query: str, hits: List[RetrievalHit]) -> None:
+#   out_dir: 输出目录,默认写到 .myspec/context/(批量模式下每个查询一个子目录)
+#   recorder: 计时记录,传入时把各阶段耗时写到 trace.json 的 "timings"
+def write_pack_and_trace(
+    paths: KBPaths,
+    query: str,
+    hits: List[RetrievalHit],
+    out_dir: Optional[Path] = None,
+    recorder: Optional[Recorder] = None,
+) -> Tuple[Path, Path]:
     # 确保输出目录存在
     ensure_dirs(paths)
+    pack_path, trace_path = paths.knowledge_pack_md, paths.trace_json
+    if out_dir is not None:
+        out_dir.mkdir(parents=True, exist_ok=True)
+        pack_path = out_dir / pack_path.name
+        trace_path = out_dir / trace_path.name
 
     # 生成并写入 knowledge-pack.md
-    pack_md = render_knowledge_pack(query, hits)
-    paths.knowledge_pack_md.write_text(pack_md, encoding="utf-8")
+    with span("render_pack") as s:
+        pack_md = render_knowledge_pack(query, hits)
+        pack_path.write_text(pack_md, encoding="utf-8")
+        s.set(bytes=len(pack_md.encode("utf-8")))
 
     # 构建 trace.json 数据结构
     # 记录检索过程的详细信息，用于调试和分析
@@ -279,11 +692,18 @@ def write_pack_and_trace(paths: KBPaths, query: str, hits: List[RetrievalHit]) -
                 "heading": h.chunk.heading,  # 文档标题
                 "namespace": h.chunk.namespace,  # 命名空间
                 "source_path": h.chunk.source_path,  # 原始文件路径
+                # 来自哪个分片(只有一个知识库时不写)
+                **({"shard": h.shard} if h.shard else {}),
             }
             for i, h in enumerate(hits)
         ],
     }
 
-    paths.trace_json.write_text(
+    # 各阶段耗时(传入 recorder 时):模型加载、索引加载、查询向量化、FAISS、BM25、融合、渲染
+    if recorder is not None:
+        trace["timings"] = recorder.to_dict()
+
+    trace_path.write_text(
         json.dumps(trace, ensure_ascii=False, indent=2), encoding="utf-8"
     )
+    return pack_path, trace_path
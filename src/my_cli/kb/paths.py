@@ -1,21 +1,64 @@
 from __future__ import annotations
 from dataclasses import dataclass
 from pathlib import Path
+from typing import List, Optional
 
 
 # 这个文件定义了 知识库（KB）相关的路径配置。
 @dataclass(frozen=True)
 class KBPaths:
     project_root: Path
+    # 分片知识库的目录（.myspec/kb/shards/<name>），None 为项目主知识库
+    shard_dir: Optional[Path] = None
+    # 固定的索引快照目录（snapshot.pin），None 时索引文件按旧版布局直接放在知识库目录下
+    snapshot_dir: Optional[Path] = None
 
     # 该装饰器作用是把方法变成“只读属性”，调用时不用加括号
     @property
     def myspec_dir(self) -> Path:
         return self.project_root / ".myspec"
 
+    @property
+    def main_kb_root(self) -> Path:
+        return self.myspec_dir / "kb"  # 项目主知识库目录
+
     @property
     def kb_root(self) -> Path:
-        return self.myspec_dir / "kb"  # 知识库目录
+        return self.shard_dir or self.main_kb_root  # 知识库目录（分片时为分片目录）
+
+    # ---------- 分片 ----------
+    # 每个分片是一个完整的知识库目录（raw/、store/、index.faiss ...），可以单独构建和更新；
+    # 也可以是指向其他位置（如全组织共享知识库）的符号链接
+
+    @property
+    def shards_dir(self) -> Path:
+        return self.main_kb_root / "shards"
+
+    def shard(self, name: str) -> KBPaths:
+        return KBPaths(self.project_root, shard_dir=self.shards_dir / name)
+
+    # 已存在的分片名（按名称排序）
+    def shard_names(self) -> List[str]:
+        if not self.shards_dir.is_dir():
+            return []
+        return sorted(p.name for p in self.shards_dir.iterdir() if p.is_dir())
+
+    # ---------- 快照 ----------
+    # 索引文件（index.faiss、store/、bm25_index.npz ...）都在 index_root 下：
+    # 固定了快照时是快照目录，否则是知识库目录（旧版布局）。
+    # raw/、embedding 缓存、ONNX 模型等与具体某次构建无关的文件始终在知识库目录下
+
+    @property
+    def index_root(self) -> Path:
+        return self.snapshot_dir or self.kb_root
+
+    @property
+    def snapshots_dir(self) -> Path:
+        return self.kb_root / "snapshots"
+
+    @property
+    def current_file(self) -> Path:
+        return self.kb_root / "CURRENT"  # 当前发布的快照名
 
     @property
     def kb_raw(self) -> Path:
@@ -23,15 +66,47 @@ class KBPaths:
 
     @property
     def chunks_jsonl(self) -> Path:
-        return self.kb_root / "chunks.jsonl"  # 文档分块数据
+        return self.index_root / "chunks.jsonl"  # 文档分块数据
+
+    @property
+    def kb_store(self) -> Path:
+        return self.index_root / "store"  # 二进制列式 chunk 存储
 
     @property
     def index_faiss(self) -> Path:
-        return self.kb_root / "index.faiss"  # FAISS 向量索引
+        return self.index_root / "index.faiss"  # FAISS 向量索引
+
+    @property
+    def vectors_npy(self) -> Path:
+        return self.index_root / "vectors.npy"  # flat 索引的向量矩阵(mmap 检索)
 
     @property
     def index_meta(self) -> Path:
-        return self.kb_root / "index_meta.json"  # 索引元数据
+        return self.index_root / "index_meta.json"  # 索引元数据
+
+    @property
+    def manifest_json(self) -> Path:
+        return self.index_root / "build_manifest.json"  # 增量构建清单
+
+    @property
+    def embed_cache_dir(self) -> Path:
+        return self.kb_root / "embed_cache"  # 持久化 embedding 缓存
+
+    @property
+    def onnx_dir(self) -> Path:
+        return self.kb_root / "onnx"  # 导出的 ONNX 模型（kb build --backend onnx）
+
+    @property
+    def query_cache_dir(self) -> Path:
+        return self.main_kb_root / "query_cache"  # kb query / kb pack 检索结果缓存
+
+    @property
+    def jieba_cache(self) -> Path:
+        return self.main_kb_root / "jieba.cache"  # 序列化的 jieba 词典（各分片共用）
+
+    @property
+    def serve_json(self) -> Path:
+        return self.main_kb_root / "serve.json"  # kb serve 的监听地址
 
     @property
     def context_dir(self) -> Path:
@@ -47,11 +122,15 @@ class KBPaths:
 
     @property
     def bm25_corpus_jsonl(self) -> Path:
-        return self.kb_root / "bm25_corpus.jsonl"
+        return self.index_root / "bm25_corpus.jsonl"
+
+    @property
+    def bm25_index(self) -> Path:
+        return self.index_root / "bm25_index.npz"  # BM25 倒排索引
 
     @property
     def bm25_meta(self) -> Path:
-        return self.kb_root / "bm25_meta.json"
+        return self.index_root / "bm25_meta.json"
 
 
 # 确保 kb/raw/ 和 context/ 目录存在
@@ -0,0 +1,154 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import shutil
+import unicodedata
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from .paths import KBPaths
+from .pack import MAIN_SHARD, RetrievalHit, hit_from_dict, hit_to_dict, kb_targets
+from .timing import span
+
+# 检索结果缓存（kb query / kb pack）
+# /specify 流程里同一个需求经常被反复 pack，命中缓存时跳过模型加载、向量化和检索
+#
+# key = hash(规范化后的查询 + topk + namespaces)，value = 融合后的命中列表（hit_to_dict）
+# 目录结构：query_cache/<build_id>/<key>.json，每条一个文件
+#   build_id 由 kb build 写入 index_meta.json（多个分片时取各分片 build_id 的组合），
+#   索引一变 key 空间就跟着变；
+#   kb build 完成后会直接删掉整个 query_cache 目录
+# LRU：命中时更新文件 mtime，总大小超过上限时按 mtime 从旧到新淘汰
+
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+# 超过上限时淘汰到上限的这个比例，避免每次写入都触发整理
+_EVICT_TARGET = 0.8
+
+
+# 规范化查询：Unicode 兼容形式（全角/半角统一）+ 合并空白
+def normalize_query(query: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", query).split())
+
+
+# 当前索引的版本号：主知识库和各分片 build_id 的组合，任何一个重建都会变
+# 有知识库缺少 build_id（旧版）时返回 None（不缓存）
+# targets: 已固定的快照（kb_targets 的结果），检索必须读同一组快照，结果才能记在这个版本号下
+def index_fingerprint(
+    paths: KBPaths, targets: Optional[List[Tuple[str, KBPaths]]] = None
+) -> Optional[str]:
+    if targets is None:
+        targets = kb_targets(paths)
+    parts = []
+    for name, target in targets or [(MAIN_SHARD, paths)]:
+        try:
+            meta = json.loads(target.index_meta.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        build_id = meta.get("build_id")
+        if not build_id:
+            return None
+        parts.append(f"{name}:{build_id}")
+    if len(parts) == 1:
+        return parts[0].split(":", 1)[1]
+    data = "\n".join(parts).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+# kb build 写完新索引后调用：旧结果全部作废
+def clear_query_cache(paths: KBPaths) -> None:
+    shutil.rmtree(paths.query_cache_dir, ignore_errors=True)
+
+
+class QueryCache:
+    def __init__(
+        self, root: Path, fingerprint: str, max_bytes: int = DEFAULT_MAX_BYTES
+    ) -> None:
+        self.root = root
+        self.fingerprint = fingerprint
+        self.dir = root / fingerprint
+        self.max_bytes = max_bytes
+
+    # 一次查询的 get / put 用同一个实例：版本号只在打开时计算一次
+    @classmethod
+    def open(
+        cls, paths: KBPaths, targets: Optional[List[Tuple[str, KBPaths]]] = None
+    ) -> Optional[QueryCache]:
+        fingerprint = index_fingerprint(paths, targets)
+        if fingerprint is None:
+            return None
+        return cls(paths.query_cache_dir, fingerprint)
+
+    @staticmethod
+    def _spec(query: str, topk: int, namespaces: Optional[List[str]]) -> Dict[str, Any]:
+        return {
+            "query": normalize_query(query),
+            "topk": int(topk),
+            "namespaces": sorted(set(namespaces or [])),
+        }
+
+    def _path(self, spec: Dict[str, Any]) -> Path:
+        data = json.dumps(spec, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        return self.dir / f"{hashlib.blake2b(data, digest_size=16).hexdigest()}.json"
+
+    def get(
+        self, query: str, topk: int, namespaces: Optional[List[str]] = None
+    ) -> Optional[List[RetrievalHit]]:
+        spec = self._spec(query, topk, namespaces)
+        path = self._path(spec)
+        with span("query_cache") as s:
+            try:
+                entry = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                s.set(hit=False)
+                return None
+            if entry.get("spec") != spec:
+                s.set(hit=False)
+                return None
+            try:
+                # 更新 mtime 作为最近使用时间
+                os.utime(path)
+            except OSError:
+                pass
+            s.set(hit=True)
+            return [hit_from_dict(h) for h in entry["hits"]]
+
+    def put(
+        self,
+        query: str,
+        topk: int,
+        namespaces: Optional[List[str]],
+        hits: List[RetrievalHit],
+    ) -> None:
+        spec = self._spec(query, topk, namespaces)
+        path = self._path(spec)
+        entry = {"spec": spec, "hits": [hit_to_dict(h) for h in hits]}
+        try:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text(json.dumps(entry, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, path)
+            self._evict()
+        except OSError:
+            # 缓存写不进去不影响检索结果
+            pass
+
+    # 删掉其他 build_id 的残留目录，再按 mtime 淘汰到上限以内
+    def _evict(self) -> None:
+        for d in self.root.iterdir():
+            if d != self.dir:
+                shutil.rmtree(d, ignore_errors=True)
+        files = []
+        total = 0
+        for p in self.dir.glob("*.json"):
+            st = p.stat()
+            files.append((st.st_mtime_ns, st.st_size, p))
+            total += st.st_size
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * _EVICT_TARGET
+        for _, size, p in sorted(files):
+            if total <= target:
+                break
+            p.unlink(missing_ok=True)
+            total -= size
@@ -0,0 +1,196 @@
+from __future__ import annotations
+import json
+import os
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from .paths import KBPaths
+from .embedder import Embedder
+from .tokenizer import tokenize_query
+from .timing import recording
+from .pack import (
+    MAIN_SHARD,
+    KBState,
+    ShardedState,
+    hit_to_dict,
+    kb_targets,
+    load_sharded_state,
+    search_kb,
+    search_kb_many,
+)
+
+# kb serve 常驻进程
+# 把 embedding 模型、FAISS 索引、chunks、BM25 语料一直放在内存里，
+# 通过 127.0.0.1 上的 HTTP 接口提供检索，kb query / kb pack 检测到它就直接转发请求，
+# 省掉每次命令行启动时加载模型和读索引的开销。
+#
+# 接口:
+#   GET  /health   -> {"ok": true, "num_chunks": N, "shards": [...]}
+#   POST /retrieve -> body: {"query", "topk", "namespaces"}  返回 {"hits": [...], "timings": {...}}
+#   POST /retrieve_many -> body: {"queries", "topk", "namespaces"}  返回 {"results": [[...], ...]}
+#
+# 启动后把地址写到 .myspec/kb/serve.json，客户端据此发现服务；退出时删除。
+
+
+def kb_signature(paths: KBPaths) -> Tuple[Any, ...]:
+    # 各知识库(分片)索引文件的 (mtime_ns, size)，任何一个变化都说明 kb build 重新写过；
+    # 分片的增删也会改变签名
+    # 快照目录随每次发布变化，本身就标识了索引版本
+    sig: List[Any] = []
+    for name, target in kb_targets(paths) or [(MAIN_SHARD, paths)]:
+        sig.extend((name, str(target.index_root)))
+        for p in (
+            target.kb_store / "meta.json",
+            target.index_faiss,
+            target.vectors_npy,
+            target.index_meta,
+            target.chunks_jsonl,
+            target.bm25_corpus_jsonl,
+            target.bm25_index,
+        ):
+            try:
+                st = p.stat()
+                sig.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                sig.append((0, 0))
+    return tuple(sig)
+
+
+class KBService:
+    def __init__(self, paths: KBPaths, embedder: Embedder) -> None:
+        self.paths = paths
+        self.embedder = embedder
+        self.state: Optional[Union[KBState, ShardedState]] = None
+        self._signature: Optional[Tuple[Any, ...]] = None
+        # 模型推理和 embedding 缓存都不是线程安全的，检索串行执行
+        self._lock = threading.Lock()
+
+    # 磁盘上的索引变了就重新加载（在锁内调用）
+    def _maybe_reload(self) -> None:
+        sig = kb_signature(self.paths)
+        if self.state is not None and sig == self._signature:
+            return
+        self.state = load_sharded_state(self.paths)
+        self._signature = sig
+
+    def warmup(self) -> None:
+        with self._lock:
+            self._maybe_reload()
+            # 提前触发模型加载和 jieba 词典初始化，第一条查询不用再等
+            self.embedder.encode(["query: warmup"])
+            tokenize_query("预热")
+
+    # 健康检查不加锁也不触发重载，客户端用很短的超时探测
+    def health(self) -> Dict[str, Any]:
+        state = self.state
+        if state is None:
+            return {"ok": True, "num_chunks": 0}
+        shards = (
+            state.shards if isinstance(state, ShardedState) else [(MAIN_SHARD, state)]
+        )
+        return {
+            "ok": True,
+            "num_chunks": sum(len(st.store) for _, st in shards),
+            "shards": [name for name, _ in shards],
+        }
+
+    def retrieve(
+        self, query: str, topk: int, namespaces: Optional[List[str]]
+    ) -> Dict[str, Any]:
+        # 服务端各阶段耗时随结果返回，客户端并入自己的 trace
+        with self._lock, recording() as rec:
+            self._maybe_reload()
+            hits = search_kb(
+                query, self.embedder, self.state, topk=topk, namespaces=namespaces
+            )
+        return {"hits": [hit_to_dict(h) for h in hits], "timings": rec.to_dict()}
+
+    def retrieve_many(
+        self, queries: List[str], topk: int, namespaces: Optional[List[str]]
+    ) -> Dict[str, Any]:
+        with self._lock:
+            self._maybe_reload()
+            results = search_kb_many(
+                queries, self.embedder, self.state, topk=topk, namespaces=namespaces
+            )
+        return {"results": [[hit_to_dict(h) for h in hits] for hits in results]}
+
+
+def _make_handler(service: KBService):
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, status: int, obj: Dict[str, Any]) -> None:
+            data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self) -> None:
+            if self.path == "/health":
+                self._send_json(200, service.health())
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self) -> None:
+            if self.path not in ("/retrieve", "/retrieve_many"):
+                self._send_json(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", "0"))
+                req = json.loads(self.rfile.read(length) or b"{}")
+                topk = int(req.get("topk", 8))
+                namespaces = req.get("namespaces") or None
+                if self.path == "/retrieve_many":
+                    queries = [str(q) for q in req["queries"]]
+                    result = service.retrieve_many(queries, topk, namespaces)
+                else:
+                    result = service.retrieve(str(req["query"]), topk, namespaces)
+            except (KeyError, ValueError, TypeError) as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            except Exception as e:
+                self._send_json(500, {"error": str(e)})
+                return
+            self._send_json(200, result)
+
+        # 默认会把每个请求打印到 stderr，这里保持安静
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    return Handler
+
+
+def write_serve_info(path: Path, host: str, port: int) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    info = {"host": host, "port": port, "pid": os.getpid()}
+    path.write_text(json.dumps(info, indent=2), encoding="utf-8")
+
+
+def _raise_exit(signum: int, frame: Any) -> None:
+    raise SystemExit(0)
+
+
+def serve_forever(
+    paths: KBPaths, embedder: Embedder, host: str = "127.0.0.1", port: int = 0
+) -> None:
+    service = KBService(paths, embedder)
+    service.warmup()
+    httpd = ThreadingHTTPServer((host, port), _make_handler(service))
+    bound_host, bound_port = httpd.server_address[:2]
+    write_serve_info(paths.serve_json, bound_host, bound_port)
+    # SIGTERM 也走正常退出流程，保证 serve.json 被清理
+    signal.signal(signal.SIGTERM, _raise_exit)
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        try:
+            info = json.loads(paths.serve_json.read_text(encoding="utf-8"))
+            if info.get("pid") == os.getpid():
+                paths.serve_json.unlink()
+        except (OSError, ValueError):
+            pass
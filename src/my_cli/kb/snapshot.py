@@ -0,0 +1,190 @@
+from __future__ import annotations
+import os
+import shutil
+import time
+import uuid
+from dataclasses import replace
+from pathlib import Path
+from typing import List, Optional
+
+from .defaults import SNAPSHOT_ABANDONED, SNAPSHOT_GRACE
+from .paths import KBPaths
+
+# 知识库快照
+# 每次 kb build 把索引写进一个新的快照目录，全部写完后原子地替换 CURRENT 指针发布：
+#   <kb>/snapshots/<时间>-<build_id 前缀>/   index.faiss、vectors.npy、store/、index_meta.json、
+#                                          bm25_index.npz、build_manifest.json ...
+#   <kb>/CURRENT                            当前快照的目录名（写临时文件再 os.replace）
+#
+# 已发布的快照不再修改，读取方开始检索时用 pin() 固定一个快照，整个查询只读这个目录，
+# 不会出现新索引配旧 chunks 的情况；构建在后台进行时检索照常使用旧快照。
+#
+# publish 在切换 CURRENT 之前给将被替换的快照写入 RETIRED 标记，标记满 SNAPSHOT_GRACE 后
+# 由 gc_snapshots 删除（正在读它的进程有足够时间结束）；GC 从不删除 CURRENT 指向的快照，
+# 所以切换前崩溃留下的标记无害，下一次发布会重写它。没有标记的快照可能是正在进行的构建，
+# 只有超过 SNAPSHOT_ABANDONED 没有任何写入（中途失败、从未发布）才删除。
+# 没有 CURRENT 的知识库是旧版布局：索引文件直接放在知识库目录下，照常读取，下一次构建时迁移；
+# 迁移时在知识库目录写入 LEGACY_RETIRED 标记，旧文件同样从这个时间起算宽限期。
+
+SNAPSHOT_PREFIX_FORMAT = "%Y%m%d-%H%M%S"
+# 被替换下来的快照里的标记文件，mtime 即退役时间
+RETIRED_MARKER = "RETIRED"
+# 旧版布局迁移到快照后写在知识库目录下的标记，mtime 即旧索引文件的退役时间
+LEGACY_RETIRED_MARKER = "LEGACY_RETIRED"
+
+
+def current_snapshot(paths: KBPaths) -> Optional[str]:
+    try:
+        name = paths.current_file.read_text(encoding="utf-8").strip()
+    except OSError:
+        return None
+    if not name or not (paths.snapshots_dir / name).is_dir():
+        return None
+    return name
+
+
+# 固定当前发布的快照；已固定的路径原样返回，旧版布局返回知识库目录本身
+def pin(paths: KBPaths) -> KBPaths:
+    if paths.snapshot_dir is not None:
+        return paths
+    name = current_snapshot(paths)
+    if name is None:
+        return paths
+    return replace(paths, snapshot_dir=paths.snapshots_dir / name)
+
+
+# 为一次构建创建新的（尚未发布的）快照目录，目录名按创建时间排序
+def new_snapshot(paths: KBPaths, build_id: Optional[str] = None) -> KBPaths:
+    build_id = build_id or uuid.uuid4().hex
+    name = f"{time.strftime(SNAPSHOT_PREFIX_FORMAT)}-{build_id[:12]}"
+    snapshot_dir = paths.snapshots_dir / name
+    snapshot_dir.mkdir(parents=True)
+    return replace(paths, snapshot_dir=snapshot_dir)
+
+
+# 原子地把 CURRENT 指向 snapshot；切换前先给被替换的快照（或旧版布局）写入退役标记，
+# 切换后任何时刻崩溃，不再是 CURRENT 的快照都已带有标记
+def publish(paths: KBPaths, snapshot: KBPaths) -> None:
+    assert snapshot.snapshot_dir is not None
+    previous = current_snapshot(paths)
+    if previous is None:
+        if any(p.exists() for p in _legacy_files(paths)):
+            _mark_retired(paths.kb_root / LEGACY_RETIRED_MARKER)
+    elif previous != snapshot.snapshot_dir.name:
+        _mark_retired(paths.snapshots_dir / previous / RETIRED_MARKER)
+    tmp = paths.current_file.with_name(f".CURRENT.{os.getpid()}.tmp")
+    tmp.write_text(snapshot.snapshot_dir.name + "\n", encoding="utf-8")
+    os.replace(tmp, paths.current_file)
+
+
+# 写入（或刷新）退役标记；写不进去时不发布，否则被替换的快照无法按退役时间回收
+def _mark_retired(marker: Path) -> None:
+    marker.write_text(f"{time.time()}\n", encoding="utf-8")
+
+
+# 构建失败或没有产出时删掉未发布的快照
+def discard(snapshot: KBPaths) -> None:
+    if snapshot.snapshot_dir is not None:
+        shutil.rmtree(snapshot.snapshot_dir, ignore_errors=True)
+
+
+# 旧版布局直接放在知识库目录下的索引文件（迁移到快照后由 GC 删除）
+def _legacy_files(paths: KBPaths) -> List[Path]:
+    legacy = replace(paths, snapshot_dir=None)
+    return [
+        legacy.index_faiss,
+        legacy.vectors_npy,
+        legacy.index_meta,
+        legacy.manifest_json,
+        legacy.chunks_jsonl,
+        legacy.bm25_corpus_jsonl,
+        legacy.bm25_index,
+        legacy.bm25_meta,
+        legacy.kb_store,
+    ]
+
+
+# 快照目录里最近一次写入的时间（构建过程中不断有文件写入，顶层目录的 mtime 只反映增删）
+def _last_write(d: Path) -> float:
+    latest = d.stat().st_mtime
+    for dirpath, dirnames, filenames in os.walk(d):
+        for name in dirnames + filenames:
+            try:
+                latest = max(latest, os.stat(os.path.join(dirpath, name)).st_mtime)
+            except OSError:
+                pass
+    return latest
+
+
+# 删除过了宽限期的旧快照，返回删除的个数
+#   - 有 RETIRED 标记的（发布过、已被替换）：标记写入超过 grace 秒
+#   - 没有标记的（正在进行或中途失败的构建）：超过 abandoned 秒没有任何写入
+# Windows 上仍被 mmap 的文件删不掉，留到下一次
+def gc_snapshots(
+    paths: KBPaths,
+    grace: float = SNAPSHOT_GRACE,
+    abandoned: float = SNAPSHOT_ABANDONED,
+) -> int:
+    current = current_snapshot(paths)
+    if current is None:
+        return 0
+    now = time.time()
+    removed = 0
+    for d in paths.snapshots_dir.iterdir():
+        if not d.is_dir() or d.name == current:
+            continue
+        try:
+            retired = (d / RETIRED_MARKER).stat().st_mtime
+        except OSError:
+            retired = None
+        try:
+            if retired is not None:
+                expired = now - retired >= grace
+            else:
+                expired = now - _last_write(d) >= abandoned
+        except OSError:
+            continue
+        if not expired:
+            continue
+        shutil.rmtree(d, ignore_errors=True)
+        removed += not d.exists()
+    _gc_legacy(paths, now, grace)
+    return removed
+
+
+# 旧版布局的索引文件：从迁移时写入的 LEGACY_RETIRED 标记起算宽限期（文件本身的 mtime
+# 是上一次旧版构建的时间，早就过了宽限期，读取方却可能仍在使用）
+def _gc_legacy(paths: KBPaths, now: float, grace: float) -> None:
+    legacy = [p for p in _legacy_files(paths) if p.exists()]
+    marker = paths.kb_root / LEGACY_RETIRED_MARKER
+    if not legacy:
+        _unlink(marker)
+        return
+    try:
+        retired = marker.stat().st_mtime
+    except OSError:
+        # 没有标记时迁移发生在标记引入之前，从现在开始计时
+        try:
+            _mark_retired(marker)
+        except OSError:
+            pass
+        return
+    if now - retired < grace:
+        return
+    for p in legacy:
+        try:
+            if p.is_dir():
+                shutil.rmtree(p, ignore_errors=True)
+            else:
+                p.unlink()
+        except OSError:
+            pass
+    if not any(p.exists() for p in legacy):
+        _unlink(marker)
+
+
+def _unlink(path: Path) -> None:
+    try:
+        path.unlink(missing_ok=True)
+    except OSError:
+        pass
@@ -0,0 +1,329 @@
+from __future__ import annotations
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .chunker import Chunk
+from .index import faiss_id, faiss_ids
+
+# 二进制列式知识库存储（替代每次查询都逐行 json.loads 的 chunks.jsonl / bm25_corpus.jsonl）
+#
+# 目录结构 .myspec/kb/store/:
+#   meta.json        - 版本、chunk 数、namespace / source_path 字典
+#   columns.npz      - 各列的偏移数组与编码：
+#                        chunk_id_off / heading_off / content_off / token_off : (N+1,) int64
+#                        ns_code / source_code : (N,) int32 字典编码
+#                        faiss_id : (N,) int64  向量 ID（与 FAISS IndexIDMap 对齐）
+#                        vocab_off : (V+1,) int64
+#   chunk_id.bin     - chunk_id 拼接的 utf-8 字节
+#   heading.bin      - 标题路径拼接的 utf-8 字节
+#   content.bin      - 正文拼接的 utf-8 字节（memmap，只读取命中的片段）
+#   tokens.i32       - 所有 chunk 的 token ID 拼接（memmap）
+#   vocab.bin        - token 词表拼接的 utf-8 字节
+#
+# 检索时只加载偏移和编码列，正文/标题等按行号切片，最终只为返回的 topk 构造 Chunk 对象。
+
+STORE_VERSION = 1
+
+_BLOBS = ("chunk_id", "heading", "content", "vocab")
+
+
+def _pack_strings(values: List[str]) -> Tuple[bytes, np.ndarray]:
+    encoded = [v.encode("utf-8") for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype="int64")
+    if encoded:
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+    return b"".join(encoded), offsets
+
+
+def _dict_encode(values: List[str]) -> Tuple[List[str], np.ndarray]:
+    names: Dict[str, int] = {}
+    codes = np.fromiter(
+        (names.setdefault(v, len(names)) for v in values),
+        dtype="int32",
+        count=len(values),
+    )
+    return list(names), codes
+
+
+class ChunkStore:
+    """
+    按行号访问的 chunk 表。可以来自磁盘上的列式文件(open)，
+    也可以由内存中的 Chunk 列表构造(from_chunks，用于兼容旧的 JSONL 知识库)。
+    """
+
+    def __init__(
+        self,
+        columns: Dict[str, np.ndarray],
+        blobs: Dict[str, np.ndarray],
+        namespaces: List[str],
+        sources: List[str],
+        tokens: Optional[np.ndarray] = None,
+    ) -> None:
+        self._cols = columns
+        self._blobs = blobs
+        self.namespaces = namespaces
+        self.sources = sources
+        self._tokens = tokens
+        self._vocab: Optional[List[str]] = None
+        self._faiss_order: Optional[np.ndarray] = None
+
+    # ---------- 构造 ----------
+
+    @classmethod
+    def from_chunks(
+        cls, chunks: List[Chunk], corpus_tokens: Optional[List[List[str]]] = None
+    ) -> "ChunkStore":
+        columns, blobs, namespaces, sources, tokens = _encode(chunks, corpus_tokens)
+        return cls(
+            columns,
+            {k: np.frombuffer(v, dtype="uint8") for k, v in blobs.items()},
+            namespaces,
+            sources,
+            tokens if corpus_tokens is not None else None,
+        )
+
+    @classmethod
+    def open(cls, root: Path) -> "ChunkStore":
+        meta = json.loads((root / "meta.json").read_text(encoding="utf-8"))
+        if meta.get("version") != STORE_VERSION:
+            raise ValueError(f"unsupported store version: {meta.get('version')}")
+        with np.load(root / "columns.npz") as z:
+            columns = {k: z[k] for k in z.files}
+        blobs = {name: _memmap(root / f"{name}.bin", "uint8") for name in _BLOBS}
+        tokens = _memmap(root / "tokens.i32", "int32")
+        return cls(columns, blobs, meta["namespaces"], meta["sources"], tokens)
+
+    # ---------- 按行访问 ----------
+
+    def __len__(self) -> int:
+        return int(self._cols["ns_code"].shape[0])
+
+    def _str(self, name: str, i: int) -> str:
+        off = self._cols[f"{name}_off"]
+        return bytes(self._blobs[name][off[i] : off[i + 1]]).decode("utf-8")
+
+    def chunk_id(self, i: int) -> str:
+        return self._str("chunk_id", i)
+
+    def namespace(self, i: int) -> str:
+        return self.namespaces[int(self._cols["ns_code"][i])]
+
+    @property
+    def ns_codes(self) -> np.ndarray:
+        return self._cols["ns_code"]
+
+    @property
+    def faiss_ids(self) -> np.ndarray:
+        return self._cols["faiss_id"]
+
+    # 属于这些命名空间的行号（升序）
+    def namespace_rows(self, namespaces: List[str]) -> np.ndarray:
+        wanted = set(namespaces)
+        codes = [i for i, ns in enumerate(self.namespaces) if ns in wanted]
+        return np.flatnonzero(np.isin(self.ns_codes, codes)).astype("int64")
+
+    def get(self, i: int) -> Chunk:
+        return Chunk(
+            chunk_id=self.chunk_id(i),
+            source_path=self.sources[int(self._cols["source_code"][i])],
+            heading=self._str("heading", i),
+            content=self._str("content", i),
+            namespace=self.namespace(i),
+        )
+
+    def __iter__(self) -> Iterator[Chunk]:
+        for i in range(len(self)):
+            yield self.get(i)
+
+    def chunk_ids(self) -> List[str]:
+        return [self.chunk_id(i) for i in range(len(self))]
+
+    def tokens(self, i: int) -> List[str]:
+        if self._tokens is None:
+            return []
+        if self._vocab is None:
+            raw = bytes(self._blobs["vocab"])
+            off = self._cols["vocab_off"].tolist()
+            self._vocab = [
+                raw[off[j] : off[j + 1]].decode("utf-8") for j in range(len(off) - 1)
+            ]
+        off = self._cols["token_off"]
+        return [self._vocab[t] for t in self._tokens[off[i] : off[i + 1]].tolist()]
+
+    # JSONL 旧知识库可能没有对齐的分词结果
+    @property
+    def has_tokens(self) -> bool:
+        return self._tokens is not None
+
+    def corpus_tokens(self) -> List[List[str]]:
+        return [self.tokens(i) for i in range(len(self))]
+
+    # 把 FAISS 返回的向量 ID 映射回行号，不存在的返回 -1
+    def rows_for_faiss_ids(self, ids: np.ndarray) -> np.ndarray:
+        fid = self._cols["faiss_id"]
+        if self._faiss_order is None:
+            self._faiss_order = np.argsort(fid, kind="stable")
+        ids = np.asarray(ids, dtype="int64")
+        if not fid.shape[0]:
+            return np.full(ids.shape, -1, dtype="int64")
+        sorted_ids = fid[self._faiss_order]
+        pos = np.searchsorted(sorted_ids, ids)
+        pos = np.minimum(pos, sorted_ids.shape[0] - 1)
+        found = sorted_ids[pos] == ids
+        return np.where(found, self._faiss_order[pos], -1)
+
+
+def _memmap(path: Path, dtype: str) -> np.ndarray:
+    # 空文件无法 memmap
+    if not path.exists() or path.stat().st_size == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+def _encode(chunks: List[Chunk], corpus_tokens: Optional[List[List[str]]]):
+    columns: Dict[str, np.ndarray] = {}
+    blobs: Dict[str, bytes] = {}
+
+    for name, values in (
+        ("chunk_id", [c.chunk_id for c in chunks]),
+        ("heading", [c.heading for c in chunks]),
+        ("content", [c.content for c in chunks]),
+    ):
+        blobs[name], columns[f"{name}_off"] = _pack_strings(values)
+
+    namespaces, columns["ns_code"] = _dict_encode([c.namespace for c in chunks])
+    sources, columns["source_code"] = _dict_encode([c.source_path for c in chunks])
+    columns["faiss_id"] = faiss_ids([c.chunk_id for c in chunks])
+
+    # token -> ID 词表
+    vocab: Dict[str, int] = {}
+    corpus_tokens = corpus_tokens if corpus_tokens is not None else []
+    token_ids = np.fromiter(
+        (vocab.setdefault(t, len(vocab)) for doc in corpus_tokens for t in doc),
+        dtype="int32",
+    )
+    token_off = np.zeros(len(chunks) + 1, dtype="int64")
+    if corpus_tokens:
+        token_off[1:] = np.cumsum([len(doc) for doc in corpus_tokens])
+    columns["token_off"] = token_off
+    blobs["vocab"], columns["vocab_off"] = _pack_strings(list(vocab))
+
+    return columns, blobs, namespaces, sources, token_ids
+
+
+class StoreWriter:
+    """
+    流式写入：逐条 add，正文直接追加到 .bin 文件，内存里只保留偏移和编码列。
+    写入 <root>.tmp 目录，close() 时整体替换 root；打开着旧存储的读取方（mmap）不受影响。
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.tmp = root.with_name(root.name + ".tmp")
+        if self.tmp.exists():
+            shutil.rmtree(self.tmp)
+        self.tmp.mkdir(parents=True)
+        self._files = {
+            name: (self.tmp / f"{name}.bin").open("wb") for name in _BLOBS[:-1]
+        }
+        self._tokens_file = (self.tmp / "tokens.i32").open("wb")
+        self._off: Dict[str, List[int]] = {name: [0] for name in _BLOBS[:-1]}
+        self._off["token"] = [0]
+        self._namespaces: Dict[str, int] = {}
+        self._sources: Dict[str, int] = {}
+        self._ns_code: List[int] = []
+        self._source_code: List[int] = []
+        self._faiss_id: List[int] = []
+        self._vocab: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._ns_code)
+
+    def add(self, chunk: Chunk, tokens: List[str]) -> None:
+        for name, value in (
+            ("chunk_id", chunk.chunk_id),
+            ("heading", chunk.heading),
+            ("content", chunk.content),
+        ):
+            data = value.encode("utf-8")
+            self._files[name].write(data)
+            self._off[name].append(self._off[name][-1] + len(data))
+        ns, src = self._namespaces, self._sources
+        self._ns_code.append(ns.setdefault(chunk.namespace, len(ns)))
+        self._source_code.append(src.setdefault(chunk.source_path, len(src)))
+        self._faiss_id.append(faiss_id(chunk.chunk_id))
+        vocab = self._vocab
+        ids = np.fromiter(
+            (vocab.setdefault(t, len(vocab)) for t in tokens),
+            dtype="int32",
+            count=len(tokens),
+        )
+        ids.tofile(self._tokens_file)
+        self._off["token"].append(self._off["token"][-1] + len(tokens))
+
+    def _close_files(self) -> None:
+        for f in self._files.values():
+            f.close()
+        self._tokens_file.close()
+
+    def close(self) -> None:
+        self._close_files()
+        vocab_blob, vocab_off = _pack_strings(list(self._vocab))
+        (self.tmp / "vocab.bin").write_bytes(vocab_blob)
+        columns = {
+            f"{name}_off": np.asarray(off, dtype="int64")
+            for name, off in self._off.items()
+        }
+        columns["vocab_off"] = vocab_off
+        columns["ns_code"] = np.asarray(self._ns_code, dtype="int32")
+        columns["source_code"] = np.asarray(self._source_code, dtype="int32")
+        columns["faiss_id"] = np.asarray(self._faiss_id, dtype="int64")
+        with (self.tmp / "columns.npz").open("wb") as f:
+            np.savez(f, **columns)
+        # meta.json 最后写入：读取方以它为准
+        meta = {
+            "version": STORE_VERSION,
+            "num_chunks": len(self),
+            "namespaces": list(self._namespaces),
+            "sources": list(self._sources),
+        }
+        (self.tmp / "meta.json").write_text(
+            json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8"
+        )
+
+        # 目录不能原子地覆盖非空目录：旧目录先挪开，新目录就位后再删除
+        old = self.root.with_name(self.root.name + ".old")
+        if old.exists():
+            shutil.rmtree(old)
+        if self.root.exists():
+            os.replace(self.root, old)
+        os.replace(self.tmp, self.root)
+        shutil.rmtree(old, ignore_errors=True)
+
+    # 构建失败时丢弃临时目录，root 保持原样
+    def abort(self) -> None:
+        self._close_files()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+def save_store(chunks: List[Chunk], corpus_tokens: List[List[str]], root: Path) -> None:
+    """
+    corpus_tokens 与 chunks 按行对齐（即 BM25 语料）
+    """
+    writer = StoreWriter(root)
+    try:
+        for c, tokens in zip(chunks, corpus_tokens):
+            writer.add(c, tokens)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+
+def store_exists(root: Path) -> bool:
+    return (root / "meta.json").exists()
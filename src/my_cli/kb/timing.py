@@ -0,0 +1,172 @@
+from __future__ import annotations
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+# 检索各阶段的计时埋点
+#
+# 用法:
+#   with recording() as rec:          # 命令入口开启记录
+#       ...
+#       with span("bm25_search") as s:  # 各模块埋点
+#           ...
+#           s.set(candidates=n)         # 附加候选数、读取字节数等信息
+#   rec.to_dict()          -> 写入 trace.json 的 "timings"
+#   rec.to_chrome_trace()  -> Chrome trace-event JSON（chrome://tracing / Perfetto 打开）
+#
+# 没有开启记录时 span() 只做一次 ContextVar 查询并返回共享的空对象，几乎没有开销。
+
+
+@dataclass
+class Span:
+    name: str
+    # 相对 Recorder 创建时刻的秒数
+    start: float
+    dur: float
+    depth: int
+    tid: int
+    attrs: Dict[str, Any] = field(default_factory=dict)
+
+
+class Recorder:
+    def __init__(self) -> None:
+        self.t0 = time.perf_counter()
+        self.spans: List[Span] = []
+        self._depth: Dict[int, int] = {}
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.t0
+
+    # 阶段按开始时间排序；depth 表示嵌套层级（0 为最外层）
+    def to_dict(self) -> Dict[str, Any]:
+        stages = []
+        for s in sorted(self.spans, key=lambda s: (s.start, s.depth)):
+            item: Dict[str, Any] = {
+                "name": s.name,
+                "start_ms": round(s.start * 1000, 3),
+                "ms": round(s.dur * 1000, 3),
+                "depth": s.depth,
+            }
+            item.update(s.attrs)
+            stages.append(item)
+        return {"total_ms": round(self.elapsed() * 1000, 3), "stages": stages}
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        pid = os.getpid()
+        events = [
+            {
+                "name": s.name,
+                "ph": "X",
+                "ts": round(s.start * 1e6, 1),
+                "dur": round(s.dur * 1e6, 1),
+                "pid": pid,
+                "tid": s.tid,
+                "args": s.attrs,
+            }
+            for s in self.spans
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    # 把 kb serve 返回的阶段（to_dict 格式）挂到本地时间轴上，offset 为请求开始时刻
+    def add_remote(self, timings: Dict[str, Any], offset: float, depth: int) -> None:
+        for st in timings.get("stages", []):
+            attrs = {
+                k: v
+                for k, v in st.items()
+                if k not in ("name", "start_ms", "ms", "depth")
+            }
+            attrs["remote"] = True
+            self.spans.append(
+                Span(
+                    name=st["name"],
+                    start=offset + st["start_ms"] / 1000,
+                    dur=st["ms"] / 1000,
+                    depth=depth + int(st.get("depth", 0)),
+                    tid=0,
+                    attrs=attrs,
+                )
+            )
+
+
+_RECORDER: ContextVar[Optional[Recorder]] = ContextVar("kb_timing", default=None)
+
+
+class _NullSpan:
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        return None
+
+    def set(self, **attrs: Any) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _ActiveSpan:
+    def __init__(self, rec: Recorder, name: str, attrs: Dict[str, Any]) -> None:
+        self.rec = rec
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self) -> "_ActiveSpan":
+        self.tid = threading.get_ident()
+        self.depth = self.rec._depth.get(self.tid, 0)
+        self.rec._depth[self.tid] = self.depth + 1
+        self.start = self.rec.elapsed()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        end = self.rec.elapsed()
+        self.rec._depth[self.tid] = self.depth
+        self.rec.spans.append(
+            Span(
+                self.name,
+                self.start,
+                end - self.start,
+                self.depth,
+                self.tid,
+                self.attrs,
+            )
+        )
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+
+def span(name: str, **attrs: Any):
+    rec = _RECORDER.get()
+    if rec is None:
+        return _NULL_SPAN
+    return _ActiveSpan(rec, name, attrs)
+
+
+def current_recorder() -> Optional[Recorder]:
+    return _RECORDER.get()
+
+
+@contextmanager
+def recording() -> Iterator[Recorder]:
+    rec = Recorder()
+    token = _RECORDER.set(rec)
+    try:
+        yield rec
+    finally:
+        _RECORDER.reset(token)
+
+
+# 文件大小（字节），不存在时为 0；用于记录各阶段读取的数据量
+def file_bytes(*paths: Any) -> int:
+    total = 0
+    for p in paths:
+        try:
+            total += os.stat(p).st_size
+        except OSError:
+            pass
+    return total
@@ -0,0 +1,227 @@
+from __future__ import annotations
+import errno
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Set
+
+from .defaults import WATCH_DEBOUNCE, WATCH_MAX_WAIT, WATCH_POLL_INTERVAL
+from .manifest import DEFAULT_EXTS, RACY_WINDOW, FileStat, stat_raw_files
+
+# kb watch：监视 raw 目录，文档变化后自动增量构建并发布新快照
+#
+# 事件来源
+#   Linux 上用 inotify（ctypes 直接调用 libc，不需要额外依赖），递归监视 raw 下的每个目录，
+#   新建的子目录随事件自动加入；其他平台、inotify 不可用或监视数达到系统上限时
+#   退回到轮询 raw 目录的 (mtime, size)
+# 防抖
+#   一批连续的变化（编辑器保存、批量拷贝）在 debounce 秒内没有新事件后才触发一次构建，
+#   最长等待 max_wait 秒，持续写入时也会定期构建
+# 构建本身是增量的：只重新切块和向量化变化的文件，完成后原子地发布新快照，检索不受影响
+
+
+class PollingWatcher:
+    def __init__(
+        self,
+        root: Path,
+        interval: float = WATCH_POLL_INTERVAL,
+        exts: Iterable[str] = DEFAULT_EXTS,
+    ) -> None:
+        self.root = root
+        self.interval = interval
+        self.exts = tuple(exts)
+        self._stats: Dict[str, FileStat] = stat_raw_files(root, self.exts)
+
+    def close(self) -> None:
+        pass
+
+    # 等待变化，返回变化的相对路径；timeout 内没有变化返回空集合（None 表示一直等）
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            stats = stat_raw_files(self.root, self.exts)
+            changed = {
+                rel
+                for rel in self._stats.keys() | stats.keys()
+                if self._stats.get(rel) != stats.get(rel)
+            }
+            self._stats = stats
+            if changed:
+                return changed
+            if deadline is None:
+                time.sleep(self.interval)
+                continue
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return set()
+            time.sleep(min(self.interval, left))
+
+
+# <linux/inotify.h>
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC if hasattr(os, "O_CLOEXEC") else 0
+
+_WATCH_MASK = (
+    _IN_CLOSE_WRITE
+    | _IN_MOVED_FROM
+    | _IN_MOVED_TO
+    | _IN_CREATE
+    | _IN_DELETE
+    | _IN_DELETE_SELF
+    | _IN_MOVE_SELF
+    | _IN_ONLYDIR
+)
+_EVENT = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    def __init__(self, root: Path, exts: Iterable[str] = DEFAULT_EXTS) -> None:
+        import ctypes
+        import ctypes.util
+
+        self.root = root
+        self.exts = tuple(exts)
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs: Dict[int, Path] = {}
+        try:
+            self._watch_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _watch_tree(self, top: Path) -> None:
+        import ctypes
+
+        for dirpath, _, _ in os.walk(top):
+            wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(dirpath), _WATCH_MASK
+            )
+            if wd < 0:
+                err = ctypes.get_errno()
+                # 目录在遍历过程中被删掉了
+                if err == errno.ENOENT:
+                    continue
+                # ENOSPC：超过 fs.inotify.max_user_watches
+                raise OSError(err, f"inotify_add_watch failed for {dirpath}")
+            self._dirs[wd] = Path(dirpath)
+
+    def _rel(self, path: Path) -> str:
+        return path.relative_to(self.root).as_posix()
+
+    # 读出当前所有事件，返回变化的相对路径（目录事件也算：目录里的文件一起增删）
+    def _drain(self) -> Set[str]:
+        changed: Set[str] = set()
+        while True:
+            try:
+                data = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            off = 0
+            while off < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, off)
+                name = os.fsdecode(data[off + _EVENT.size : off + _EVENT.size + length])
+                name = name.rstrip("\0")
+                off += _EVENT.size + length
+                if mask & _IN_Q_OVERFLOW:
+                    # 事件队列溢出：不知道丢了什么，按整个目录变化处理并重建监视
+                    self._dirs.clear()
+                    self._watch_tree(self.root)
+                    changed.add(".")
+                    continue
+                if mask & _IN_IGNORED:
+                    self._dirs.pop(wd, None)
+                    continue
+                base = self._dirs.get(wd)
+                if base is None:
+                    continue
+                path = base / name if name else base
+                if mask & _IN_ISDIR:
+                    if mask & (_IN_CREATE | _IN_MOVED_TO) and path.is_dir():
+                        self._watch_tree(path)
+                    changed.add(self._rel(path))
+                elif not name or os.path.splitext(name)[1].lower() in self.exts:
+                    # 编辑器的临时文件、swap 文件等不触发构建
+                    changed.add(self._rel(path))
+
+    def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            left = None if deadline is None else max(0.0, deadline - time.monotonic())
+            ready, _, _ = select.select([self._fd], [], [], left)
+            if not ready:
+                return set()
+            changed = self._drain()
+            if changed:
+                return changed
+
+
+def open_watcher(
+    root: Path,
+    poll_interval: float = WATCH_POLL_INTERVAL,
+    polling: bool = False,
+    exts: Iterable[str] = DEFAULT_EXTS,
+):
+    if not polling and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root, exts)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(root, poll_interval, exts)
+
+
+# 主循环：等待变化 → 防抖 → rebuild(变化的文件)；Ctrl+C 退出
+# 构建期间发生的变化留在事件队列（轮询时体现在下一次比较）里，构建完成后立即再触发一次
+# settle：构建后 settle_after 秒内没有新变化时调用一次。刚构建时处在 racy 窗口内的文件
+# 清单里没有记录 stat（防抖后的构建总是如此），由它补记，之后的检查不用再算这些文件的哈希
+def watch_loop(
+    watcher,
+    rebuild: Callable[[Set[str]], None],
+    debounce: float = WATCH_DEBOUNCE,
+    max_wait: float = WATCH_MAX_WAIT,
+    settle: Optional[Callable[[], None]] = None,
+    settle_after: float = RACY_WINDOW,
+) -> None:
+    try:
+        changed: Set[str] = set()
+        while True:
+            if not changed:
+                changed = watcher.wait()
+            started = time.monotonic()
+            while True:
+                left = max_wait - (time.monotonic() - started)
+                if left <= 0:
+                    break
+                more = watcher.wait(min(debounce, left))
+                if not more:
+                    break
+                changed |= more
+            rebuild(changed)
+            changed = set()
+            if settle is not None:
+                changed = watcher.wait(settle_after)
+                if not changed:
+                    settle()
+    finally:
+        watcher.close()
@@ -1,31 +1,47 @@
+import json
 import os
 import sys
 import shutil
 import subprocess
+import threading
 import zipfile
-import tempfile
-import ssl
-from pathlib import Path
-from typing import Tuple
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set, Tuple
 
 import typer
-import httpx
-import readchar  # 用于捕获键盘输入
-import truststore
 from rich.console import Console
 from rich.panel import Panel
 from rich.live import Live
 from rich.tree import Tree
 from rich.table import Table
 from my_cli.kb.cli import kb_app
+from my_cli.template_cache import TemplateError, TemplateInfo, fetch_template
+
+if TYPE_CHECKING:
+    import httpx
 
 # --- 配置常量 ---
 REPO_OWNER = "ffgzz"
 REPO_NAME = "myspec"
 SCRIPT_TYPE_CHOICES = {"sh": "POSIX Shell (bash/zsh)", "ps": "PowerShell"}
 
-ssl_context = truststore.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-client = httpx.Client(verify=ssl_context)
+# httpx / truststore 导入和系统证书加载要几百毫秒，只有下载模板时才创建客户端
+_client: Optional["httpx.Client"] = None
+
+
+def get_http_client() -> "httpx.Client":
+    global _client
+    if _client is None:
+        import ssl
+
+        import httpx
+        import truststore
+
+        ssl_context = truststore.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        _client = httpx.Client(verify=ssl_context)
+    return _client
+
 
 console = Console()
 app = typer.Typer(help="My Custom SDD CLI Tool", add_completion=False)
@@ -37,6 +53,8 @@ app.add_typer(kb_app, name="kb")
 
 def get_key():
     """跨平台获取单个按键输入"""
+    import readchar  # 用于捕获键盘输入，只有交互式菜单需要
+
     key = readchar.readkey()
 
     if key == readchar.key.UP or key == readchar.key.CTRL_P:
@@ -128,21 +146,29 @@ def select_with_arrows(
 
 
 # --- StepTracker (进度条组件) ---
+# 批量 init 时多个工作线程同时更新：修改行和刷新显示都在同一把锁里，
+# 刷新时看到的总是完整的一组行，两次刷新也不会交错
 class StepTracker:
     def __init__(self, title: str):
         self.title = title
         self.steps = []
         self._refresh_cb = None
+        # 刷新回调会调用 render，所以用可重入锁
+        self._lock = threading.RLock()
+        # 刷新失败时记下异常并停止刷新，不影响正在执行的步骤
+        self.refresh_error: Optional[Exception] = None
 
     def attach_refresh(self, cb):
-        self._refresh_cb = cb
+        with self._lock:
+            self._refresh_cb = cb
 
     def add(self, key: str, label: str):
-        if key not in [s["key"] for s in self.steps]:
-            self.steps.append(
-                {"key": key, "label": label, "status": "pending", "detail": ""}
-            )
-            self._maybe_refresh()
+        with self._lock:
+            if key not in [s["key"] for s in self.steps]:
+                self.steps.append(
+                    {"key": key, "label": label, "status": "pending", "detail": ""}
+                )
+                self._maybe_refresh()
 
     def start(self, key: str, detail: str = ""):
         self._update(key, status="running", detail=detail)
@@ -157,28 +183,34 @@ class StepTracker:
         self._update(key, status="skipped", detail=detail)
 
     def _update(self, key: str, status: str, detail: str):
-        for s in self.steps:
-            if s["key"] == key:
-                s["status"] = status
-                if detail:
-                    s["detail"] = detail
-                self._maybe_refresh()
-                return
-        self.steps.append(
-            {"key": key, "label": key, "status": status, "detail": detail}
-        )
-        self._maybe_refresh()
+        with self._lock:
+            for s in self.steps:
+                if s["key"] == key:
+                    s["status"] = status
+                    if detail:
+                        s["detail"] = detail
+                    self._maybe_refresh()
+                    return
+            self.steps.append(
+                {"key": key, "label": key, "status": status, "detail": detail}
+            )
+            self._maybe_refresh()
 
+    # 调用方已持有锁
     def _maybe_refresh(self):
-        if self._refresh_cb:
-            try:
-                self._refresh_cb()
-            except:
-                pass
+        if self._refresh_cb is None:
+            return
+        try:
+            self._refresh_cb()
+        except Exception as e:
+            self.refresh_error = e
+            self._refresh_cb = None
 
     def render(self):
+        with self._lock:
+            steps = [dict(step) for step in self.steps]
         tree = Tree(f"[cyan]{self.title}[/cyan]", guide_style="grey50")
-        for step in self.steps:
+        for step in steps:
             label = step["label"]
             detail = f" [dim]({step['detail']})[/dim]" if step["detail"] else ""
             status = step["status"]
@@ -201,6 +233,14 @@ class StepTracker:
         return tree
 
 
+# 进度显示中途刷新失败时提示一次（步骤本身照常执行完）
+def _report_refresh_error(tracker: StepTracker) -> None:
+    if tracker.refresh_error is not None:
+        console.print(
+            f"[yellow]Warning:[/yellow] progress display stopped updating: {tracker.refresh_error}"
+        )
+
+
 # --- 核心逻辑函数 ---
 
 
@@ -240,111 +280,323 @@ def init_git_repo(project_path: Path) -> bool:
         return False
 
 
-def download_template_from_github(download_dir: Path) -> Tuple[Path, dict]:
-    api_url = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/releases/latest"
-    resp = client.get(api_url, follow_redirects=True)
-    if resp.status_code != 200:
-        raise RuntimeError(f"GitHub API Error: {resp.status_code}")
-
-    release_data = resp.json()
-    assets = release_data.get("assets", [])
-    # 新的包命名格式: my-spec-cli-v*.zip
-    asset = next(
-        (
-            a
-            for a in assets
-            if a["name"].startswith("my-spec-cli-") and a["name"].endswith(".zip")
-        ),
-        None,
+# 每种脚本类型在模板包里对应的子目录：选中的那个提升到 scripts/ 下，另一个不解压
+SCRIPT_DIRS = {"sh": "bash", "ps": "powershell"}
+
+
+# 模板包里所有条目共同的顶层目录（release 打包时的 <name>/ 前缀），没有则为空串
+def _common_prefix(names: List[str]) -> str:
+    if not names or "/" not in names[0]:
+        return ""
+    prefix = names[0].split("/", 1)[0] + "/"
+    return prefix if all(n.startswith(prefix) for n in names) else ""
+
+
+# 条目在项目里的相对路径；None 表示跳过（未选中的脚本类型、不安全的路径）
+def _target_path(rel: str, script_type: str) -> Optional[PurePosixPath]:
+    path = PurePosixPath(rel)
+    if path.is_absolute() or ".." in path.parts or not path.parts:
+        return None
+    parts = path.parts
+    if parts[0] == "scripts" and len(parts) >= 2 and parts[1] in SCRIPT_DIRS.values():
+        if parts[1] != SCRIPT_DIRS[script_type]:
+            return None
+        if len(parts) == 2:
+            return PurePosixPath("scripts")
+        return PurePosixPath("scripts", *parts[2:])
+    return path
+
+
+def _is_executable(info: zipfile.ZipInfo, target: PurePosixPath) -> bool:
+    # 包里记录了可执行位，或者是 scripts/ 下的 shell 脚本
+    unix_mode = info.external_attr >> 16
+    return bool(unix_mode & 0o111) or (
+        target.parts[0] == "scripts" and target.suffix == ".sh"
     )
 
-    if not asset:
-        raise RuntimeError("No release asset found for my-spec-cli")
 
-    download_url = asset["browser_download_url"]
-    filename = asset["name"]
-    zip_path = download_dir / filename
+# 单遍流式解压：每个条目直接写到最终位置，一个文件只写一次
+#   - 去掉顶层目录前缀（不再先解压再搬家）
+#   - 未选中的 scripts/bash 或 scripts/powershell 整个跳过，选中的直接写进 scripts/
+#   - 可执行位在创建文件时就设置好（Windows 上忽略）
+# project_path 已存在的文件会被覆盖（--here）；返回写入的文件数
+def extract_template(zip_path: Path, project_path: Path, script_type: str) -> int:
+    written = 0
+    with zipfile.ZipFile(zip_path, "r") as zf:
+        infos = zf.infolist()
+        prefix = _common_prefix([i.filename for i in infos])
+        made: Set[Path] = set()
+        for info in infos:
+            rel = info.filename[len(prefix) :]
+            target = _target_path(rel.rstrip("/"), script_type) if rel else None
+            if target is None:
+                continue
+            dest = project_path.joinpath(*target.parts)
+            if info.is_dir():
+                if dest not in made:
+                    dest.mkdir(parents=True, exist_ok=True)
+                    made.add(dest)
+                continue
+            if dest.parent not in made:
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                made.add(dest.parent)
+            mode = 0o777 if os.name != "nt" and _is_executable(info, target) else 0o666
+            fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+            with zf.open(info) as src, os.fdopen(fd, "wb") as out:
+                shutil.copyfileobj(src, out, 1 << 20)
+            if mode == 0o777:
+                # 覆盖已有文件时 os.open 不会修改权限
+                os.chmod(dest, os.stat(dest).st_mode | 0o111)
+            written += 1
+    return written
+
+
+# 脚本类型：命令行指定时校验，否则交互式选择（管道模式下用平台默认值）
+def choose_script(script: Optional[str]) -> str:
+    if script:
+        # 如果用户通过命令行指定了 (如 --script sh)，则校验合法性
+        if script not in SCRIPT_TYPE_CHOICES:
+            console.print(
+                f"[red]Error:[/red] Invalid script type '{script}'. Choose from: {', '.join(SCRIPT_TYPE_CHOICES.keys())}"
+            )
+            raise typer.Exit(1)
+        return script
+
+    # 如果未指定，则进行交互式选择
+    default_script = "ps" if os.name == "nt" else "sh"
 
-    with client.stream("GET", download_url, follow_redirects=True) as r:
-        with open(zip_path, "wb") as f:
-            for chunk in r.iter_bytes():
-                f.write(chunk)
+    # 只有在标准终端下才显示交互菜单，管道模式下使用默认值
+    if sys.stdin.isatty():
+        return select_with_arrows(
+            SCRIPT_TYPE_CHOICES,
+            "Choose script type (or press Enter)",
+            default_script,
+        )
+    console.print(
+        f"[yellow]Non-interactive mode detected. Using default script: {default_script}[/yellow]"
+    )
+    return default_script
+
+
+# 获取模板（环境检查 + 下载/缓存两步），失败时退出
+def fetch_template_step(
+    tracker: StepTracker, offline: bool, template_zip: Optional[Path]
+) -> TemplateInfo:
+    tracker.start("env")
+    check_tool("claude", tracker)
+    tracker.complete("env")
+
+    tracker.start("download")
+    try:
+        # 模板包缓存在用户缓存目录下，重复 init 不需要再下载
+        template = fetch_template(
+            REPO_OWNER,
+            REPO_NAME,
+            get_http_client,
+            offline=offline,
+            template_zip=template_zip,
+        )
+    except TemplateError as e:
+        tracker.error("download", str(e))
+        raise typer.Exit(1)
+    tracker.complete("download", f"{template.version}, {template.source}")
+    return template
+
+
+# --- 批量初始化 ---
+# myspec init a b c  或  myspec init --batch projects.yaml
+# 模板只获取一次，各项目的解压和 git init 在线程池里并发执行（--jobs 限制并发数），
+# 进度显示为同一个 StepTracker 里每个项目一行，最后输出每个项目的结果汇总
+#
+# 清单文件（.json 直接读取，其他按 YAML 解析，需要 PyYAML）:
+#   script: sh            # 可选，所有项目的默认值
+#   no_git: false         # 可选
+#   projects:
+#     - svc-a
+#     - name: svc-b
+#       script: ps
+#       no_git: true
+# 也可以直接写成项目列表。项目路径相对于当前目录
+#
+# 每个项目的设置优先级：清单里的项目条目 > 命令行选项 > 清单顶层默认值
+
+INIT_JOBS = 4
+
+
+@dataclass
+class BatchProject:
+    name: str
+    script: Optional[str] = None
+    no_git: Optional[bool] = None
+
+
+def _read_manifest(path: Path) -> Any:
+    text = path.read_text(encoding="utf-8")
+    if path.suffix.lower() == ".json":
+        return json.loads(text)
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError(
+            "YAML manifests need PyYAML: pip install 'my-spec-cli[batch]' (or use a .json manifest)"
+        )
+    return yaml.safe_load(text)
+
+
+def load_manifest(path: Path) -> Tuple[Dict[str, Any], List[BatchProject]]:
+    data = _read_manifest(path)
+    if isinstance(data, list):
+        data = {"projects": data}
+    if not isinstance(data, dict) or not isinstance(data.get("projects"), list):
+        raise ValueError(f"{path}: expected a list of projects or a 'projects' key")
+    defaults = {k: data[k] for k in ("script", "no_git") if data.get(k) is not None}
+    projects: List[BatchProject] = []
+    for entry in data["projects"]:
+        if isinstance(entry, str):
+            entry = {"name": entry}
+        if not isinstance(entry, dict) or not entry.get("name"):
+            raise ValueError(f"{path}: every project needs a name, got {entry!r}")
+        projects.append(
+            BatchProject(
+                name=str(entry["name"]),
+                script=entry.get("script"),
+                no_git=entry.get("no_git"),
+            )
+        )
+    return defaults, projects
 
-    return zip_path, {"version": release_data["tag_name"], "filename": filename}
 
+# 项目在 StepTracker 里的行 key；加前缀，避免与 env / download 等步骤的 key 冲突
+def _project_key(project: BatchProject) -> str:
+    return f"project:{project.name}"
 
-def extract_template(
-    zip_path: Path,
+
+# 在工作线程里执行：创建目录、解压、git init；返回 (是否成功, 说明)
+def _init_project(
+    project: BatchProject,
     project_path: Path,
-    is_current_dir: bool,
-    tracker: StepTracker = None,
-):
-    with zipfile.ZipFile(zip_path, "r") as zip_ref:
-        if is_current_dir:
-            with tempfile.TemporaryDirectory() as temp_dir:
-                zip_ref.extractall(temp_dir)
-                temp_path = Path(temp_dir)
-                items = list(temp_path.iterdir())
-                source = (
-                    items[0] if len(items) == 1 and items[0].is_dir() else temp_path
-                )
-                for item in source.iterdir():
-                    dest = project_path / item.name
-                    if item.is_dir():
-                        shutil.copytree(item, dest, dirs_exist_ok=True)
-                    else:
-                        shutil.copy2(item, dest)
+    template: TemplateInfo,
+    use_git: bool,
+    tracker: StepTracker,
+) -> Tuple[bool, str]:
+    key = _project_key(project)
+    try:
+        tracker.start(key, "extracting")
+        # 已存在时报错，不覆盖任何文件
+        project_path.mkdir(parents=True)
+        files = extract_template(template.zip_path, project_path, project.script)
+        detail = f"{files} files, {project.script}"
+        if project.no_git or not use_git:
+            detail += ", no git"
         else:
-            zip_ref.extractall(project_path)
-            items = list(project_path.iterdir())
-            if len(items) == 1 and items[0].is_dir():
-                nested = items[0]
-                temp_move = project_path.parent / f"{project_path.name}_temp"
-                shutil.move(str(nested), str(temp_move))
-                project_path.rmdir()
-                shutil.move(str(temp_move), str(project_path))
-                if tracker:
-                    tracker.complete("extract", "flattened nested dir")
-
-
-def filter_scripts_by_type(project_path: Path, script_type: str):
-    """根据选择的脚本类型，将对应脚本移动到 scripts 目录下，删除子目录"""
-    scripts_dir = project_path / "scripts"
-    if not scripts_dir.exists():
-        return
+            tracker.start(key, f"{detail}, git init")
+            if not init_git_repo(project_path):
+                tracker.error(key, f"{detail}, git init failed")
+                return False, "git init failed"
+        tracker.complete(key, detail)
+        return True, detail
+    except Exception as e:
+        message = str(e) or type(e).__name__
+        tracker.error(key, message)
+        return False, message
+
+
+def init_batch(
+    names: List[str],
+    batch: Optional[Path],
+    script: Optional[str],
+    no_git: bool,
+    offline: bool,
+    template_zip: Optional[Path],
+    jobs: int,
+) -> None:
+    from concurrent.futures import ThreadPoolExecutor
+
+    defaults: Dict[str, Any] = {}
+    projects = [BatchProject(name=n) for n in names]
+    if batch is not None:
+        try:
+            defaults, listed = load_manifest(batch)
+        except (OSError, ValueError) as e:
+            console.print(f"[red]Error:[/red] Invalid manifest: {e}")
+            raise typer.Exit(1)
+        projects.extend(listed)
+    if not projects:
+        console.print("[red]No projects to initialize[/red]")
+        raise typer.Exit(1)
 
-    bash_dir = scripts_dir / "bash"
-    ps_dir = scripts_dir / "powershell"
-
-    if script_type == "sh":
-        # 将 bash 脚本移动到 scripts 根目录
-        if bash_dir.exists():
-            for script in bash_dir.iterdir():
-                shutil.move(str(script), str(scripts_dir / script.name))
-            bash_dir.rmdir()
-        # 删除 powershell 目录
-        if ps_dir.exists():
-            shutil.rmtree(ps_dir)
-    else:
-        # 将 powershell 脚本移动到 scripts 根目录
-        if ps_dir.exists():
-            for script in ps_dir.iterdir():
-                shutil.move(str(script), str(scripts_dir / script.name))
-            ps_dir.rmdir()
-        # 删除 bash 目录
-        if bash_dir.exists():
-            shutil.rmtree(bash_dir)
-
-
-def ensure_executable(project_path: Path):
-    if os.name != "nt":
-        scripts_dir = project_path / "scripts"
-        if scripts_dir.exists():
-            for script in scripts_dir.rglob("*.sh"):
-                try:
-                    os.chmod(script, script.stat().st_mode | 0o111)
-                except:
-                    pass
+    # 同一个目录出现两次时整批拒绝（进度显示按项目名区分行）
+    paths = [Path(p.name).resolve() for p in projects]
+    if len(set(paths)) != len(paths):
+        console.print("[red]Error:[/red] Duplicate projects in batch")
+        raise typer.Exit(1)
+
+    # 只有需要时才交互式选择一次脚本类型
+    if script is None:
+        script = defaults.get("script")
+    if any(p.script is None for p in projects):
+        script = choose_script(script)
+    if no_git:
+        defaults["no_git"] = True
+    for p in projects:
+        p.script = p.script or script
+        if p.no_git is None:
+            p.no_git = bool(defaults.get("no_git", False))
+
+    tracker = StepTracker(f"Initializing {len(projects)} projects")
+    tracker.add("env", "Environment Check")
+    tracker.add("download", "Fetch Template")
+    results: Dict[str, Tuple[bool, str]] = {}
+    # 提交任务前先做不需要碰磁盘的检查，有问题的项目直接记为失败
+    todo: List[Tuple[BatchProject, Path]] = []
+    for p, project_path in zip(projects, paths):
+        tracker.add(_project_key(p), p.name)
+        if p.name == ".":
+            problem = "use --here outside batch mode"
+        elif p.script not in SCRIPT_TYPE_CHOICES:
+            problem = f"invalid script type '{p.script}'"
+        elif project_path.exists():
+            problem = "directory exists"
+        else:
+            todo.append((p, project_path))
+            continue
+        tracker.error(_project_key(p), problem)
+        results[p.name] = (False, problem)
+
+    with Live(tracker.render(), console=console, refresh_per_second=4) as live:
+        tracker.attach_refresh(lambda: live.update(tracker.render()))
+        template = fetch_template_step(tracker, offline, template_zip)
+        use_git = check_tool("git")
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            futures = {
+                p.name: pool.submit(
+                    _init_project, p, project_path, template, use_git, tracker
+                )
+                for p, project_path in todo
+            }
+            for name, future in futures.items():
+                results[name] = future.result()
+    _report_refresh_error(tracker)
+
+    # 汇总
+    table = Table(show_header=True, header_style="bold", box=None)
+    table.add_column("Project", style="cyan")
+    table.add_column("Result")
+    table.add_column("Detail", style="dim")
+    for p in projects:
+        ok, detail = results[p.name]
+        table.add_row(
+            p.name, "[green]ok[/green]" if ok else "[red]failed[/red]", detail
+        )
+    console.print()
+    console.print(table)
+    failed = sum(not ok for ok, _ in results.values())
+    if failed:
+        console.print(
+            f"\n[bold red]{failed}/{len(projects)} projects failed[/], {len(projects) - failed} initialized"
+        )
+        raise typer.Exit(1)
+    console.print(f"\n[bold green]Ready![/] {len(projects)} projects initialized")
 
 
 # --- 命令定义 ---
@@ -352,15 +604,39 @@ def ensure_executable(project_path: Path):
 
 @app.command()
 def init(
-    project_name: str = typer.Argument(
-        None, help="Project name or '.' for current dir"
+    project_names: Optional[List[str]] = typer.Argument(
+        None, help="Project name(s) or '.' for current dir"
     ),
     script: str = typer.Option(None, "--script", help="Script type: sh or ps"),
     here: bool = typer.Option(False, "--here", help="Init in current dir"),
     no_git: bool = typer.Option(False, "--no-git", help="Skip git init"),
+    offline: bool = typer.Option(
+        False, "--offline", help="Use the cached template only, never touch the network"
+    ),
+    template_zip: Optional[Path] = typer.Option(
+        None, "--template-zip", help="Use a local template zip instead of the release"
+    ),
+    batch: Optional[Path] = typer.Option(
+        None, "--batch", help="Init every project listed in a YAML/JSON manifest"
+    ),
+    jobs: int = typer.Option(
+        INIT_JOBS, "--jobs", "-j", help="Projects initialized concurrently (batch mode)"
+    ),
 ):
     """Initialize a new project (Claude Code only)"""
 
+    names = project_names or []
+    # 多个项目名或清单文件：批量模式
+    if batch is not None or len(names) > 1:
+        if here:
+            console.print(
+                "[red]Error:[/red] --here cannot be used with several projects"
+            )
+            raise typer.Exit(1)
+        init_batch(names, batch, script, no_git, offline, template_zip, jobs)
+        return
+    project_name = names[0] if names else None
+
     # 1. 路径处理
     if project_name == ".":
         here = True
@@ -383,31 +659,7 @@ def init(
         raise typer.Exit(1)
 
     # 2. 脚本选择
-    if script:
-        # 如果用户通过命令行指定了 (如 --script sh)，则校验合法性
-        if script not in SCRIPT_TYPE_CHOICES:
-            console.print(
-                f"[red]Error:[/red] Invalid script type '{script}'. Choose from: {', '.join(SCRIPT_TYPE_CHOICES.keys())}"
-            )
-            raise typer.Exit(1)
-        selected_script = script
-    else:
-        # 如果未指定，则进行交互式选择
-        default_script = "ps" if os.name == "nt" else "sh"
-
-        # 只有在标准终端下才显示交互菜单，管道模式下使用默认值
-        if sys.stdin.isatty():
-            selected_script = select_with_arrows(
-                SCRIPT_TYPE_CHOICES,
-                "Choose script type (or press Enter)",
-                default_script,
-            )
-        else:
-            selected_script = default_script
-            console.print(
-                f"[yellow]Non-interactive mode detected. Using default script: {selected_script}[/yellow]"
-            )
-
+    selected_script = choose_script(script)
     console.print(f"[cyan]Selected script type:[/cyan] {selected_script}")
 
     # 3. 执行流程
@@ -420,26 +672,12 @@ def init(
     with Live(tracker.render(), console=console, refresh_per_second=4) as live:
         tracker.attach_refresh(lambda: live.update(tracker.render()))
 
-        tracker.start("env")
-        check_tool("claude", tracker)
-        tracker.complete("env")
-
-        tracker.start("download")
-        try:
-            zip_path, meta = download_template_from_github(Path.cwd())
-            tracker.complete("download", f"v{meta['version']}")
-        except Exception as e:
-            tracker.error("download", str(e))
-            raise typer.Exit(1)
+        template = fetch_template_step(tracker, offline, template_zip)
 
         tracker.start("extract")
         try:
-            extract_template(zip_path, project_path, here, tracker)
-            if zip_path.exists():
-                zip_path.unlink()
-            filter_scripts_by_type(project_path, selected_script)
-            ensure_executable(project_path)
-            tracker.complete("extract")
+            files = extract_template(template.zip_path, project_path, selected_script)
+            tracker.complete("extract", f"{files} files")
         except Exception as e:
             tracker.error("extract", str(e))
             raise typer.Exit(1)
@@ -452,6 +690,7 @@ def init(
                 tracker.error("git", "failed")
         else:
             tracker.skip("git")
+    _report_refresh_error(tracker)
 
     console.print(f"\n[bold green]Ready![/] Project initialized at {project_path}")
 
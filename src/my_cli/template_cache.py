@@ -0,0 +1,279 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+import zipfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional
+
+if TYPE_CHECKING:
+    import httpx
+
+# myspec init 的模板缓存
+#
+# 模板 zip 按 release tag 分版本缓存在用户缓存目录下:
+#   <cache>/templates/release.json        - 最近一次的 release 元数据: ETag、tag、资产名、sha256、检查时间
+#   <cache>/templates/<tag>/<asset>.zip   - 模板包
+#
+# 在线模式: RELEASE_TTL 内直接用缓存，不访问网络；
+#           过期后带 If-None-Match 请求 release 接口，304 说明没有新版本，只刷新检查时间；
+#           有新版本或缓存的包校验失败时才重新下载；网络不通时退回到已缓存的版本
+# --offline: 不访问网络，只用缓存
+# --template-zip PATH: 直接使用本地 zip，不读写缓存
+#
+# 环境变量:
+#   MYSPEC_CACHE_DIR   - 缓存根目录（默认按平台取用户缓存目录）
+#   MYSPEC_GITHUB_API  - GitHub API 地址，测试或内网时可以换成本地的替身 HTTP 服务，
+#                        只需提供 /repos/<owner>/<repo>/releases/latest 和资产下载地址
+
+CACHE_ENV = "MYSPEC_CACHE_DIR"
+API_ENV = "MYSPEC_GITHUB_API"
+DEFAULT_API = "https://api.github.com"
+# release 元数据的有效期（秒）：期内重复 init 是纯本地操作
+RELEASE_TTL = 10 * 60
+# 模板包命名格式: my-spec-cli-v*.zip
+ASSET_PREFIX = "my-spec-cli-"
+
+RELEASE_FILE = "release.json"
+
+
+class TemplateError(RuntimeError):
+    pass
+
+
+@dataclass
+class TemplateInfo:
+    zip_path: Path
+    version: str
+    filename: str
+    sha256: str
+    # download: 新下载 | cache: 缓存命中 | offline: 离线 / 网络不通时用缓存 | file: --template-zip
+    source: str
+
+
+# 各平台的用户缓存目录
+def user_cache_dir() -> Path:
+    override = os.environ.get(CACHE_ENV)
+    if override:
+        return Path(override).expanduser()
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA") or str(Path.home() / "AppData" / "Local")
+        return Path(base) / "myspec" / "Cache"
+    if sys.platform == "darwin":
+        return Path.home() / "Library" / "Caches" / "myspec"
+    base = os.environ.get("XDG_CACHE_HOME") or str(Path.home() / ".cache")
+    return Path(base) / "myspec"
+
+
+def template_cache_dir() -> Path:
+    return user_cache_dir() / "templates"
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with path.open("rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _load_release(cache_dir: Path) -> Dict[str, Any]:
+    try:
+        return json.loads((cache_dir / RELEASE_FILE).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_release(cache_dir: Path, release: Dict[str, Any]) -> None:
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    path = cache_dir / RELEASE_FILE
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(release, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+# tag 用作目录名，去掉路径分隔符等字符
+def _cached_zip(cache_dir: Path, release: Dict[str, Any]) -> Path:
+    tag = re.sub(r"[^\w.-]", "_", release["tag"]).strip(".") or "_"
+    return cache_dir / tag / release["asset"]
+
+
+# 缓存的包存在且 sha256 与记录一致时返回它
+def _verified(cache_dir: Path, release: Dict[str, Any]) -> Optional[Path]:
+    if not release.get("tag") or not release.get("asset"):
+        return None
+    path = _cached_zip(cache_dir, release)
+    if not path.is_file() or file_sha256(path) != release.get("sha256"):
+        return None
+    return path
+
+
+# 新版本下载完成后删掉旧版本的目录
+def _prune(cache_dir: Path, keep: Path) -> None:
+    import shutil
+
+    for d in cache_dir.iterdir():
+        if d.is_dir() and d != keep:
+            shutil.rmtree(d, ignore_errors=True)
+
+
+def _info(path: Path, release: Dict[str, Any], source: str) -> TemplateInfo:
+    return TemplateInfo(
+        zip_path=path,
+        version=release["tag"],
+        filename=release["asset"],
+        sha256=release["sha256"],
+        source=source,
+    )
+
+
+# 从 release 接口的返回中挑出模板包
+# 返回的不是预期的 JSON（强制门户、坏掉的镜像）时报 TemplateError，由调用方退回到缓存
+def _pick_asset(release_data: Any) -> Dict[str, Any]:
+    if not isinstance(release_data, dict) or not isinstance(
+        release_data.get("tag_name"), str
+    ):
+        raise TemplateError("Unexpected response from the release API")
+    assets = release_data.get("assets")
+    asset = next(
+        (
+            a
+            for a in (assets if isinstance(assets, list) else [])
+            if isinstance(a, dict)
+            and isinstance(a.get("name"), str)
+            and a["name"].startswith(ASSET_PREFIX)
+            and a["name"].endswith(".zip")
+        ),
+        None,
+    )
+    if not asset:
+        raise TemplateError("No release asset found for my-spec-cli")
+    if not isinstance(asset.get("browser_download_url"), str):
+        raise TemplateError(f"No download URL for {asset['name']}")
+    return asset
+
+
+# 边下载边计算 sha256，校验通过后原子地放到缓存位置
+def _download(client: "httpx.Client", asset: Dict[str, Any], dest: Path) -> str:
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(f".{dest.name}.{os.getpid()}.tmp")
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with client.stream(
+            "GET", asset["browser_download_url"], follow_redirects=True
+        ) as r:
+            if r.status_code != 200:
+                raise TemplateError(f"Template download failed: HTTP {r.status_code}")
+            with tmp.open("wb") as f:
+                for chunk in r.iter_bytes():
+                    f.write(chunk)
+                    h.update(chunk)
+                    size += len(chunk)
+        digest = h.hexdigest()
+        # GitHub 的资产信息里带 "digest": "sha256:..."，有就校验
+        expected = asset.get("digest") or ""
+        if expected.startswith("sha256:") and expected[7:] != digest:
+            raise TemplateError(f"Checksum mismatch for {asset['name']}")
+        if asset.get("size") and asset["size"] != size:
+            raise TemplateError(
+                f"Size mismatch for {asset['name']}: {size} != {asset['size']}"
+            )
+        os.replace(tmp, dest)
+        return digest
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+# --template-zip：版本号从文件名里取（my-spec-cli-v1.2.0.zip -> v1.2.0）
+def _local_template(path: Path) -> TemplateInfo:
+    path = path.expanduser().resolve()
+    if not path.is_file() or not zipfile.is_zipfile(path):
+        raise TemplateError(f"Not a zip file: {path}")
+    m = re.match(rf"{re.escape(ASSET_PREFIX)}(.+)\.zip$", path.name)
+    return TemplateInfo(
+        zip_path=path,
+        version=m.group(1) if m else "local",
+        filename=path.name,
+        sha256=file_sha256(path),
+        source="file",
+    )
+
+
+def fetch_template(
+    owner: str,
+    repo: str,
+    get_client: Callable[[], "httpx.Client"],
+    offline: bool = False,
+    template_zip: Optional[Path] = None,
+    cache_dir: Optional[Path] = None,
+) -> TemplateInfo:
+    if template_zip is not None:
+        return _local_template(template_zip)
+
+    cache_dir = cache_dir or template_cache_dir()
+    release = _load_release(cache_dir)
+    cached = _verified(cache_dir, release)
+
+    if offline:
+        if cached is None:
+            raise TemplateError(
+                f"No cached template in {cache_dir}; run `myspec init` online once or pass --template-zip"
+            )
+        return _info(cached, release, "offline")
+    if cached is not None and time.time() - release.get("checked_at", 0) < RELEASE_TTL:
+        return _info(cached, release, "cache")
+
+    import httpx
+
+    api = os.environ.get(API_ENV, DEFAULT_API).rstrip("/")
+    headers = {"Accept": "application/vnd.github+json"}
+    if cached is not None and release.get("etag"):
+        headers["If-None-Match"] = release["etag"]
+    try:
+        client = get_client()
+        resp = client.get(
+            f"{api}/repos/{owner}/{repo}/releases/latest",
+            headers=headers,
+            follow_redirects=True,
+        )
+        if resp.status_code == 304 and cached is not None:
+            release["checked_at"] = time.time()
+            _save_release(cache_dir, release)
+            return _info(cached, release, "cache")
+        if resp.status_code != 200:
+            raise TemplateError(f"GitHub API Error: {resp.status_code}")
+
+        try:
+            release_data = resp.json()
+        except ValueError as e:
+            raise TemplateError("Release API did not return JSON") from e
+        asset = _pick_asset(release_data)
+        fresh = {
+            "tag": release_data["tag_name"],
+            "asset": asset["name"],
+            "etag": resp.headers.get("ETag"),
+            "checked_at": time.time(),
+            "sha256": release.get("sha256"),
+        }
+        path = _cached_zip(cache_dir, fresh)
+        # 同一版本已经下载过（例如 ETag 过期但 release 没变）且校验通过就不再下载
+        same = fresh["tag"] == release.get("tag") and fresh["asset"] == release.get(
+            "asset"
+        )
+        if same and cached is not None:
+            _save_release(cache_dir, fresh)
+            return _info(cached, fresh, "cache")
+        fresh["sha256"] = _download(client, asset, path)
+        _save_release(cache_dir, fresh)
+        _prune(cache_dir, keep=path.parent)
+        return _info(path, fresh, "download")
+    except (httpx.HTTPError, OSError, TemplateError) as e:
+        # 网络不通（例如隔离环境里的 CI）时用已缓存的版本
+        if cached is not None:
+            return _info(cached, release, "offline")
+        raise TemplateError(f"Could not fetch template: {e}") from e
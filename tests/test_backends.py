@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from my_cli.kb.backends import EmbeddingBackend, plan_batches
+
+
+def test_incomplete_backend_fails_on_construction():
+    class NoEncode(EmbeddingBackend):
+        name = "broken"
+
+    with pytest.raises(TypeError):
+        NoEncode()
+
+
+def test_backend_subclass():
+    class Ones(EmbeddingBackend):
+        name = "ones"
+
+        def encode(self, texts, batch_size):
+            return np.ones((len(texts), 4), dtype="float32")
+
+    backend = Ones()
+    assert backend.encode(["a", "b"], 8).shape == (2, 4)
+    assert len(backend.token_lengths(["a", "中文"])) == 2
+
+
+def test_plan_batches_respects_budget():
+    lengths = [5, 50, 7, 300, 12, 40, 8]
+    batches = plan_batches(lengths, token_budget=100, max_batch=3)
+    assert sorted(i for b in batches for i in b) == list(range(len(lengths)))
+    for b in batches:
+        assert len(b) <= 3
+        assert len(b) == 1 or len(b) * max(lengths[i] for i in b) <= 100
@@ -0,0 +1,14 @@
+from my_cli.kb.cli import _batch_dir_names
+
+
+def test_distinct_ids_get_distinct_dirs():
+    ids = ["a/b", "a_b", "a b", "q1", "Q1", "x", "x", "plain"]
+    names = _batch_dir_names(ids)
+    assert len({n.lower() for n in names}) == len(ids)
+    # 没有冲突的 id 保持原来的目录名
+    assert names[-1] == "plain"
+
+
+def test_stable_across_runs():
+    ids = ["a/b", "a_b"]
+    assert _batch_dir_names(ids) == _batch_dir_names(ids)
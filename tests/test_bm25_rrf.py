@@ -0,0 +1,111 @@
+import math
+import random
+
+import numpy as np
+import pytest
+
+from my_cli.kb.bm25 import B, EPSILON, K1, build_bm25_index
+from my_cli.kb.pack import rrf_fuse
+
+# 向量化的 BM25 top-k 和加权 RRF 与逐个文档 / 逐个键计算的参考实现逐项一致
+
+
+def _reference_bm25(corpus, query, topk, rows=None):
+    n = len(corpus)
+    avgdl = sum(len(d) for d in corpus) / n
+    # 按词首次出现的顺序统计，平均 IDF 的累加顺序与建索引时相同
+    df = {}
+    for doc in corpus:
+        for tok in dict.fromkeys(doc):
+            df[tok] = df.get(tok, 0) + 1
+    idf = {t: math.log(n - c + 0.5) - math.log(c + 0.5) for t, c in df.items()}
+    avg_idf = sum(idf.values()) / len(idf)
+    idf = {t: v if v >= 0 else EPSILON * avg_idf for t, v in idf.items()}
+
+    universe = list(range(n)) if rows is None else list(rows)
+    scores = {}
+    for d in universe:
+        doc = corpus[d]
+        s = 0.0
+        for q in query:
+            tf = doc.count(q)
+            if not tf:
+                continue
+            denom = tf + K1 * (1 - B + B * len(doc) / avgdl)
+            s += idf[q] * (tf * (K1 + 1) / denom)
+        scores[d] = s
+    ranked = sorted(universe, key=lambda d: (-scores[d], d))[:topk]
+    return ranked, [scores[d] for d in ranked]
+
+
+def _corpus(rng, n, vocab):
+    return [rng.choices(vocab, k=rng.randint(1, 12)) for _ in range(n)]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_bm25_topk_matches_reference(seed):
+    rng = random.Random(seed)
+    # 词表小，得分相同和负 IDF 的情况都很常见
+    vocab = [f"w{i}" for i in range(rng.randint(3, 15))]
+    corpus = _corpus(rng, rng.randint(1, 60), vocab)
+    index = build_bm25_index(corpus)
+    for _ in range(10):
+        query = rng.choices(vocab + ["oov"], k=rng.randint(1, 4))
+        topk = rng.randint(1, 25)
+        rows = None
+        if rng.random() < 0.5:
+            rows = np.array(
+                sorted(rng.sample(range(len(corpus)), rng.randint(1, len(corpus)))),
+                dtype="int64",
+            )
+        docs, scores = index.topk(query, topk=topk, rows=rows)
+        ref_docs, ref_scores = _reference_bm25(corpus, query, topk, rows)
+        assert docs.tolist() == ref_docs
+        assert scores.tolist() == ref_scores
+
+
+def _reference_rrf(ranked, weights, k):
+    scores = {}
+    for keys, w in zip(ranked, weights):
+        for rank, key in enumerate(keys, start=1):
+            scores[key] = scores.get(key, 0.0) + w / (k + rank)
+    return sorted(scores.items(), key=lambda kv: -kv[1])
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_rrf_fuse_matches_reference(seed):
+    rng = random.Random(seed)
+    lists = [
+        np.array(rng.sample(range(40), rng.randint(0, 20)), dtype="int64")
+        for _ in range(rng.randint(1, 5))
+    ]
+    weights = [rng.choice([1.0, 0.5, 2.0]) for _ in lists]
+    keys, scores = rrf_fuse(lists, weights, k=60)
+    ref = _reference_rrf([r.tolist() for r in lists], weights, 60)
+    assert list(zip(keys.tolist(), scores.tolist())) == ref
+
+
+def test_rrf_fuse_rejects_weight_mismatch():
+    with pytest.raises(ValueError):
+        rrf_fuse([np.arange(3)], [1.0, 1.0])
+
+
+# 查询开销与 postings 总长有关，与库的大小无关：不分配 N 大小的数组
+def test_bm25_query_memory_is_independent_of_corpus_size():
+    import tracemalloc
+
+    n = 100_000
+    corpus = [["common"] for _ in range(n)]
+    corpus[123] = ["rare", "common"]
+    index = build_bm25_index(corpus)
+    rows = np.arange(0, n, 2, dtype="int64")
+    index.topk(["rare"], topk=5, rows=rows)
+    tracemalloc.start()
+    try:
+        docs, _ = index.topk(["rare"], topk=5)
+        index.topk(["rare"], topk=5, rows=rows)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert docs[0] == 123
+    assert peak < n
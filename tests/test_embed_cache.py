@@ -0,0 +1,103 @@
+import zlib
+from multiprocessing import get_context
+
+import numpy as np
+
+from my_cli.kb.embed_cache import EmbeddingCache
+
+
+def _vec(text: str) -> np.ndarray:
+    return np.random.default_rng(zlib.crc32(text.encode())).random(8, dtype="float32")
+
+
+def _store(cache: EmbeddingCache, texts):
+    cache.store(list(texts), np.stack([_vec(t) for t in texts]))
+
+
+def _check(root, texts):
+    cache = EmbeddingCache(root, "m")
+    hits, missing = cache.lookup(list(texts))
+    assert missing == []
+    for i, t in enumerate(texts):
+        np.testing.assert_array_equal(hits[i], _vec(t))
+
+
+# 构建和查询交错写入同一份缓存：两边的向量都保留，且行与 key 对应
+def test_interleaved_writers(tmp_path):
+    base = EmbeddingCache(tmp_path, "m")
+    _store(base, ["x", "y"])
+    base.flush()
+    build = EmbeddingCache(tmp_path, "m")
+    query = EmbeddingCache(tmp_path, "m")
+    _store(build, [f"b{i}" for i in range(5)])
+    _store(query, ["q1", "q2"])
+    query.flush()
+    build.flush()
+    _check(tmp_path, ["x", "y", "q1", "q2"] + [f"b{i}" for i in range(5)])
+
+
+# 异常退出留下的半截数据不影响后续写入
+def test_partial_tail(tmp_path):
+    cache = EmbeddingCache(tmp_path, "m")
+    _store(cache, ["x"])
+    cache.flush()
+    with (tmp_path / "m" / "vectors.f32").open("ab") as f:
+        f.write(b"\1" * 13)
+    cache = EmbeddingCache(tmp_path, "m")
+    _store(cache, ["y"])
+    cache.flush()
+    _check(tmp_path, ["x", "y"])
+
+
+# 只有命中（时间戳变化）时不重写 keys/stamps
+def test_lookup_does_not_rewrite(tmp_path):
+    cache = EmbeddingCache(tmp_path, "m")
+    _store(cache, ["x"])
+    cache.flush()
+    keys = tmp_path / "m" / "keys.npy"
+    before = keys.stat().st_mtime_ns
+    cache = EmbeddingCache(tmp_path, "m")
+    assert cache.lookup(["x"])[1] == []
+    cache.flush()
+    assert keys.stat().st_mtime_ns == before
+
+
+def test_eviction_keeps_rows_aligned(tmp_path):
+    texts = [f"t{i}" for i in range(10)]
+    cache = EmbeddingCache(tmp_path, "m", max_bytes=8 * 4 * 5)
+    _store(cache, texts)
+    cache.flush()
+    cache = EmbeddingCache(tmp_path, "m")
+    assert len(cache) <= 5
+    hits, _ = cache.lookup(texts)
+    assert hits
+    for i, v in hits.items():
+        np.testing.assert_array_equal(v, _vec(texts[i]))
+
+
+def _worker(args):
+    root, w = args
+    for j in range(20):
+        cache = EmbeddingCache(root, "m")
+        texts = [f"t{(w * 7 + j * 3 + k) % 60}" for k in range(5)]
+        hits, missing = cache.lookup(texts)
+        for i, v in hits.items():
+            np.testing.assert_array_equal(v, _vec(texts[i]))
+        if missing:
+            _store(cache, [texts[i] for i in missing])
+            cache.flush()
+
+
+def test_concurrent_processes(tmp_path):
+    with get_context("spawn").Pool(4) as pool:
+        pool.map(_worker, [(tmp_path, w) for w in range(8)])
+    texts = sorted(
+        {
+            f"t{(w * 7 + j * 3 + k) % 60}"
+            for w in range(8)
+            for j in range(20)
+            for k in range(5)
+        }
+    )
+    _check(tmp_path, texts)
+    assert len(EmbeddingCache(tmp_path, "m")) == len(texts)
@@ -0,0 +1,40 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+# myspec version / check / init 不能因为导入 kb 的依赖而变慢（见 main.py、kb/cli.py 的延迟导入）
+HEAVY = ["numpy", "faiss", "jieba", "sentence_transformers", "torch", "httpx", "yaml"]
+# 宽松的上限：正常只需约 0.15s，只用来发现整包重依赖被重新导入
+BUDGET_S = 1.5
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+
+
+def _run(code: str) -> dict:
+    env = {**os.environ, "PYTHONPATH": str(SRC)}
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        capture_output=True,
+        text=True,
+        env=env,
+    ).stdout
+    return json.loads(out)
+
+
+def test_main_import_is_light():
+    code = (
+        "import json, sys, time\n"
+        "t = time.perf_counter()\n"
+        "import my_cli.main\n"
+        "elapsed = time.perf_counter() - t\n"
+        f"heavy = [m for m in {HEAVY!r} if m in sys.modules]\n"
+        "print(json.dumps({'elapsed': elapsed, 'heavy': heavy}))\n"
+    )
+    # 第一次运行可能要写 .pyc，取第二次
+    _run(code)
+    result = _run(code)
+    assert result["heavy"] == []
+    assert result["elapsed"] < BUDGET_S
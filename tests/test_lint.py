@@ -0,0 +1,18 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+# 未定义的名字、没用到的导入等问题（需要安装 pyflakes）
+def test_pyflakes_clean():
+    pytest.importorskip("pyflakes")
+    result = subprocess.run(
+        [sys.executable, "-m", "pyflakes", str(ROOT / "src"), str(ROOT / "tests")],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
@@ -0,0 +1,158 @@
+import json
+import os
+import time
+
+from my_cli.kb import manifest as m
+from my_cli.kb.manifest import (
+    BuildManifest,
+    FileEntry,
+    diff_manifest,
+    load_manifest,
+    recorded_stat,
+    refresh_stats,
+    save_manifest,
+    scan_raw_files,
+    stale_files,
+    stat_raw_files,
+)
+
+# 一小时前：在 racy 窗口之外
+OLD = time.time() - 3600
+
+
+def _write(root, rel, text, mtime=OLD):
+    p = root / rel
+    p.parent.mkdir(parents=True, exist_ok=True)
+    p.write_text(text, encoding="utf-8")
+    os.utime(p, (mtime, mtime))
+    return p
+
+
+# 与 build_kb 记录清单的方式相同
+def _record(root, now=None):
+    stats = stat_raw_files(root)
+    manifest = BuildManifest(model="m")
+    for rel, p in scan_raw_files(root).items():
+        mtime_ns, size = recorded_stat(stats[rel], now)
+        manifest.files[rel] = FileEntry(
+            sha1=m.file_sha1(p), mtime_ns=mtime_ns, size=size
+        )
+    return manifest
+
+
+def _kb(tmp_path):
+    root = tmp_path / "raw"
+    _write(root, "a.md", "alpha")
+    _write(root, "sub/b.txt", "beta")
+    _write(root, "ignored.swp", "x")
+    return root
+
+
+def test_unchanged_is_not_stale(tmp_path):
+    root = _kb(tmp_path)
+    manifest = _record(root)
+    assert set(manifest.files) == {"a.md", "sub/b.txt"}
+    assert stale_files(manifest, root) == []
+
+
+def test_touch_only_is_not_stale(tmp_path):
+    root = _kb(tmp_path)
+    manifest = _record(root)
+    os.utime(root / "a.md", (OLD + 60, OLD + 60))
+    assert stale_files(manifest, root) == []
+
+
+def test_changes_are_stale(tmp_path):
+    root = _kb(tmp_path)
+    manifest = _record(root)
+    # 大小相同、mtime 变化
+    _write(root, "a.md", "ALPHA", mtime=OLD + 60)
+    _write(root, "c.md", "new")
+    (root / "sub" / "b.txt").unlink()
+    assert stale_files(manifest, root) == ["a.md", "c.md", "sub/b.txt"]
+
+
+# 构建时刚被写入的文件不记录 stat：之后同一秒内的同大小修改也能通过哈希发现
+def test_racy_window_falls_back_to_hash(tmp_path):
+    root = tmp_path / "raw"
+    now = time.time()
+    _write(root, "a.md", "alpha", mtime=now)
+    manifest = _record(root, now)
+    entry = manifest.files["a.md"]
+    assert (entry.mtime_ns, entry.size) == (0, -1)
+    assert stale_files(manifest, root) == []
+    _write(root, "a.md", "ALPHA", mtime=now)
+    assert stale_files(manifest, root) == ["a.md"]
+
+
+def test_diff_skips_hashing_stat_clean_files(tmp_path, monkeypatch):
+    root = _kb(tmp_path)
+    manifest = _record(root)
+    _write(root, "a.md", "changed", mtime=OLD + 60)
+    hashed = []
+    real = m.file_sha1
+    monkeypatch.setattr(m, "file_sha1", lambda p: hashed.append(p.name) or real(p))
+    diff, hashes = diff_manifest(manifest, scan_raw_files(root), stat_raw_files(root))
+    assert hashed == ["a.md"]
+    assert diff.changed == ["a.md"]
+    assert diff.unchanged == ["sub/b.txt"]
+    assert hashes["sub/b.txt"] == manifest.files["sub/b.txt"].sha1
+
+
+def test_save_load_round_trip(tmp_path):
+    root = _kb(tmp_path)
+    manifest = _record(root)
+    path = tmp_path / "build_manifest.json"
+    save_manifest(manifest, path)
+    assert load_manifest(path).files == manifest.files
+
+
+# 旧版清单没有 mtime / size：照常读取，比较时退回到哈希
+def test_old_manifest_without_stat(tmp_path):
+    root = _kb(tmp_path)
+    path = tmp_path / "build_manifest.json"
+    files = {
+        rel: {"sha1": m.file_sha1(p), "chunk_ids": []}
+        for rel, p in scan_raw_files(root).items()
+    }
+    data = {"version": m.MANIFEST_VERSION, "model": "m", "files": files}
+    path.write_text(json.dumps(data), encoding="utf-8")
+    manifest = load_manifest(path)
+    assert manifest.files["a.md"].mtime_ns == 0
+    assert stale_files(manifest, root) == []
+
+
+# 构建时处在 racy 窗口内的文件：窗口过后没有变化的构建补记 stat，之后的检查不再计算哈希
+def test_refresh_stats_after_racy_window(tmp_path, monkeypatch):
+    root = tmp_path / "raw"
+    built_at = time.time()
+    _write(root, "a.md", "alpha", mtime=built_at)
+    _write(root, "b.md", "beta")
+    manifest = _record(root, built_at)
+    assert manifest.files["a.md"].mtime_ns == 0
+
+    later = built_at + m.RACY_WINDOW + 1
+    stats = stat_raw_files(root)
+    diff, _ = diff_manifest(manifest, scan_raw_files(root), stats)
+    assert not diff.dirty
+    assert refresh_stats(manifest, diff.unchanged, stats, later)
+    assert manifest.files["a.md"].mtime_ns == stats["a.md"][0]
+    # 已经一致时不需要重写清单
+    assert not refresh_stats(manifest, diff.unchanged, stats, later)
+
+    hashed = []
+    real = m.file_sha1
+    monkeypatch.setattr(m, "file_sha1", lambda p: hashed.append(p.name) or real(p))
+    assert stale_files(manifest, root) == []
+    assert hashed == []
+
+
+# 窗口内再次构建仍然不记录
+def test_refresh_stats_inside_window(tmp_path):
+    root = tmp_path / "raw"
+    now = time.time()
+    _write(root, "a.md", "alpha", mtime=now)
+    manifest = _record(root, now)
+    stats = stat_raw_files(root)
+    assert not refresh_stats(manifest, ["a.md"], stats, now)
+    assert manifest.files["a.md"].mtime_ns == 0
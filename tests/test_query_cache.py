@@ -0,0 +1,63 @@
+import json
+
+from my_cli.kb import cli
+from my_cli.kb.chunker import Chunk
+from my_cli.kb.pack import RetrievalHit
+from my_cli.kb.paths import KBPaths
+from my_cli.kb.query_cache import QueryCache, clear_query_cache
+from my_cli.kb.snapshot import new_snapshot, publish
+from my_cli.kb.store import StoreWriter
+
+
+# 发布一个只有 index_meta 和空存储的快照，模拟一次 kb build
+def _publish(paths, build_id):
+    snap = new_snapshot(paths, build_id)
+    StoreWriter(snap.kb_store).close()
+    snap.index_meta.write_text(json.dumps({"build_id": build_id}), encoding="utf-8")
+    publish(paths, snap)
+    clear_query_cache(paths)
+
+
+def _hit(text):
+    chunk = Chunk(
+        chunk_id=text, source_path="a.md", heading="", content=text, namespace=""
+    )
+    return RetrievalHit(fused_score=1.0, chunk=chunk)
+
+
+def test_cache_hit_and_invalidation(tmp_path, monkeypatch):
+    paths = KBPaths(project_root=tmp_path)
+    _publish(paths, "a" * 32)
+    calls = []
+
+    def fake_retrieve(paths, query, topk, ns_list, targets=None):
+        calls.append(query)
+        return [_hit("old")]
+
+    monkeypatch.setattr(cli, "_retrieve_uncached", fake_retrieve)
+    assert cli._retrieve(paths, "q", 8, None)[0].chunk.content == "old"
+    assert cli._retrieve(paths, "q", 8, None)[0].chunk.content == "old"
+    assert calls == ["q"]
+    _publish(paths, "b" * 32)
+    cli._retrieve(paths, "q", 8, None)
+    assert calls == ["q", "q"]
+
+
+# 检索进行中 kb build 发布了新索引：旧快照的结果不能记到新索引的版本号下
+def test_publish_between_lookup_and_write(tmp_path, monkeypatch):
+    paths = KBPaths(project_root=tmp_path)
+    _publish(paths, "a" * 32)
+    seen = []
+
+    def slow_retrieve(paths_, query, topk, ns_list, targets=None):
+        seen.append(targets[0][1].index_meta.parent.name)
+        _publish(paths, "b" * 32)
+        return [_hit("from old snapshot")]
+
+    monkeypatch.setattr(cli, "_retrieve_uncached", slow_retrieve)
+    cli._retrieve(paths, "q", 8, None)
+    # 检索用的是查缓存时固定的旧快照
+    assert seen[0].endswith("a" * 12)
+    cache = QueryCache.open(paths)
+    assert cache.fingerprint == "b" * 32
+    assert cache.get("q", 8, None) is None
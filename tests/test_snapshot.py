@@ -0,0 +1,119 @@
+import os
+import time
+
+from my_cli.kb.paths import KBPaths
+from my_cli.kb.snapshot import (
+    LEGACY_RETIRED_MARKER,
+    RETIRED_MARKER,
+    current_snapshot,
+    gc_snapshots,
+    new_snapshot,
+    publish,
+)
+
+
+def _age(path, seconds):
+    t = time.time() - seconds
+    os.utime(path, (t, t))
+
+
+def _snapshot(paths, build_id):
+    snap = new_snapshot(paths, build_id)
+    (snap.snapshot_dir / "index_meta.json").write_text("{}", encoding="utf-8")
+    return snap
+
+
+def test_publish_retires_previous(tmp_path):
+    paths = KBPaths(project_root=tmp_path)
+    a = _snapshot(paths, "a" * 12)
+    publish(paths, a)
+    b = _snapshot(paths, "b" * 12)
+    publish(paths, b)
+    assert current_snapshot(paths) == b.snapshot_dir.name
+    assert (a.snapshot_dir / RETIRED_MARKER).exists()
+    assert not (b.snapshot_dir / RETIRED_MARKER).exists()
+
+
+def test_gc_collects_retired_after_grace(tmp_path):
+    paths = KBPaths(project_root=tmp_path)
+    a = _snapshot(paths, "a" * 12)
+    publish(paths, a)
+    publish(paths, _snapshot(paths, "b" * 12))
+    assert gc_snapshots(paths, grace=60) == 0
+    _age(a.snapshot_dir / RETIRED_MARKER, 120)
+    assert gc_snapshots(paths, grace=60) == 1
+    assert not a.snapshot_dir.exists()
+
+
+# 在别的构建发布之前开始的长时间构建：目录名排在 CURRENT 前面、顶层 mtime 很旧，
+# 但还没有发布过，不能当作退役快照删除
+def test_gc_keeps_unpublished_build(tmp_path):
+    paths = KBPaths(project_root=tmp_path)
+    slow = _snapshot(paths, "0" * 12)
+    publish(paths, _snapshot(paths, "f" * 12))
+    assert slow.snapshot_dir.name < current_snapshot(paths)
+    _age(slow.snapshot_dir, 3600)
+    _age(slow.snapshot_dir / "index_meta.json", 3600)
+    assert gc_snapshots(paths, grace=60, abandoned=86400) == 0
+    assert slow.snapshot_dir.exists()
+    # 超过 abandoned 没有任何写入才算中途失败
+    _age(slow.snapshot_dir, 2 * 86400)
+    _age(slow.snapshot_dir / "index_meta.json", 2 * 86400)
+    assert gc_snapshots(paths, grace=60, abandoned=86400) == 1
+
+
+# 切换 CURRENT 之前崩溃：标记已写入但快照仍是 CURRENT，GC 不会删它；
+# 下一次发布重写标记，宽限期从真正退役时算起
+def test_marker_written_before_swap(tmp_path, monkeypatch):
+    paths = KBPaths(project_root=tmp_path)
+    a = _snapshot(paths, "a" * 12)
+    publish(paths, a)
+    b = _snapshot(paths, "b" * 12)
+
+    def crash(src, dst):
+        raise OSError("crash")
+
+    monkeypatch.setattr(os, "replace", crash)
+    try:
+        publish(paths, b)
+    except OSError:
+        pass
+    monkeypatch.undo()
+    assert current_snapshot(paths) == a.snapshot_dir.name
+    assert (a.snapshot_dir / RETIRED_MARKER).exists()
+    _age(a.snapshot_dir / RETIRED_MARKER, 3600)
+    assert gc_snapshots(paths, grace=60) == 0
+    assert a.snapshot_dir.exists()
+
+    publish(paths, _snapshot(paths, "c" * 12))
+    assert gc_snapshots(paths, grace=60) == 0
+    assert a.snapshot_dir.exists()
+
+
+# 旧版布局的文件按迁移时间（LEGACY_RETIRED 标记）计算宽限期，而不是文件自己的 mtime
+def test_legacy_files_kept_for_grace_after_migration(tmp_path):
+    paths = KBPaths(project_root=tmp_path)
+    paths.kb_root.mkdir(parents=True)
+    paths.index_meta.write_text("{}", encoding="utf-8")
+    paths.kb_store.mkdir()
+    _age(paths.index_meta, 30 * 86400)
+    publish(paths, _snapshot(paths, "a" * 12))
+    marker = paths.kb_root / LEGACY_RETIRED_MARKER
+    assert marker.exists()
+    gc_snapshots(paths, grace=60)
+    assert paths.index_meta.exists() and paths.kb_store.exists()
+    _age(marker, 120)
+    gc_snapshots(paths, grace=60)
+    assert not paths.index_meta.exists() and not paths.kb_store.exists()
+    assert not marker.exists()
+
+
+# 标记引入之前就迁移过的知识库：第一次 GC 只开始计时
+def test_legacy_files_without_marker_start_grace(tmp_path):
+    paths = KBPaths(project_root=tmp_path)
+    publish(paths, _snapshot(paths, "a" * 12))
+    paths.index_meta.write_text("{}", encoding="utf-8")
+    _age(paths.index_meta, 30 * 86400)
+    gc_snapshots(paths, grace=60)
+    assert paths.index_meta.exists()
+    assert (paths.kb_root / LEGACY_RETIRED_MARKER).exists()
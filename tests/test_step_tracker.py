@@ -0,0 +1,54 @@
+import threading
+
+from my_cli.main import StepTracker
+
+
+def test_concurrent_updates_keep_rows_consistent():
+    tracker = StepTracker("t")
+    keys = [f"project:{i}" for i in range(16)]
+    for k in keys:
+        tracker.add(k, k)
+    active = []
+    overlaps = []
+
+    # 刷新回调不应被两个线程同时进入，每次看到的行数都完整
+    def refresh():
+        active.append(1)
+        if len(active) > 1:
+            overlaps.append(len(active))
+        tracker.render()
+        assert len(tracker.steps) == len(keys)
+        active.pop()
+
+    tracker.attach_refresh(refresh)
+
+    def worker(key):
+        for _ in range(50):
+            tracker.start(key, "extracting")
+            tracker.complete(key, "done")
+
+    threads = [threading.Thread(target=worker, args=(k,)) for k in keys]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not overlaps
+    assert tracker.refresh_error is None
+    assert [s["status"] for s in tracker.steps] == ["done"] * len(keys)
+
+
+def test_failing_refresh_is_recorded_and_detached():
+    tracker = StepTracker("t")
+    calls = []
+
+    def refresh():
+        calls.append(1)
+        raise RuntimeError("boom")
+
+    tracker.attach_refresh(refresh)
+    tracker.add("a", "A")
+    tracker.complete("a")
+    # 步骤照常更新，回调只失败一次后不再调用
+    assert tracker.steps[0]["status"] == "done"
+    assert len(calls) == 1
+    assert str(tracker.refresh_error) == "boom"
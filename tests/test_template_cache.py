@@ -0,0 +1,177 @@
+import io
+import json
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from my_cli import template_cache
+from my_cli.template_cache import TemplateError, fetch_template
+
+# 用本地的替身 HTTP 服务代替 GitHub API（MYSPEC_GITHUB_API）
+
+
+def _zip_bytes(tag: str) -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        z.writestr("README.md", f"template {tag}\n")
+    return buf.getvalue()
+
+
+class FakeGitHub:
+    def __init__(self) -> None:
+        self.tag = "v1.0.0"
+        # 设置后 release 接口原样返回这段内容（模拟强制门户、坏掉的镜像）
+        self.raw_body = None
+        self.requests = []
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                fake.requests.append((self.path, dict(self.headers)))
+                if self.path.endswith("/releases/latest"):
+                    fake._release(self)
+                elif self.path.startswith("/dl/"):
+                    body = _zip_bytes(fake.tag)
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def _release(self, handler: BaseHTTPRequestHandler) -> None:
+        etag = f'"{self.tag}"'
+        if self.raw_body is not None:
+            body = self.raw_body
+        elif handler.headers.get("If-None-Match") == etag:
+            handler.send_response(304)
+            handler.end_headers()
+            return
+        else:
+            name = f"my-spec-cli-{self.tag}.zip"
+            body = json.dumps(
+                {
+                    "tag_name": self.tag,
+                    "assets": [
+                        {
+                            "name": name,
+                            "size": len(_zip_bytes(self.tag)),
+                            "browser_download_url": f"{self.url}/dl/{name}",
+                        }
+                    ],
+                }
+            ).encode()
+        handler.send_response(200)
+        handler.send_header("ETag", etag)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def api_calls(self):
+        return [h for p, h in self.requests if p.endswith("/releases/latest")]
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def github(monkeypatch, tmp_path):
+    fake = FakeGitHub()
+    monkeypatch.setenv(template_cache.API_ENV, fake.url)
+    monkeypatch.setenv(template_cache.CACHE_ENV, str(tmp_path / "cache"))
+    yield fake
+    fake.close()
+
+
+def _fetch(**kw):
+    return fetch_template("o", "r", lambda: httpx.Client(timeout=5), **kw)
+
+
+def _expire(cache_dir) -> None:
+    path = cache_dir / template_cache.RELEASE_FILE
+    release = json.loads(path.read_text(encoding="utf-8"))
+    release["checked_at"] = 0
+    path.write_text(json.dumps(release), encoding="utf-8")
+
+
+def test_download_then_cache_within_ttl(github):
+    first = _fetch()
+    assert first.source == "download"
+    assert first.version == "v1.0.0"
+    assert zipfile.is_zipfile(first.zip_path)
+    second = _fetch()
+    assert second.source == "cache"
+    assert second.zip_path == first.zip_path
+    assert len(github.api_calls()) == 1
+
+
+def test_revalidates_with_etag(github):
+    _fetch()
+    _expire(template_cache.template_cache_dir())
+    info = _fetch()
+    assert info.source == "cache"
+    calls = github.api_calls()
+    assert calls[-1].get("If-None-Match") == '"v1.0.0"'
+    # 304 之后不再下载
+    assert sum(p.startswith("/dl/") for p, _ in github.requests) == 1
+
+
+def test_new_release_replaces_old(github):
+    old = _fetch()
+    _expire(template_cache.template_cache_dir())
+    github.tag = "v1.1.0"
+    new = _fetch()
+    assert new.source == "download"
+    assert new.version == "v1.1.0"
+    assert not old.zip_path.exists()
+
+
+def test_offline(github):
+    with pytest.raises(TemplateError):
+        _fetch(offline=True)
+    _fetch()
+    info = _fetch(offline=True)
+    assert info.source == "offline"
+    assert len(github.api_calls()) == 1
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b"<html>captive portal</html>",
+        b"[]",
+        b'{"tag_name": "v2"}',
+        b'{"tag_name": "v2", "assets": [{"name": "my-spec-cli-v2.zip"}]}',
+    ],
+)
+def test_bad_payload(github, body):
+    github.raw_body = body
+    with pytest.raises(TemplateError):
+        _fetch()
+    # 有缓存时退回到缓存的版本
+    github.raw_body = None
+    _fetch()
+    _expire(template_cache.template_cache_dir())
+    github.raw_body = body
+    info = _fetch()
+    assert info.source == "offline"
+    assert info.version == "v1.0.0"
+
+
+def test_network_down_uses_cache(github):
+    _fetch()
+    _expire(template_cache.template_cache_dir())
+    github.close()
+    assert _fetch().source == "offline"
@@ -0,0 +1,51 @@
+from my_cli.kb.watch import PollingWatcher, watch_loop
+
+
+class FakeWatcher:
+    # events: 每次 wait 依次返回的变化集合；用完后抛 KeyboardInterrupt 结束循环
+    def __init__(self, events):
+        self.events = list(events)
+        self.closed = False
+
+    def wait(self, timeout=None):
+        if not self.events:
+            raise KeyboardInterrupt
+        return self.events.pop(0)
+
+    def close(self):
+        self.closed = True
+
+
+def _run(events, **kw):
+    watcher = FakeWatcher(events)
+    builds, settles = [], []
+    try:
+        watch_loop(
+            watcher, builds.append, settle=lambda: settles.append(len(builds)), **kw
+        )
+    except KeyboardInterrupt:
+        pass
+    assert watcher.closed
+    return builds, settles
+
+
+def test_debounce_merges_burst():
+    # 第一次变化 → 防抖期间又来两次 → 静默 → 构建；settle 窗口内没有变化 → settle
+    builds, settles = _run([{"a.md"}, {"b.md"}, {"a.md"}, set(), set()])
+    assert builds == [{"a.md", "b.md"}]
+    assert settles == [1]
+
+
+def test_change_during_settle_window_rebuilds():
+    builds, settles = _run([{"a.md"}, set(), {"c.md"}, set(), set()])
+    assert builds == [{"a.md"}, {"c.md"}]
+    assert settles == [2]
+
+
+def test_polling_watcher(tmp_path):
+    (tmp_path / "a.md").write_text("a", encoding="utf-8")
+    watcher = PollingWatcher(tmp_path, interval=0.01)
+    assert watcher.wait(0.05) == set()
+    (tmp_path / "b.md").write_text("b", encoding="utf-8")
+    (tmp_path / "ignored.swp").write_text("x", encoding="utf-8")
+    assert watcher.wait(1.0) == {"b.md"}